@@ -0,0 +1,531 @@
+import math
+import numbers
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from medicaltorch.transforms import IntensityAugmentation, MTTransform, get_rng, standard_normal
+
+
+def _as_tensor(data):
+    """Return the data as a single (B, C, H, W) tensor and the channel
+    sizes to split it back, if it was a list of tensors."""
+    if isinstance(data, (list, tuple)):
+        return torch.cat(list(data), dim=1), [item.size(1) for item in data]
+    return data, None
+
+
+def _batch_size(data):
+    if isinstance(data, (list, tuple)):
+        return data[0].size(0)
+    return data.size(0)
+
+
+def _restore(data, split_sizes):
+    if split_sizes is None:
+        return data
+    return list(torch.split(data, split_sizes, dim=1))
+
+
+def _pixel_to_normalized(height, width, dtype=torch.float32):
+    """Return the matrix mapping continuous pixel coordinates (x, y), with
+    the pixel centers at i + 0.5, to the [-1, 1] coordinates of grid_sample
+    (align_corners=False)."""
+    return torch.tensor([[2. / width, 0., -1.],
+                         [0., 2. / height, -1.],
+                         [0., 0., 1.]], dtype=dtype)
+
+
+def warp_affine(data, matrices, output_size, mode='bilinear'):
+    """Warp a batch with per-sample affine transformations in one
+    grid_sample pass.
+
+    :param data: the (B, C, H, W) tensor.
+    :param matrices: the (B, 3, 3) forward transformations, mapping input
+                     pixel coordinates (x, y) to output pixel coordinates.
+    :param output_size: the (height, width) of the output.
+    :param mode: the interpolation mode of grid_sample.
+    """
+    height, width = data.shape[-2:]
+    out_height, out_width = output_size
+    norm_in = _pixel_to_normalized(height, width).to(data.device)
+    norm_out = _pixel_to_normalized(out_height, out_width).to(data.device)
+    matrices = matrices.to(data.device, torch.float32)
+    theta = norm_in.matmul(torch.inverse(matrices)).matmul(torch.inverse(norm_out))
+    grid = F.affine_grid(theta[:, :2], (data.size(0), data.size(1), out_height, out_width),
+                         align_corners=False)
+    return F.grid_sample(data, grid, mode=mode, padding_mode='zeros',
+                         align_corners=False)
+
+
+def _threshold_labels(gt_data, thr=0.5):
+    return (gt_data >= thr).to(gt_data.dtype)
+
+
+def rotation_matrices(angles, height, width):
+    """Return the (B, 3, 3) matrices of counter-clockwise rotations
+    around the image center, as PIL.Image.rotate.
+
+    :param angles: the angles in degrees.
+    """
+    angles = torch.as_tensor(angles, dtype=torch.float64) * math.pi / 180.
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    cx, cy = width / 2., height / 2.
+    matrices = torch.zeros(len(angles), 3, 3, dtype=torch.float64)
+    matrices[:, 0, 0] = cos
+    matrices[:, 0, 1] = sin
+    matrices[:, 1, 0] = -sin
+    matrices[:, 1, 1] = cos
+    matrices[:, 0, 2] = cx - cos * cx - sin * cy
+    matrices[:, 1, 2] = cy + sin * cx - cos * cy
+    matrices[:, 2, 2] = 1.
+    return matrices
+
+
+def affine_matrices(angles, translations, scales, shears, height, width):
+    """Return the (B, 3, 3) matrices of the affine transformations used by
+    :class:`medicaltorch.transforms.RandomAffine` (rotation, scale and shear
+    around the image center followed by a translation).
+
+    :param angles: the angles in degrees.
+    :param translations: the (B, 2) translations in pixels.
+    :param scales: the scales.
+    :param shears: the shear angles in degrees.
+    """
+    angles = torch.as_tensor(angles, dtype=torch.float64) * math.pi / 180.
+    shears = torch.as_tensor(shears, dtype=torch.float64) * math.pi / 180.
+    scales = torch.as_tensor(scales, dtype=torch.float64)
+    translations = torch.as_tensor(translations, dtype=torch.float64)
+    cx, cy = width / 2., height / 2.
+
+    rss = torch.zeros(len(angles), 2, 2, dtype=torch.float64)
+    rss[:, 0, 0] = torch.cos(angles) * scales
+    rss[:, 0, 1] = -torch.sin(angles + shears) * scales
+    rss[:, 1, 0] = torch.sin(angles) * scales
+    rss[:, 1, 1] = torch.cos(angles + shears) * scales
+
+    center = torch.tensor([cx, cy], dtype=torch.float64)
+    matrices = torch.zeros(len(angles), 3, 3, dtype=torch.float64)
+    matrices[:, :2, :2] = rss
+    matrices[:, :2, 2] = center + translations - rss.matmul(center)
+    matrices[:, 2, 2] = 1.
+    return matrices
+
+
+class BatchTransform(MTTransform):
+    """Base class of the transformations working on collated batches,
+    where 'input' is a (B, C, H, W) tensor (or a list of them, one per
+    modality) and 'gt' a (B, G, H, W) tensor.
+
+    The per-sample parameters are drawn in one vectorized call from the
+    generator returned by :func:`medicaltorch.transforms.get_rng`.
+
+    :param labeled: if True, the geometric transformations are also
+                    applied to the ground truth.
+    """
+
+    def __init__(self, labeled=True):
+        self.labeled = labeled
+
+
+class BatchAffineTransform(BatchTransform):
+    """Base class of the geometric batch transformations, that are
+    applied with a single grid_sample per tensor. The forward matrices
+    of all the transformations are composed in batch['__affine'] to be
+    able to invert them later.
+    """
+
+    def get_matrices(self, batch, height, width):
+        """Return the (B, 3, 3) forward matrices and the output size."""
+        raise NotImplementedError("You need to implement the get_matrices() method.")
+
+    @staticmethod
+    def record(batch, matrices):
+        if '__affine' in batch:
+            matrices = matrices.matmul(batch['__affine'])
+        batch['__affine'] = matrices
+
+    def __call__(self, batch):
+        input_data, split_sizes = _as_tensor(batch['input'])
+        height, width = input_data.shape[-2:]
+        matrices, output_size = self.get_matrices(batch, height, width)
+
+        input_data = warp_affine(input_data, matrices, output_size)
+        batch['input'] = _restore(input_data, split_sizes)
+
+        if self.labeled:
+            gt_data = warp_affine(batch['gt'], matrices, output_size)
+            batch['gt'] = _threshold_labels(gt_data)
+
+        self.record(batch, matrices)
+        return batch
+
+
+class BatchCenterCrop2D(BatchAffineTransform):
+    """Make a centered crop of a specified size on a batch.
+
+    :param size: the (height, width) of the crop.
+    """
+
+    def __init__(self, size, labeled=True):
+        super().__init__(labeled)
+        self.size = size
+
+    def get_offsets(self, height, width):
+        th, tw = self.size
+        return int(round((height - th) / 2.)), int(round((width - tw) / 2.))
+
+    def get_matrices(self, batch, height, width):
+        fh, fw = self.get_offsets(height, width)
+        batch_size = _batch_size(batch['input'])
+        matrices = torch.eye(3, dtype=torch.float64).repeat(batch_size, 1, 1)
+        matrices[:, 0, 2] = -fw
+        matrices[:, 1, 2] = -fh
+        return matrices, self.size
+
+    def __call__(self, batch):
+        # A crop doesn't need any interpolation, slicing is enough
+        input_data, split_sizes = _as_tensor(batch['input'])
+        height, width = input_data.shape[-2:]
+        th, tw = self.size
+        fh, fw = self.get_offsets(height, width)
+        matrices, _ = self.get_matrices(batch, height, width)
+
+        batch['input'] = _restore(input_data[..., fh:fh + th, fw:fw + tw], split_sizes)
+        if self.labeled:
+            batch['gt'] = batch['gt'][..., fh:fh + th, fw:fw + tw]
+
+        self.record(batch, matrices)
+        return batch
+
+
+class BatchRandomRotation(BatchAffineTransform):
+    """Rotate each sample of a batch by its own random angle.
+
+    :param degrees: range of the rotation angles, a single number d
+                    means (-d, d).
+    """
+
+    def __init__(self, degrees, labeled=True):
+        super().__init__(labeled)
+        if isinstance(degrees, numbers.Number):
+            if degrees < 0:
+                raise ValueError("If degrees is a single number, it must be positive.")
+            self.degrees = (-degrees, degrees)
+        else:
+            if len(degrees) != 2:
+                raise ValueError("If degrees is a sequence, it must be of len 2.")
+            self.degrees = degrees
+
+    def get_matrices(self, batch, height, width):
+        batch_size = _batch_size(batch['input'])
+        angles = get_rng().uniform(self.degrees[0], self.degrees[1], batch_size)
+        return rotation_matrices(angles, height, width), (height, width)
+
+
+class BatchRandomAffine(BatchAffineTransform):
+    """Apply a random affine transformation to each sample of a batch,
+    with the same parameters as :class:`medicaltorch.transforms.RandomAffine`.
+    """
+
+    def __init__(self, degrees, translate=None, scale=None, shear=None,
+                 labeled=True):
+        super().__init__(labeled)
+        if isinstance(degrees, numbers.Number):
+            if degrees < 0:
+                raise ValueError("If degrees is a single number, it must be positive.")
+            self.degrees = (-degrees, degrees)
+        else:
+            assert isinstance(degrees, (tuple, list)) and len(degrees) == 2, \
+                "degrees should be a list or tuple and it must be of length 2."
+            self.degrees = degrees
+
+        self.translate = translate
+        self.scale = scale
+
+        if isinstance(shear, numbers.Number):
+            if shear < 0:
+                raise ValueError("If shear is a single number, it must be positive.")
+            self.shear = (-shear, shear)
+        else:
+            self.shear = shear
+
+    def get_matrices(self, batch, height, width):
+        batch_size = _batch_size(batch['input'])
+        rng = get_rng()
+        angles = rng.uniform(self.degrees[0], self.degrees[1], batch_size)
+
+        translations = np.zeros((batch_size, 2))
+        if self.translate is not None:
+            max_dx = self.translate[0] * width
+            max_dy = self.translate[1] * height
+            translations[:, 0] = np.round(rng.uniform(-max_dx, max_dx, batch_size))
+            translations[:, 1] = np.round(rng.uniform(-max_dy, max_dy, batch_size))
+
+        scales = np.ones(batch_size)
+        if self.scale is not None:
+            scales = rng.uniform(self.scale[0], self.scale[1], batch_size)
+
+        shears = np.zeros(batch_size)
+        if self.shear is not None:
+            shears = rng.uniform(self.shear[0], self.shear[1], batch_size)
+
+        matrices = affine_matrices(angles, translations, scales, shears, height, width)
+        return matrices, (height, width)
+
+
+class BatchRandomFlip(BatchAffineTransform):
+    """Flip each sample of a batch with probability p.
+
+    :param p: probability of flipping a sample, 1.0 flips all of them.
+    :param horizontal: if True, flip the width axis.
+    :param vertical: if True, flip the height axis.
+    """
+
+    def __init__(self, p=0.5, horizontal=True, vertical=False, labeled=True):
+        super().__init__(labeled)
+        self.p = p
+        self.horizontal = horizontal
+        self.vertical = vertical
+
+    def get_matrices(self, batch, height, width):
+        batch_size = _batch_size(batch['input'])
+        flipped = torch.from_numpy(get_rng().random(batch_size) < self.p)
+        matrices = torch.eye(3, dtype=torch.float64).repeat(batch_size, 1, 1)
+        if self.horizontal:
+            matrices[flipped, 0, 0] = -1.
+            matrices[flipped, 0, 2] = width
+        if self.vertical:
+            matrices[flipped, 1, 1] = -1.
+            matrices[flipped, 1, 2] = height
+        return matrices, (height, width)
+
+
+class BatchResample(BatchAffineTransform):
+    """Resample a batch to a new pixel spacing, using the zooms of the
+    input metadata. All the samples must be resampled to the same shape.
+
+    :param wspace: the new spacing of the width.
+    :param hspace: the new spacing of the height.
+    """
+
+    def __init__(self, wspace, hspace, labeled=True):
+        super().__init__(labeled)
+        self.wspace = wspace
+        self.hspace = hspace
+
+    def get_output_size(self, batch, height, width):
+        output_sizes = set()
+        # Collated metadata: one sequence per modality, one item per sample
+        for input_metadata in batch['input_metadata'][0]:
+            hzoom, wzoom = input_metadata["zooms"]
+            output_sizes.add((int(height * hzoom / self.hspace),
+                              int(width * wzoom / self.wspace)))
+        if len(output_sizes) != 1:
+            raise RuntimeError("All the samples of the batch must be resampled to the same shape.")
+        return output_sizes.pop()
+
+    def get_matrices(self, batch, height, width):
+        out_height, out_width = self.get_output_size(batch, height, width)
+        batch_size = _batch_size(batch['input'])
+        matrices = torch.eye(3, dtype=torch.float64).repeat(batch_size, 1, 1)
+        matrices[:, 0, 0] = out_width / float(width)
+        matrices[:, 1, 1] = out_height / float(height)
+        return matrices, (out_height, out_width)
+
+    def __call__(self, batch):
+        # A uniform scale is a plain interpolation of the whole batch
+        input_data, split_sizes = _as_tensor(batch['input'])
+        height, width = input_data.shape[-2:]
+        matrices, output_size = self.get_matrices(batch, height, width)
+
+        input_data = F.interpolate(input_data, size=output_size, mode='bilinear',
+                                   align_corners=False)
+        batch['input'] = _restore(input_data, split_sizes)
+        if self.labeled:
+            gt_data = F.interpolate(batch['gt'], size=output_size, mode='bilinear',
+                                    align_corners=False)
+            batch['gt'] = _threshold_labels(gt_data)
+
+        self.record(batch, matrices)
+        return batch
+
+
+def gaussian_kernels(sigmas, truncate=4.0):
+    """Return one normalized 1D gaussian kernel per sigma, zero-padded to
+    the size of the largest one, as a (N, K) float32 tensor."""
+    sigmas = torch.as_tensor(sigmas, dtype=torch.float32).clamp(min=1e-3)
+    radius = int(truncate * float(sigmas.max()) + 0.5)
+    positions = torch.arange(-radius, radius + 1, dtype=torch.float32)
+    kernels = torch.exp(-0.5 * (positions[None, :] / sigmas[:, None]) ** 2)
+    radii = torch.floor(truncate * sigmas + 0.5)
+    kernels[positions.abs()[None, :] > radii[:, None]] = 0.
+    return kernels / kernels.sum(dim=1, keepdim=True)
+
+
+def smooth_fields(fields, sigmas):
+    """Smooth each (H, W) field with its own separable gaussian filter, with
+    zero padding, in two grouped convolutions.
+
+    :param fields: the (N, H, W) tensor.
+    :param sigmas: the N sigmas.
+    """
+    num_fields = fields.size(0)
+    kernels = gaussian_kernels(sigmas)
+    radius = kernels.size(1) // 2
+    fields = fields.unsqueeze(0)
+    fields = F.conv2d(fields, kernels.view(num_fields, 1, -1, 1),
+                      padding=(radius, 0), groups=num_fields)
+    fields = F.conv2d(fields, kernels.view(num_fields, 1, 1, -1),
+                      padding=(0, radius), groups=num_fields)
+    return fields.squeeze(0)
+
+
+class BatchElasticTransform(BatchTransform):
+    """Elastic deformation of a batch, each sample with its own random
+    displacement field, shared by all its modalities and labels.
+
+    :param alpha_range: range of the displacement amplitude.
+    :param sigma_range: range of the displacement smoothness.
+    :param p: probability of deforming a sample.
+    """
+
+    def __init__(self, alpha_range, sigma_range, p=0.5, labeled=True):
+        super().__init__(labeled)
+        self.alpha_range = alpha_range
+        self.sigma_range = sigma_range
+        self.p = p
+
+    def get_params(self, batch_size):
+        rng = get_rng()
+        selected = rng.random(batch_size) < self.p
+        alphas = rng.uniform(self.alpha_range[0], self.alpha_range[1], batch_size)
+        sigmas = rng.uniform(self.sigma_range[0], self.sigma_range[1], batch_size)
+        return np.flatnonzero(selected), alphas[selected], sigmas[selected]
+
+    def get_grids(self, indexes, alphas, sigmas, height, width):
+        """Return the sampling grids of grid_sample for the selected samples."""
+        num_samples = len(indexes)
+        noise = get_rng().random((2 * num_samples, height, width)).astype(np.float32)
+        noise = torch.from_numpy(noise) * 2 - 1
+        fields = smooth_fields(noise, np.repeat(sigmas, 2))
+        fields = fields.view(num_samples, 2, height, width)
+        fields = fields * torch.as_tensor(alphas, dtype=torch.float32).view(-1, 1, 1, 1)
+
+        # Displacements are (row, col) in pixels, the grid is (x, y) in [-1, 1]
+        identity = torch.eye(2, 3).unsqueeze(0).repeat(num_samples, 1, 1)
+        grids = F.affine_grid(identity, (num_samples, 1, height, width), align_corners=False)
+        grids[..., 0] += fields[:, 1] * (2. / width)
+        grids[..., 1] += fields[:, 0] * (2. / height)
+        return grids
+
+    def __call__(self, batch):
+        input_data, split_sizes = _as_tensor(batch['input'])
+        height, width = input_data.shape[-2:]
+        indexes, alphas, sigmas = self.get_params(input_data.size(0))
+        if not len(indexes):
+            return batch
+
+        grids = self.get_grids(indexes, alphas, sigmas, height, width)
+        indexes = torch.from_numpy(indexes)
+
+        input_data = input_data.clone()
+        input_data[indexes] = F.grid_sample(input_data[indexes], grids, mode='bilinear',
+                                            padding_mode='zeros', align_corners=False)
+        batch['input'] = _restore(input_data, split_sizes)
+
+        if self.labeled:
+            gt_data = batch['gt'].clone()
+            gt_data[indexes] = _threshold_labels(F.grid_sample(gt_data[indexes], grids, mode='bilinear',
+                                                               padding_mode='zeros', align_corners=False))
+            batch['gt'] = gt_data
+        return batch
+
+
+class BatchAdditiveGaussianNoise(BatchTransform):
+    """Add gaussian noise to a batch, in place. As in
+    :class:`medicaltorch.transforms.AdditiveGaussianNoise`, the noise of
+    a sample is shared by all its modalities.
+    """
+
+    def __init__(self, mean=0.0, std=0.01):
+        super().__init__(labeled=False)
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, batch):
+        input_data, split_sizes = _as_tensor(batch['input'])
+        batch_size, _, height, width = input_data.shape
+        noise = standard_normal((batch_size, 1, height, width))
+        noise *= self.std
+        noise += self.mean
+        input_data.add_(torch.from_numpy(noise))
+        batch['input'] = _restore(input_data, split_sizes)
+        return batch
+
+
+class BatchRandomTensorChannelShift(BatchTransform):
+    """Shift the intensities of each sample of a batch by a random value,
+    in place, shared by all its modalities.
+
+    :param shift_range: the range of the shift.
+    """
+
+    def __init__(self, shift_range):
+        super().__init__(labeled=False)
+        self.shift_range = shift_range
+
+    def __call__(self, batch):
+        input_data, split_sizes = _as_tensor(batch['input'])
+        shifts = get_rng().uniform(self.shift_range[0], self.shift_range[1],
+                                   input_data.size(0))
+        input_data.add_(torch.from_numpy(shifts.astype(np.float32)).view(-1, 1, 1, 1))
+        batch['input'] = _restore(input_data, split_sizes)
+        return batch
+
+
+class BatchIntensityAugmentation(IntensityAugmentation):
+    """Batch version of :class:`medicaltorch.transforms.IntensityAugmentation`,
+    applied on a (B, C, H, W) tensor (or a list of them, one per modality),
+    in place when copy is False. The parameters of all the samples and
+    channels are drawn in one vectorized call and the bias fields are
+    upsampled with a single bicubic interpolation.
+    """
+
+    def __call__(self, batch):
+        input_data, split_sizes = _as_tensor(batch['input'])
+        if self.copy and split_sizes is None:
+            input_data = input_data.clone()
+        batch_size, n_channels, height, width = input_data.shape
+        params = self.get_params(batch_size, n_channels)
+
+        def as_tensor(values):
+            return torch.from_numpy(values).to(input_data.device).view(
+                values.shape[0], values.shape[1], 1, 1)
+
+        if params['bias'] is not None:
+            bias = torch.from_numpy(params['bias']).to(input_data.device)
+            field = F.interpolate(bias, size=(height, width), mode='bicubic',
+                                  align_corners=True)
+            input_data.mul_(field.exp_())
+
+        if params['gamma'] is not None:
+            flat = input_data.reshape(batch_size, n_channels, -1)
+            low = flat.min(-1)[0].view(batch_size, n_channels, 1, 1)
+            span = (flat.max(-1)[0].view(batch_size, n_channels, 1, 1) - low).clamp(min=1e-8)
+            input_data.sub_(low).div_(span).clamp_(min=0).pow_(as_tensor(params['gamma']))
+            input_data.mul_(span).add_(low)
+
+        if params['scale'] is not None:
+            input_data.mul_(as_tensor(params['scale']))
+        if params['shift'] is not None:
+            input_data.add_(as_tensor(params['shift']))
+
+        if params['noise_std'] is not None:
+            noise_std = params['noise_std']
+            noise = torch.from_numpy(standard_normal(noise_std.shape + (height, width)))
+            input_data.add_(noise.to(input_data.device).mul_(as_tensor(noise_std)))
+
+        batch['input'] = _restore(input_data, split_sizes)
+        return batch
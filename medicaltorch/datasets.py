@@ -1,6 +1,11 @@
 import os
 import re
+import copy
+import json
+import hashlib
+import pickle
 import collections
+from multiprocessing import Pool
 
 from medicaltorch import transforms as mt_transforms
 
@@ -8,7 +13,7 @@ from tqdm import tqdm
 import numpy as np
 import nibabel as nib
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 import torch
 from torch._six import string_classes, int_classes
 
@@ -56,6 +61,452 @@ class BatchSplit(object):
         raise StopIteration
 
 
+def roi_bounding_box(mask):
+    """Return the bounding box and the centroid of the non-zero region
+    of a 2D mask.
+
+    :param mask: the 2D mask (numpy array).
+    :returns: tuple (bbox, center) where bbox is (row_min, row_max,
+              col_min, col_max), inclusive, and center is (row, col).
+              Both are None for an empty mask.
+    """
+    rows, cols = np.nonzero(mask)
+    if not len(rows):
+        return None, None
+    bbox = (int(rows.min()), int(rows.max()), int(cols.min()), int(cols.max()))
+    center = (float(rows.mean()), float(cols.mean()))
+    return bbox, center
+
+
+def rle_encode(mask):
+    """Run-length encode a binary mask in row-major order.
+
+    :param mask: the mask (numpy array), non-zero values are foreground.
+    :returns: int32 array of shape (N, 2) with (start, length) runs.
+    """
+    flat = np.asarray(mask).ravel() > 0
+    padded = np.concatenate([[False], flat, [False]])
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    starts, ends = changes[::2], changes[1::2]
+    return np.stack([starts, ends - starts], axis=1).astype(np.int32)
+
+
+def rle_decode(runs, shape, value=1, dtype=np.float32):
+    """Decode a mask encoded by :func:`rle_encode`.
+
+    :param runs: the (start, length) runs.
+    :param shape: the shape of the decoded mask.
+    :param value: the value of the foreground.
+    :param dtype: the dtype of the decoded mask.
+    """
+    flat = np.zeros(int(np.prod(shape)), dtype=dtype)
+    for start, length in runs:
+        flat[start:start + length] = value
+    return flat.reshape(shape)
+
+
+def index_roi_slice(roi_pair_slice, rle=False):
+    """Precompute the bounding box and the centroid of each ROI slice and
+    store them in the ROI metadata, so that the ROI cropping doesn't need
+    a full-slice reduction per sample.
+
+    :param roi_pair_slice: the ROI slice dict returned by
+                           :meth:`SegmentationPair2D.get_pair_slice`.
+    :param rle: if True, the ROI slices are replaced by their run-length
+                encoding.
+    """
+    if roi_pair_slice['gt'] is None:
+        return
+
+    for idx, roi_slice in enumerate(roi_pair_slice['gt']):
+        roi_metadata = roi_pair_slice['gt_metadata'][idx]
+        bbox, center = roi_bounding_box(roi_slice)
+        roi_metadata['__roi_bbox'] = bbox
+        roi_metadata['__roi_center'] = center
+        roi_metadata['__roi_shape'] = roi_slice.shape
+
+        if rle:
+            roi_pair_slice['gt'][idx] = rle_encode(roi_slice)
+            roi_metadata['__roi_rle'] = True
+
+
+def index_foreground_slice(seg_pair_slice):
+    """Precompute the (row, col) coordinates of the foreground pixels of
+    the ground truth slices, all the classes merged, and store them as an
+    int16 array in the first ground truth metadata, so that
+    :class:`medicaltorch.transforms.RandomCrop2D` can sample the crop
+    centers without scanning the slices.
+
+    :param seg_pair_slice: the slice dict returned by
+                           :meth:`SegmentationPair2D.get_pair_slice`.
+    """
+    gt_slices = [gt_slice for gt_slice in seg_pair_slice['gt'] or []
+                 if gt_slice is not None]
+    if not gt_slices:
+        return
+
+    foreground = np.any([gt_slice > 0 for gt_slice in gt_slices], axis=0)
+    gt_metadata = seg_pair_slice['gt_metadata'][0]
+    gt_metadata['__fg_coords'] = np.argwhere(foreground).astype(np.int16)
+    gt_metadata['__fg_shape'] = foreground.shape
+
+
+def _window_slices(shape, window):
+    """Return the (source, destination) slices copying the part of a 2D
+    window inside an array of the given shape."""
+    row_start, row_stop, col_start, col_stop = window
+    rows = slice(max(row_start, 0), max(min(row_stop, shape[0]), row_start, 0))
+    cols = slice(max(col_start, 0), max(min(col_stop, shape[1]), col_start, 0))
+    dst = (slice(rows.start - row_start, rows.stop - row_start),
+           slice(cols.start - col_start, cols.stop - col_start))
+    return (rows, cols), dst
+
+
+def read_slice(data_object, slice_index, slice_axis=2, window=None):
+    """Read a slice of a volume as a float32 array, or only a window of it.
+
+    :param data_object: the volume, a numpy array or a nibabel array proxy
+                        (only the window is then read from the file).
+    :param slice_index: the slice number.
+    :param slice_axis: axis to make the slicing.
+    :param window: None or the (row_start, row_stop, col_start, col_stop)
+                   window in slice coordinates, the parts outside of the
+                   slice are zero-padded.
+    """
+    index = [slice(None)] * 3
+    index[slice_axis] = slice_index
+    if window is None:
+        return np.asarray(data_object[tuple(index)], dtype=np.float32)
+
+    in_plane = [axis for axis in range(3) if axis != slice_axis]
+    shape = [data_object.shape[axis] for axis in in_plane]
+    src, dst = _window_slices(shape, window)
+    index[in_plane[0]], index[in_plane[1]] = src
+
+    output = np.zeros((window[1] - window[0], window[3] - window[2]), dtype=np.float32)
+    output[dst] = data_object[tuple(index)]
+    return output
+
+
+def crop_window(data, window):
+    """Crop a window of a 2D array, zero-padded outside of the array.
+
+    :param data: the 2D array.
+    :param window: the (row_start, row_stop, col_start, col_stop) window.
+    """
+    src, dst = _window_slices(data.shape, window)
+    output = np.zeros((window[1] - window[0], window[3] - window[2]), dtype=data.dtype)
+    output[dst] = data[src]
+    return output
+
+
+class MarginCrop2D(mt_transforms.CenterCrop2D):
+    """Centered crop removing the margin kept around a pushed down crop
+    window, see :func:`push_down_crop`. The '__centercrop' parameters are
+    recorded relative to the full slice from the '__crop_window' metadata,
+    so that the undo of the pushed down crop restores the full slice.
+    """
+
+    def __call__(self, sample):
+        sample = super().__call__(sample)
+        metadata_list = list(sample['input_metadata'])
+        if self.labeled:
+            metadata_list += sample['gt_metadata'] or []
+        for metadata in metadata_list:
+            if '__crop_window' in metadata:
+                top, left, w, h = metadata['__crop_window']
+                fh, fw, _, _ = metadata['__centercrop']
+                metadata['__centercrop'] = (top + fh, left + fw, w, h)
+        return sample
+
+
+def push_down_crop(transform, margin=0):
+    """Split the leading :class:`medicaltorch.transforms.CenterCrop2D` or
+    :class:`medicaltorch.transforms.ROICrop2D` of a composed transform, so
+    that the dataset can read only the cropped window of the slices.
+
+    :param transform: the composed transform (with a transforms list).
+    :param margin: margin added around the window. When it is positive,
+                   a :class:`MarginCrop2D` removing the margin is inserted
+                   before the ToTensor transform (or at the end).
+    :returns: tuple (leading crop or None, remaining transform).
+    """
+    transform_list = list(getattr(transform, 'transforms', []))
+    crop_types = (mt_transforms.CenterCrop2D, mt_transforms.ROICrop2D)
+    if not transform_list or not isinstance(transform_list[0], crop_types):
+        return None, transform
+
+    crop, remaining = transform_list[0], transform_list[1:]
+    if margin > 0:
+        position = next((idx for idx, t in enumerate(remaining)
+                         if isinstance(t, mt_transforms.ToTensor)), len(remaining))
+        remaining.insert(position, MarginCrop2D(crop.size, crop.labeled))
+
+    transform = copy.copy(transform)
+    transform.transforms = remaining
+    return crop, transform
+
+
+def build_label_map(gt_slices):
+    """Merge the binary masks of the classes into a single uint8 label map
+    (0 for the background, i + 1 for the class i). Where the masks overlap,
+    the last class wins.
+
+    :param gt_slices: the list of class masks, None for missing masks.
+    """
+    shape = next(gt_slice.shape for gt_slice in gt_slices if gt_slice is not None)
+    label_map = np.zeros(shape, dtype=np.uint8)
+    for idx, gt_slice in enumerate(gt_slices):
+        if gt_slice is not None:
+            label_map[gt_slice >= 0.5] = idx + 1
+    return label_map
+
+
+def build_slice_sample(seg_pair_slice, roi_pair_slice, label_map=False):
+    """Build the sample dict (input, ground truth, roi and metadatas) of
+    a slice, the images are returned as PIL images.
+
+    :param seg_pair_slice: the slice dict of the segmentation pair.
+    :param roi_pair_slice: the slice dict of the ROI pair.
+    :param label_map: if True, the classes are merged in a single label map
+                      image, see :func:`build_label_map`.
+    """
+    input_tensors = []
+    input_metadata = []
+    data_dict = {}
+
+    # Looping over all modalities (one or more)
+    for idx, input_slice in enumerate(seg_pair_slice["input"]):
+        # Consistency with torchvision, returning PIL Image
+        # Using the "Float mode" of PIL, the only mode
+        # supporting unbounded float32 values
+
+        input_img = Image.fromarray(input_slice, mode='F')
+        input_tensors.append(input_img)
+
+    gt_img = []
+    gt_metadata = seg_pair_slice['gt_metadata']
+    if label_map and any(gt_slice is not None for gt_slice in seg_pair_slice["gt"]):
+        gt_img.append(Image.fromarray(build_label_map(seg_pair_slice["gt"]), mode='L'))
+        gt_metadata = [gt_metadata[0]]
+        gt_metadata[0]['__label_map'] = len(seg_pair_slice["gt"])
+    else:
+        for gt_slice in seg_pair_slice["gt"]:
+            # Handle unlabeled data
+            if gt_slice is None:
+                gt_img.append(None)
+            else:
+                gt_scaled = (gt_slice * 255).astype(np.uint8)
+                gt_img.append(Image.fromarray(gt_scaled, mode='L'))
+
+    if not len(roi_pair_slice['gt']):
+        roi_img = None
+        roi_pair_slice['gt_metadata'] = None
+    else:
+        roi_img = []
+        
+    for idx, roi_slice in enumerate(roi_pair_slice["gt"]):
+        roi_metadata = roi_pair_slice['gt_metadata'][idx]
+        # Handle data with no ROI provided
+        if roi_pair_slice["gt"] is None:
+            roi_img.append(None)
+        elif '__roi_rle' in roi_metadata:
+            roi_scaled = rle_decode(roi_slice, roi_metadata['__roi_shape'],
+                                    value=255, dtype=np.uint8)
+            roi_img.append(Image.fromarray(roi_scaled, mode='L'))
+        else:
+            roi_scaled = (roi_slice * 255).astype(np.uint8)
+            roi_img.append(Image.fromarray(roi_scaled, mode='L'))
+
+    data_dict = {
+        'input': input_tensors,
+        'gt': gt_img,
+        'roi': roi_img,
+        'input_metadata': seg_pair_slice['input_metadata'],
+        'gt_metadata': gt_metadata,
+        'roi_metadata': roi_pair_slice['gt_metadata']
+    }
+
+    """"
+    Moving that part in ToTensor() transformation
+    input_tensors.append(data_dict['input'])
+    input_metadata.append(data_dict['input_metadata'])
+    
+    if len(input_tensors) > 1:
+        data_dict['input'] = torch.squeeze(torch.stack(input_tensors, dim=0))
+        data_dict['input_metadata'] = input_metadata
+    """
+
+    return data_dict
+
+
+def apply_sample_transform(dataset, data_dict, index):
+    """Apply the dataset transformation to a sample. When the dataset has a
+    seed, the random transforms draw from the per-sample generator derived
+    from (seed, epoch, index).
+
+    :param dataset: the dataset, with transform, seed and epoch attributes.
+    :param data_dict: the sample.
+    :param index: the index of the sample.
+    """
+    if dataset.transform is None:
+        return data_dict
+
+    if dataset.seed is None:
+        return dataset.transform(data_dict)
+
+    rng = mt_transforms.sample_rng(dataset.seed, dataset.epoch, index)
+    with mt_transforms.sample_rng_context(rng):
+        return dataset.transform(data_dict)
+
+
+class VolumeCache(object):
+    """On-disk cache of preprocessed volumes. The entries are keyed by the
+    sha1 of the source file (path, size and modification time) and of the
+    parameters of the stages, so changing a parameter or the source file
+    invalidates them.
+
+    :param cache_dir: the cache directory.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(filename, params):
+        stat = os.stat(filename)
+        content = json.dumps({
+            'filename': os.path.abspath(filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'params': params,
+        }, sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """Return the cached volume (memory mapped) or None."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, volume):
+        # Write to a temporary file first so that readers never see a
+        # partial entry
+        tmp_path = self.path(key) + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as fhandle:
+            np.save(fhandle, volume)
+        os.replace(tmp_path, self.path(key))
+
+
+def volume_stages_params(stages, canonical=False):
+    """Return the parameters identifying the output of volume stages."""
+    return {
+        'canonical': canonical,
+        'stages': [[type(stage).__name__, stage.volume_params()] for stage in stages],
+    }
+
+
+def _preprocess_volume(args):
+    filename, stages, canonical, cache_dir, key = args
+    img = nib.load(filename)
+    if canonical:
+        img = nib.as_closest_canonical(img)
+    volume = img.get_fdata(dtype=np.float32)
+    for stage in stages:
+        volume = stage.volume_transform(volume)
+    volume = np.asarray(volume, dtype=np.float32)
+
+    if cache_dir is None:
+        return volume
+    VolumeCache(cache_dir).put(key, volume)
+    return None
+
+
+def preprocess_volumes(filenames, stages, canonical=False, cache_dir=None,
+                       num_workers=0, verbose=False):
+    """Apply volume-level stages (e.g. :class:`medicaltorch.transforms.Clahe`
+    or :class:`medicaltorch.transforms.HistogramClipping`) once per volume,
+    with a process pool.
+
+    :param filenames: the volume filenames.
+    :param stages: the stages, implementing volume_transform() and
+                   volume_params().
+    :param canonical: canonical reordering of the volume axes.
+    :param cache_dir: if not None, the volumes are cached in this directory
+                      (see :class:`VolumeCache`) and only the missing ones
+                      are computed.
+    :param num_workers: number of processes, 0 to run in the main process.
+    :param verbose: if True, it will show a progress bar.
+    :returns: the list of preprocessed volumes.
+    """
+    params = volume_stages_params(stages, canonical)
+    cache = VolumeCache(cache_dir) if cache_dir is not None else None
+
+    volumes = [None] * len(filenames)
+    keys = [None] * len(filenames)
+    tasks, task_indexes = [], []
+    for idx, filename in enumerate(filenames):
+        if cache is not None:
+            keys[idx] = cache.key(filename, params)
+            volumes[idx] = cache.get(keys[idx])
+        if volumes[idx] is None:
+            tasks.append((filename, stages, canonical, cache_dir, keys[idx]))
+            task_indexes.append(idx)
+
+    if num_workers > 0 and len(tasks) > 1:
+        pool = Pool(min(num_workers, len(tasks)))
+        results = pool.imap(_preprocess_volume, tasks)
+    else:
+        pool = None
+        results = map(_preprocess_volume, tasks)
+
+    try:
+        for idx, volume in zip(task_indexes, tqdm(results, total=len(tasks),
+                                                  desc="Volume preprocessing",
+                                                  disable=not verbose)):
+            volumes[idx] = volume if cache is None else cache.get(keys[idx])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return volumes
+
+
+def volume_stats(data_object, chunk_size=16):
+    """Return the (mean, std) of a volume in a single float64 pass over
+    chunks of slices, merged with the parallel variance formula, without
+    loading the whole volume in float64.
+
+    :param data_object: the volume, a numpy array or a nibabel dataobj.
+    :param chunk_size: number of slices (along the last axis) per chunk.
+    :returns: tuple (mean, unbiased standard deviation).
+    """
+    count, mean, m2 = 0, 0.0, 0.0
+    for start in range(0, data_object.shape[-1], chunk_size):
+        chunk = np.asarray(data_object[..., start:start + chunk_size],
+                           dtype=np.float64)
+        chunk_count = chunk.size
+        if chunk_count == 0:
+            continue
+        chunk_mean = chunk.mean()
+        chunk_m2 = np.square(chunk - chunk_mean).sum()
+
+        delta = chunk_mean - mean
+        total = count + chunk_count
+        mean += delta * chunk_count / total
+        m2 += chunk_m2 + delta * delta * count * chunk_count / total
+        count = total
+
+    std = np.sqrt(m2 / (count - 1)) if count > 1 else 0.0
+    return float(mean), float(std)
+
+
 class SegmentationPair2D(object):
     """This class is used to build 2D segmentation datasets. It represents
     a pair of of two data volumes (the input data and the ground truth data).
@@ -76,6 +527,8 @@ class SegmentationPair2D(object):
         self.metadata = metadata
         self.canonical = canonical
         self.cache = cache
+        self.input_data = None
+        self.volume_stats = None
 
         # list of the images
         self.input_handle = []
@@ -143,14 +596,38 @@ class SegmentationPair2D(object):
 
         return input_shape[0], gt_shape[0] if len(gt_shape) else None
 
+    def set_input_data(self, input_data):
+        """Replace the input volumes read from the files by preprocessed
+        ones, in the same (canonical or not) orientation.
+
+        :param input_data: the list of input volumes, one per modality.
+        """
+        self.input_data = list(input_data)
+
+    def compute_volume_stats(self):
+        """Compute the (mean, std) of each input volume once, they are
+        then recorded as '__volume_stats' in the input metadata of the
+        slices, see :class:`medicaltorch.transforms.NormalizeInstance`."""
+        if self.input_data is not None:
+            input_dataobj = self.input_data
+        elif self.cache:
+            input_dataobj, _ = self.get_pair_data()
+        else:
+            input_dataobj = [handle.dataobj for handle in self.input_handle]
+        self.volume_stats = [volume_stats(data_object) for data_object in input_dataobj]
+        return self.volume_stats
+
     def get_pair_data(self):
         """Return the tuble (input, ground truth) with the data content in
         numpy array."""
         cache_mode = 'fill' if self.cache else 'unchanged'
 
-        input_data = []
-        for handle in self.input_handle:
-            input_data.append(handle.get_fdata(cache_mode, dtype=np.float32))
+        if self.input_data is not None:
+            input_data = list(self.input_data)
+        else:
+            input_data = []
+            for handle in self.input_handle:
+                input_data.append(handle.get_fdata(cache_mode, dtype=np.float32))
 
         gt_data = []
         # Handle unlabeled data
@@ -164,17 +641,25 @@ class SegmentationPair2D(object):
 
         return input_data, gt_data
 
-    def get_pair_slice(self, slice_index, slice_axis=2):
+    def get_pair_slice(self, slice_index, slice_axis=2, window=None, window_gt=True):
         """Return the specified slice from (input, ground truth).
 
         :param slice_index: the slice number.
         :param slice_axis: axis to make the slicing.
+        :param window: None or the (row_start, row_stop, col_start,
+                       col_stop) window of the slice to read, see
+                       :func:`read_slice`.
+        :param window_gt: if False, the window is only read from the input
+                          slices, the ground truth slices are read whole.
         """
         if self.cache:
             input_dataobj, gt_dataobj = self.get_pair_data()
         else:
             # use dataobj to avoid caching
-            input_dataobj = [handle.dataobj for handle in self.input_handle]
+            if self.input_data is not None:
+                input_dataobj = self.input_data
+            else:
+                input_dataobj = [handle.dataobj for handle in self.input_handle]
 
             if self.gt_handle is None:
                 gt_dataobj = None
@@ -187,15 +672,7 @@ class SegmentationPair2D(object):
         input_slices = []
         # Loop over modalities
         for data_object in input_dataobj:
-            if slice_axis == 2:
-                input_slices.append(np.asarray(data_object[..., slice_index],
-                                              dtype=np.float32))
-            elif slice_axis == 1:
-                input_slices.append(np.asarray(data_object[:, slice_index, ...],
-                                              dtype=np.float32))
-            elif slice_axis == 0:
-                input_slices.append(np.asarray(data_object[slice_index, ...],
-                                              dtype=np.float32))
+            input_slices.append(read_slice(data_object, slice_index, slice_axis, window))
 
         # Handle the case for unlabeled data
         gt_meta_dict = None
@@ -204,15 +681,8 @@ class SegmentationPair2D(object):
         else:
             gt_slices = []
             for gt_obj in gt_dataobj:
-                if slice_axis == 2:
-                    gt_slices.append(np.asarray(gt_obj[..., slice_index],
-                                          dtype=np.float32))
-                elif slice_axis == 1:
-                    gt_slices.append(np.asarray(gt_obj[:, slice_index, ...],
-                                          dtype=np.float32))
-                elif slice_axis == 0:
-                    gt_slices.append(np.asarray(gt_obj[slice_index, ...],
-                                          dtype=np.float32))
+                gt_slices.append(read_slice(gt_obj, slice_index, slice_axis,
+                                            window if window_gt else None))
 
             gt_meta_dict = []
             for gt in self.gt_handle:
@@ -227,11 +697,13 @@ class SegmentationPair2D(object):
                     }))
 
         input_meta_dict = []
-        for handle in self.input_handle:
+        for idx, handle in enumerate(self.input_handle):
             input_meta_dict.append(SampleMetadata({
                 "zooms": handle.header.get_zooms()[:2],
                 "data_shape": handle.header.get_data_shape()[:2],
             }))
+            if self.volume_stats is not None:
+                input_meta_dict[idx]['__volume_stats'] = self.volume_stats[idx]
 
         dreturn = {
             "input": input_slices,
@@ -258,10 +730,51 @@ class MRI2DSegmentationDataset(Dataset):
     :param slice_axis: axis to make the slicing (default axial).
     :param cache: if the data should be cached in memory or not.
     :param transform: transformations to apply.
+    :param roi_rle: if True, the ROI slices are kept run-length encoded
+                    in memory and decoded on access.
+    :param seed: if not None, the random transforms of each sample draw from
+                 a generator derived from (seed, epoch, index), see
+                 :meth:`set_epoch`.
+    :param label_map: if True, the classes of the ground truth are carried
+                      as a single label map image, so that the geometric
+                      transforms warp it once whatever the number of
+                      classes. :class:`medicaltorch.transforms.ToTensor`
+                      expands it back to one channel per class.
+    :param crop_pushdown: if True and the transform starts with a
+                          :class:`medicaltorch.transforms.CenterCrop2D` or
+                          :class:`medicaltorch.transforms.ROICrop2D`, only
+                          the cropped window of each slice is read and
+                          converted, the crop parameters are recorded in
+                          the metadata as the crop would do. The slice
+                          filter then sees the cropped slices.
+    :param crop_margin: margin in pixels kept around the pushed down crop
+                        window for the augmentations following the crop;
+                        the margin is removed by a centered crop before
+                        the ToTensor transform.
+    :param volume_transform: list of volume-level stages applied once per
+                             input volume before slicing, e.g.
+                             :class:`medicaltorch.transforms.Clahe` and
+                             :class:`medicaltorch.transforms.HistogramClipping`.
+    :param volume_cache_dir: if not None, the outputs of the volume stages
+                             are cached in this directory, see
+                             :class:`VolumeCache`.
+    :param num_workers: number of processes running the volume stages.
+    :param volume_stats: if True, the mean and standard deviation of each
+                         input volume are computed once at load time for
+                         :class:`medicaltorch.transforms.NormalizeInstance`
+                         with per_volume=True.
+    :param foreground_index: if True, the coordinates of the foreground
+                             pixels of each slice are indexed for
+                             :class:`medicaltorch.transforms.RandomCrop2D`,
+                             see :func:`index_foreground_slice`.
     """
 
     def __init__(self, filename_pairs, slice_axis=2, cache=True,
-                 transform=None, slice_filter_fn=None, canonical=False):
+                 transform=None, slice_filter_fn=None, canonical=False,
+                 roi_rle=False, seed=None, label_map=False,
+                 crop_pushdown=False, crop_margin=0, volume_transform=None,
+                 volume_cache_dir=None, num_workers=0, volume_stats=False,
+                 foreground_index=False):
 
         self.indexes = []
         self.filename_pairs = filename_pairs
@@ -270,30 +783,134 @@ class MRI2DSegmentationDataset(Dataset):
         self.slice_axis = slice_axis
         self.slice_filter_fn = slice_filter_fn
         self.canonical = canonical
+        self.roi_rle = roi_rle
+        self.seed = seed
+        self.label_map = label_map
+        self.crop_margin = crop_margin
+        self.crop = None
+        if crop_pushdown:
+            self.crop, self.transform = push_down_crop(transform, crop_margin)
+        self.volume_transform = volume_transform
+        self.volume_cache_dir = volume_cache_dir
+        self.num_workers = num_workers
+        self.volume_stats = volume_stats
+        self.foreground_index = foreground_index
+        self.epoch = 0
         self.n_contrasts = len(self.filename_pairs[0][0])
 
         self._load_filenames()
 
+    def _preprocess_inputs(self):
+        """Run the volume stages on all the input volumes at once, return
+        one list of volumes per filename pair."""
+        filenames = [filename for input_filenames, _, _, _ in self.filename_pairs
+                     for filename in input_filenames]
+        volumes = preprocess_volumes(filenames, self.volume_transform,
+                                     canonical=self.canonical,
+                                     cache_dir=self.volume_cache_dir,
+                                     num_workers=self.num_workers)
+        pair_volumes, start = [], 0
+        for input_filenames, _, _, _ in self.filename_pairs:
+            pair_volumes.append(volumes[start:start + len(input_filenames)])
+            start += len(input_filenames)
+        return pair_volumes
+
+    def _read_roi_slices(self, roi_pair, slice_index):
+        """Read the whole ROI slices of a slice, without the input slices."""
+        roi_slices = []
+        for handle in roi_pair.gt_handle:
+            if handle is not None:
+                if roi_pair.cache:
+                    data_object = handle.get_fdata('fill', dtype=np.float32)
+                else:
+                    data_object = handle.dataobj
+                roi_slices.append(read_slice(data_object, slice_index, self.slice_axis))
+        return roi_slices
+
+    def _crop_window(self, slice_shape, roi_slices):
+        """Return the (top, left) corner of the pushed down crop and the
+        window to read, margin included."""
+        h, w = slice_shape
+        th, tw = self.crop.size
+        if isinstance(self.crop, mt_transforms.ROICrop2D):
+            center = None
+            if roi_slices:
+                _, center = roi_bounding_box(roi_slices[0])
+            if center is None:
+                # Empty ROI, fallback to a centered crop
+                center = (h / 2., w / 2.)
+            fh = int(round(center[0])) - int(round(th / 2.))
+            fw = int(round(center[1])) - int(round(tw / 2.))
+        else:
+            fh = int(round((h - th) / 2.))
+            fw = int(round((w - tw) / 2.))
+
+        margin = self.crop_margin
+        window = (fh - margin, fh + th + margin, fw - margin, fw + tw + margin)
+        return (fh, fw), window
+
+    def _push_down(self, seg_pair, roi_pair, slice_index, slice_shape):
+        """Read the crop window of a slice and record the crop parameters."""
+        roi_slices = None
+        if isinstance(self.crop, mt_transforms.ROICrop2D):
+            roi_slices = self._read_roi_slices(roi_pair, slice_index)
+        (fh, fw), window = self._crop_window(slice_shape, roi_slices)
+
+        roi_pair_slice = roi_pair.get_pair_slice(slice_index, self.slice_axis, window)
+        seg_pair_slice = seg_pair.get_pair_slice(slice_index, self.slice_axis, window,
+                                                 window_gt=self.crop.labeled)
+
+        h, w = slice_shape
+        metadata_list = list(seg_pair_slice['input_metadata'])
+        if self.crop.labeled:
+            metadata_list += seg_pair_slice['gt_metadata'] or []
+        for metadata in metadata_list:
+            metadata['__centercrop'] = (fh, fw, w, h)
+            if self.crop_margin > 0:
+                # Consumed by the MarginCrop2D removing the margin
+                metadata['__crop_window'] = (window[0], window[2], w, h)
+        return seg_pair_slice, roi_pair_slice
+
     def _load_filenames(self):
-        for input_filenames, gt_filenames, roi_filename, metadata in self.filename_pairs:
+        pair_volumes = None
+        if self.volume_transform:
+            pair_volumes = self._preprocess_inputs()
+
+        for pair_idx, filename_pair in enumerate(self.filename_pairs):
+            input_filenames, gt_filenames, roi_filename, metadata = filename_pair
             roi_pair = SegmentationPair2D(input_filenames, roi_filename, metadata=metadata,
                                           cache=self.cache, canonical=self.canonical)
 
             seg_pair = SegmentationPair2D(input_filenames, gt_filenames, metadata=metadata,
                                           cache=self.cache, canonical=self.canonical)
+            if pair_volumes is not None:
+                roi_pair.set_input_data(pair_volumes[pair_idx])
+                seg_pair.set_input_data(pair_volumes[pair_idx])
+            if self.volume_stats:
+                seg_pair.compute_volume_stats()
 
             input_data_shape, _ = seg_pair.get_pair_shapes()
+            slice_shape = [size for axis, size in enumerate(input_data_shape)
+                           if axis != self.slice_axis]
 
             for idx_pair_slice in range(input_data_shape[self.slice_axis]):
-                slice_seg_pair = seg_pair.get_pair_slice(idx_pair_slice,
-                                                         self.slice_axis)
+                if self.crop is not None:
+                    slice_seg_pair, slice_roi_pair = self._push_down(
+                        seg_pair, roi_pair, idx_pair_slice, slice_shape)
+                else:
+                    slice_seg_pair = seg_pair.get_pair_slice(idx_pair_slice,
+                                                             self.slice_axis)
                 if self.slice_filter_fn:
                     filter_fn_ret_seg = self.slice_filter_fn(slice_seg_pair)
                 if self.slice_filter_fn and not filter_fn_ret_seg:
                     continue
 
-                slice_roi_pair = roi_pair.get_pair_slice(idx_pair_slice,
-                                                         self.slice_axis)
+                if self.crop is None:
+                    slice_roi_pair = roi_pair.get_pair_slice(idx_pair_slice,
+                                                             self.slice_axis)
+                index_roi_slice(slice_roi_pair, self.roi_rle)
+                if self.foreground_index:
+                    index_foreground_slice(slice_seg_pair)
 
                 item = (slice_seg_pair, slice_roi_pair)
                 self.indexes.append(item)
@@ -306,6 +923,14 @@ class MRI2DSegmentationDataset(Dataset):
         """
         self.transform = transform
 
+    def set_epoch(self, epoch):
+        """Set the epoch used to derive the random generator of each
+        sample, it should be called before each epoch.
+
+        :param epoch: the epoch number.
+        """
+        self.epoch = epoch
+
     def compute_mean_std(self, verbose=False):
         """Compute the mean and standard deviation of the entire dataset per modality.
 
@@ -354,67 +979,165 @@ class MRI2DSegmentationDataset(Dataset):
         :param index: slice index.
         """
         seg_pair_slice, roi_pair_slice = self.indexes[index]
+        data_dict = build_slice_sample(seg_pair_slice, roi_pair_slice,
+                                       self.label_map)
 
-        input_tensors = []
-        input_metadata = []
-        data_dict = {}
+        # Warning: both input_tensors and input_metadata are list. Transforms needs to take that into account.
+        data_dict = apply_sample_transform(self, data_dict, index)
 
-        # Looping over all modalities (one or more)
-        for idx, input_slice in enumerate(seg_pair_slice["input"]):
-            # Consistency with torchvision, returning PIL Image
-            # Using the "Float mode" of PIL, the only mode
-            # supporting unbounded float32 values
+        return data_dict
 
-            input_img = Image.fromarray(input_slice, mode='F')
-            input_tensors.append(input_img)
 
-        gt_img = []
-        for gt_slice in seg_pair_slice["gt"]:
-            # Handle unlabeled data
-            if gt_slice is None:
-                gt_img.append(None)
-            else:
-                gt_scaled = (gt_slice * 255).astype(np.uint8)
-                gt_img.append(Image.fromarray(gt_scaled, mode='L'))
+def _copy_slices(slices):
+    """Return copies of a list of slices (or None)."""
+    if slices is None:
+        return None
+    return [None if data is None else np.array(data) for data in slices]
 
-        if not len(roi_pair_slice['gt']):
-            roi_img = None
-            roi_pair_slice['gt_metadata'] = None
-        else:
-            roi_img = []
-            
-        for roi_slice in roi_pair_slice["gt"]:
-            # Handle data with no ROI provided
-            if roi_pair_slice["gt"] is None:
-                roi_img.append(None)
-            else:
-                roi_scaled = (roi_slice * 255).astype(np.uint8)
-                roi_img.append(Image.fromarray(roi_scaled, mode='L'))
 
-        data_dict = {
-            'input': input_tensors,
-            'gt': gt_img,
-            'roi': roi_img,
-            'input_metadata': seg_pair_slice['input_metadata'],
-            'gt_metadata': seg_pair_slice['gt_metadata'],
-            'roi_metadata': roi_pair_slice['gt_metadata']
-        }
+class MRI2DSegmentationIterableDataset(IterableDataset):
+    """This is a streaming version of :class:`MRI2DSegmentationDataset`
+    for cohorts that don't fit in memory. The volumes are loaded one at a
+    time from the filename list, split into slices and shuffled through a
+    bounded shuffle buffer, so that the memory used doesn't depend on the
+    number of subjects. When used with multiple DataLoader workers, the
+    volumes are split across the workers.
 
-        """"
-        Moving that part in ToTensor() transformation
-        input_tensors.append(data_dict['input'])
-        input_metadata.append(data_dict['input_metadata'])
-        
-        if len(input_tensors) > 1:
-            data_dict['input'] = torch.squeeze(torch.stack(input_tensors, dim=0))
-            data_dict['input_metadata'] = input_metadata
+    :param filename_pairs: a list of tuples in the format (input filename list containing all modalities,
+                           ground truth filename, ROI filename, metadata).
+    :param slice_axis: axis to make the slicing (default axial).
+    :param transform: transformations to apply.
+    :param shuffle: if True, the volume order is shuffled at each epoch and
+                    the slices go through the shuffle buffer.
+    :param buffer_size: number of slices kept in the shuffle buffer.
+    :param seed: seed of the shuffling, combined with the epoch. The random
+                 transforms of each slice draw from a generator derived
+                 from (seed, epoch, slice), see :func:`apply_sample_transform`.
+    :param label_map: if True, the classes of the ground truth are carried
+                      as a single label map image, see
+                      :class:`MRI2DSegmentationDataset`.
+    :param volume_stats: if True, the mean and standard deviation of each
+                         input volume are computed when it is loaded, see
+                         :class:`MRI2DSegmentationDataset`.
+    :param foreground_index: if True, the foreground pixels of each slice
+                             are indexed, see :class:`MRI2DSegmentationDataset`.
+    """
+
+    def __init__(self, filename_pairs, slice_axis=2, transform=None,
+                 slice_filter_fn=None, canonical=False, shuffle=True,
+                 buffer_size=256, seed=0, label_map=False, volume_stats=False,
+                 foreground_index=False):
+        self.filename_pairs = filename_pairs
+        self.slice_axis = slice_axis
+        self.transform = transform
+        self.slice_filter_fn = slice_filter_fn
+        self.canonical = canonical
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.label_map = label_map
+        self.volume_stats = volume_stats
+        self.foreground_index = foreground_index
+        self.epoch = 0
+
+    def set_transform(self, transform):
+        """ This method will replace the current transformation for the
+        dataset.
+
+        :param transform: the new transformation
         """
-        # Warning: both input_tensors and input_metadata are list. Transforms needs to take that into account.
+        self.transform = transform
 
-        if self.transform is not None:
-            data_dict = self.transform(data_dict)
+    def set_epoch(self, epoch):
+        """Set the epoch used to seed the shuffling, it should be called
+        before each epoch.
 
-        return data_dict
+        :param epoch: the epoch number.
+        """
+        self.epoch = epoch
+
+    def _volume_slices(self, pair_index, filename_pair):
+        """Load a volume and yield its (sample index, segmentation, ROI)
+        slices. The sample index identifies the slice whatever the
+        shuffling and the number of workers."""
+        input_filenames, gt_filenames, roi_filename, metadata = filename_pair
+        # Caching is limited to the lifetime of the current volume
+        seg_pair = SegmentationPair2D(input_filenames, gt_filenames, metadata=metadata,
+                                      cache=True, canonical=self.canonical)
+        roi_pair = SegmentationPair2D(input_filenames, roi_filename, metadata=metadata,
+                                      cache=True, canonical=self.canonical)
+        # The ROI pair shares the input volumes instead of loading them again
+        roi_pair.set_input_data(seg_pair.get_pair_data()[0])
+        if self.volume_stats:
+            seg_pair.compute_volume_stats()
+
+        input_data_shape, _ = seg_pair.get_pair_shapes()
+
+        for idx_pair_slice in range(input_data_shape[self.slice_axis]):
+            slice_seg_pair = seg_pair.get_pair_slice(idx_pair_slice,
+                                                     self.slice_axis)
+            if self.slice_filter_fn and not self.slice_filter_fn(slice_seg_pair):
+                continue
+
+            slice_roi_pair = roi_pair.get_pair_slice(idx_pair_slice,
+                                                     self.slice_axis)
+            index_roi_slice(slice_roi_pair)
+            # Only the ROI slices are used from the ROI pair
+            slice_roi_pair['input'] = slice_seg_pair['input']
+            if self.foreground_index:
+                index_foreground_slice(slice_seg_pair)
+            yield pair_index * 2 ** 32 + idx_pair_slice, slice_seg_pair, slice_roi_pair
+
+    def _worker_pairs(self, rng):
+        """Return the (index, filename pair) processed by the current worker."""
+        order = list(range(len(self.filename_pairs)))
+        if self.shuffle:
+            rng.shuffle(order)
+
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            order = order[worker_info.id::worker_info.num_workers]
+
+        return [(i, self.filename_pairs[i]) for i in order]
+
+    def _slices(self):
+        # Same volume order on every worker, then a worker specific stream
+        rng = np.random.RandomState([self.seed, self.epoch])
+        filename_pairs = self._worker_pairs(rng)
+
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        rng = np.random.RandomState([self.seed, self.epoch, worker_id])
+
+        buffer = []
+        for pair_index, filename_pair in filename_pairs:
+            for item in self._volume_slices(pair_index, filename_pair):
+                if not self.shuffle:
+                    yield item
+                else:
+                    # The slices are views of the volume, the buffered
+                    # copies don't keep the whole volume alive
+                    _, seg_pair_slice, roi_pair_slice = item
+                    seg_pair_slice['input'] = _copy_slices(seg_pair_slice['input'])
+                    seg_pair_slice['gt'] = _copy_slices(seg_pair_slice['gt'])
+                    roi_pair_slice['input'] = seg_pair_slice['input']
+                    roi_pair_slice['gt'] = _copy_slices(roi_pair_slice['gt'])
+                    if len(buffer) < self.buffer_size:
+                        buffer.append(item)
+                    else:
+                        idx = rng.randint(len(buffer))
+                        yield buffer[idx]
+                        buffer[idx] = item
+
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield item
+
+    def __iter__(self):
+        for index, seg_pair_slice, roi_pair_slice in self._slices():
+            data_dict = build_slice_sample(seg_pair_slice, roi_pair_slice,
+                                           self.label_map)
+            yield apply_sample_transform(self, data_dict, index)
 
 
 class MRI3DSegmentationDataset(Dataset):
@@ -423,16 +1146,20 @@ class MRI3DSegmentationDataset(Dataset):
                            ground truth filename).
     :param cache: if the data should be cached in memory or not.
     :param transform: transformations to apply.
+    :param seed: if not None, the random transforms of each sample draw from
+                 a generator derived from (seed, epoch, index).
     """
 
     def __init__(self, filename_pairs, cache=True,
-                 transform=None, canonical=False):
+                 transform=None, canonical=False, seed=None):
         self.filename_pairs = filename_pairs
         self.handlers = []
         self.indexes = []
         self.transform = transform
         self.cache = cache
         self.canonical = canonical
+        self.seed = seed
+        self.epoch = 0
 
         self._load_filenames()
 
@@ -449,6 +1176,14 @@ class MRI3DSegmentationDataset(Dataset):
         """
         self.transform = transform
 
+    def set_epoch(self, epoch):
+        """Set the epoch used to derive the random generator of each
+        sample, it should be called before each epoch.
+
+        :param epoch: the epoch number.
+        """
+        self.epoch = epoch
+
     def __len__(self):
         """Return the dataset size."""
         return len(self.handlers)
@@ -462,8 +1197,7 @@ class MRI3DSegmentationDataset(Dataset):
             'input': input_img,
             'gt': gt_img
         }
-        if self.transform is not None:
-            data_dict = self.transform(data_dict)
+        data_dict = apply_sample_transform(self, data_dict, index)
         return data_dict
 
 
@@ -487,11 +1221,14 @@ class MRI3DSubVolumeSegmentationDataset(MRI3DSegmentationDataset):
     :param transform: transformations to apply.
     :param length: size of each dimensions of the subvolumes
     :param padding: size of the overlapping per subvolume and dimensions
+    :param seed: if not None, the random transforms of each sample draw from
+                 a generator derived from (seed, epoch, index).
     """
 
     def __init__(self, filename_pairs, cache=True,
-                 transform=None, canonical=False, length=(64, 64, 64), padding=0):
-        super().__init__(filename_pairs, cache, transform, canonical)
+                 transform=None, canonical=False, length=(64, 64, 64), padding=0,
+                 seed=None):
+        super().__init__(filename_pairs, cache, transform, canonical, seed)
         self.length = length
         self.padding = padding
         self.transform = transform
@@ -564,8 +1301,233 @@ class MRI3DSubVolumeSegmentationDataset(MRI3DSegmentationDataset):
         data_dict['gt_metadata'] = seg_pair_slice['gt_metadata']
         for idx in range(len(data_dict["input"])):
             data_dict['input_metadata'][idx]['data_shape'] = data_shape
-        if self.transform is not None:
-            data_dict = self.transform(data_dict)
+        data_dict = apply_sample_transform(self, data_dict, index)
+        return data_dict
+
+
+# Streams of the generators, see sample_rng: the per-sample generators of
+# the datasets use the stream 0, the materialized variants and the
+# permutations of ResumableRandomSampler have their own
+MATERIALIZE_STREAM = 1
+SAMPLER_STREAM = 2
+
+_METADATA_KEYS = ('input_metadata', 'gt_metadata')
+
+
+def _copy_metadata(metadata_list):
+    if metadata_list is None:
+        return None
+    return [SampleMetadata(dict(metadata.metadata)) for metadata in metadata_list]
+
+
+def _metadata_changes(original, transformed):
+    """Return the items added or replaced by a transform in each metadata
+    of a list."""
+    if original is None or transformed is None:
+        return None
+    return [{key: metadata[key] for key in metadata.keys()
+             if key not in reference or reference[key] is not metadata[key]}
+            for reference, metadata in zip(original, transformed)]
+
+
+def materialize_augmentations(dataset, transform, output_dir, num_variants=4,
+                              seed=None, verbose=False):
+    """Precompute num_variants augmented versions of each slice of a 2D
+    dataset and store them in memory-mapped files, to be used with
+    :class:`MRI2DAugmentedDataset`. This trades disk space for the CPU time
+    of expensive augmentations (i.e. elastic and affine transforms).
+
+    The transformation must return PIL images or numpy arrays of the same
+    shape for all the slices (i.e. it should contain a crop). The metadata
+    it records (e.g. the crop parameters) are stored with each variant.
+
+    :param dataset: the :class:`MRI2DSegmentationDataset` to augment.
+    :param transform: the augmentation (i.e. a Compose) to materialize.
+    :param output_dir: the directory of the memory-mapped files.
+    :param num_variants: number of augmented variants per slice.
+    :param seed: if not None, the variant k of the slice i is generated with
+                 the generator derived from (seed, k, i) in the
+                 :data:`MATERIALIZE_STREAM` stream, independent of the
+                 per-epoch generators of the datasets.
+    :param verbose: if True, it will show a progress bar.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    num_samples = len(dataset.indexes)
+    if not num_samples:
+        raise RuntimeError("The dataset is empty.")
+
+    input_store, gt_store = None, None
+    variant_metadata = []
+    pbar = tqdm(range(num_samples), desc="Augmentation", disable=not verbose)
+    for index in pbar:
+        variant_metadata.append([])
+        for variant in range(num_variants):
+            seg_pair_slice, roi_pair_slice = dataset.indexes[index]
+            sample = build_slice_sample(seg_pair_slice, roi_pair_slice)
+            # The transform records its parameters (e.g. the crop) in copies
+            # of the metadata, the changes are stored with the variant
+            for key in _METADATA_KEYS:
+                sample[key] = _copy_metadata(sample[key])
+            if seed is None:
+                sample = transform(sample)
+            else:
+                rng = mt_transforms.sample_rng(seed, variant, index, stream=MATERIALIZE_STREAM)
+                with mt_transforms.sample_rng_context(rng):
+                    sample = transform(sample)
+            variant_metadata[index].append({
+                key: _metadata_changes(seg_pair_slice[key], sample[key])
+                for key in _METADATA_KEYS
+            })
+
+            input_data = np.stack([np.asarray(item, dtype=np.float32)
+                                   for item in sample['input']])
+            gt_data = np.stack([np.asarray(item, dtype=np.uint8)
+                                for item in sample['gt']])
+
+            if input_store is None:
+                input_shape, gt_shape = input_data.shape, gt_data.shape
+                input_store = np.memmap(os.path.join(output_dir, 'input.dat'), dtype=np.float32, mode='w+',
+                                        shape=(num_samples, num_variants) + input_shape)
+                gt_store = np.memmap(os.path.join(output_dir, 'gt.dat'), dtype=np.uint8, mode='w+',
+                                     shape=(num_samples, num_variants) + gt_shape)
+
+            if input_data.shape != input_shape or gt_data.shape != gt_shape:
+                raise RuntimeError("Augmented slices must have the same shape, "
+                                   "the transformation should contain a crop.")
+
+            input_store[index, variant] = input_data
+            gt_store[index, variant] = gt_data
+
+    input_store.flush()
+    gt_store.flush()
+
+    with open(os.path.join(output_dir, 'metadata.json'), 'w') as fhandle:
+        json.dump({
+            'num_samples': num_samples,
+            'num_variants': num_variants,
+            'input_shape': input_shape,
+            'gt_shape': gt_shape,
+        }, fhandle)
+    with open(os.path.join(output_dir, 'metadata.pkl'), 'wb') as fhandle:
+        pickle.dump(variant_metadata, fhandle)
+
+
+class MRI2DAugmentedDataset(Dataset):
+    """This dataset serves the augmented slices precomputed by
+    :func:`materialize_augmentations`, picking one random variant of each
+    slice per epoch. A ratio of the samples can still be augmented online.
+
+    :param dataset: the :class:`MRI2DSegmentationDataset` that was augmented.
+    :param cache_dir: the directory of the memory-mapped files.
+    :param transform: transformations to apply after the augmentation
+                      (i.e. ToTensor, normalization).
+    :param online_transform: the augmentation to apply online, usually the
+                             one that was materialized.
+    :param online_ratio: probability of augmenting a sample online instead
+                         of using a precomputed variant.
+    :param seed: if not None, the variant choice and the transforms of each
+                 sample draw from a generator derived from (seed, epoch, index).
+    """
+
+    def __init__(self, dataset, cache_dir, transform=None,
+                 online_transform=None, online_ratio=0.0, seed=None):
+        self.dataset = dataset
+        self.cache_dir = cache_dir
+        self.transform = transform
+        self.online_transform = online_transform
+        self.online_ratio = online_ratio
+        self.seed = seed
+        self.epoch = 0
+
+        if online_ratio > 0 and online_transform is None:
+            raise ValueError("An online transform is required when online_ratio > 0.")
+
+        with open(os.path.join(cache_dir, 'metadata.json')) as fhandle:
+            self.cache_metadata = json.load(fhandle)
+
+        if self.cache_metadata['num_samples'] != len(dataset.indexes):
+            raise RuntimeError("The augmentation cache doesn't match the dataset.")
+        with open(os.path.join(cache_dir, 'metadata.pkl'), 'rb') as fhandle:
+            self.variant_metadata = pickle.load(fhandle)
+
+        # Memory maps are opened lazily, in each DataLoader worker
+        self._input_store = None
+        self._gt_store = None
+
+    def _open_stores(self):
+        num_samples = self.cache_metadata['num_samples']
+        num_variants = self.cache_metadata['num_variants']
+        self._input_store = np.memmap(os.path.join(self.cache_dir, 'input.dat'), dtype=np.float32, mode='r',
+                                      shape=(num_samples, num_variants) + tuple(self.cache_metadata['input_shape']))
+        self._gt_store = np.memmap(os.path.join(self.cache_dir, 'gt.dat'), dtype=np.uint8, mode='r',
+                                   shape=(num_samples, num_variants) + tuple(self.cache_metadata['gt_shape']))
+
+    def set_transform(self, transform):
+        """ This method will replace the current transformation for the
+        dataset.
+
+        :param transform: the new transformation
+        """
+        self.transform = transform
+
+    def set_epoch(self, epoch):
+        """Set the epoch used to pick the variants, it should be called
+        before each epoch.
+
+        :param epoch: the epoch number.
+        """
+        self.epoch = epoch
+
+    def __len__(self):
+        """Return the dataset size."""
+        return len(self.dataset.indexes)
+
+    def _precomputed_sample(self, index, variant):
+        if self._input_store is None:
+            self._open_stores()
+
+        seg_pair_slice, _ = self.dataset.indexes[index]
+        input_data = self._input_store[index, variant]
+        gt_data = self._gt_store[index, variant]
+        data_dict = {
+            'input': [Image.fromarray(np.array(item), mode='F') for item in input_data],
+            'gt': [Image.fromarray(np.array(item), mode='L') for item in gt_data],
+            'roi': None,
+            'roi_metadata': None,
+        }
+        # Metadata of the variant, with the parameters of its transform
+        changes = self.variant_metadata[index][variant]
+        for key in _METADATA_KEYS:
+            data_dict[key] = _copy_metadata(seg_pair_slice[key])
+            for metadata, items in zip(data_dict[key] or [], changes[key] or []):
+                for item_key, value in items.items():
+                    metadata[item_key] = value
+        return data_dict
+
+    def __getitem__(self, index):
+        """Return a random augmented variant of the slice.
+
+        :param index: slice index.
+        """
+        if self.seed is None:
+            rng = np.random
+        else:
+            rng = mt_transforms.sample_rng(self.seed, self.epoch, index)
+
+        with mt_transforms.sample_rng_context(rng):
+            if rng.random() < self.online_ratio:
+                seg_pair_slice, roi_pair_slice = self.dataset.indexes[index]
+                data_dict = build_slice_sample(seg_pair_slice, roi_pair_slice)
+                data_dict = self.online_transform(data_dict)
+            else:
+                variant = int(rng.random() * self.cache_metadata['num_variants'])
+                data_dict = self._precomputed_sample(index, variant)
+
+            if self.transform is not None:
+                data_dict = self.transform(data_dict)
+
         return data_dict
 
 
@@ -586,6 +1548,68 @@ class DatasetManager(object):
             self.dataset.transform = self._transform_state
 
 
+class ResumableRandomSampler(Sampler):
+    """Random sampler whose permutation only depends on (seed, epoch) and
+    whose position in the epoch can be checkpointed, so that a job can be
+    resumed in the middle of an epoch without replaying it.
+
+    Example::
+
+        sampler = ResumableRandomSampler(dataset, seed=42)
+        sampler.load_state_dict(checkpoint['sampler'])
+        for epoch in range(sampler.epoch, num_epochs):
+            sampler.set_epoch(epoch)  # keeps a restored position
+            for i, batch in enumerate(DataLoader(dataset, sampler=sampler)):
+                ...
+                checkpoint['sampler'] = sampler.state_dict((i + 1) * batch_size)
+
+    :param data_source: the dataset to sample from.
+    :param seed: the seed of the permutations.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.position = 0
+
+    def set_epoch(self, epoch):
+        """Set the epoch of the permutation. The position is reset unless
+        the sampler was restored in this same epoch.
+
+        :param epoch: the epoch number.
+        """
+        if epoch != self.epoch:
+            self.position = 0
+        self.epoch = epoch
+
+    def state_dict(self, num_consumed):
+        """Return the state of the sampler.
+
+        :param num_consumed: the number of samples consumed since the
+                             beginning of the current iteration.
+        """
+        return {
+            'seed': self.seed,
+            'epoch': self.epoch,
+            'position': self.position + num_consumed,
+        }
+
+    def load_state_dict(self, state_dict):
+        """Restore the state returned by :meth:`state_dict`."""
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.position = state_dict['position']
+
+    def __iter__(self):
+        rng = mt_transforms.sample_rng(self.seed, self.epoch, 0, stream=SAMPLER_STREAM)
+        permutation = rng.permutation(len(self.data_source))
+        return iter(permutation[self.position:].tolist())
+
+    def __len__(self):
+        return len(self.data_source) - self.position
+
+
 class SCGMChallenge2DTrain(MRI2DSegmentationDataset):
     """This is the Spinal Cord Gray Matter Challenge dataset.
 
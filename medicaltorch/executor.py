@@ -0,0 +1,238 @@
+import queue
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def _sample_spec(value):
+    """Return the (shape, dtype) of a tensor, the list of specs of a list
+    of tensors, or None for the other values."""
+    if torch.is_tensor(value):
+        return tuple(value.shape), value.dtype
+    if isinstance(value, (list, tuple)) and value and all(torch.is_tensor(v) for v in value):
+        return [(tuple(v.shape), v.dtype) for v in value]
+    return None
+
+
+def _allocate(spec, batch_size):
+    if isinstance(spec, list):
+        return [_allocate(item, batch_size) for item in spec]
+    shape, dtype = spec
+    return torch.empty((batch_size,) + shape, dtype=dtype).share_memory_()
+
+
+def _write(buffer, position, value):
+    if isinstance(buffer, list):
+        if len(value) != len(buffer):
+            raise RuntimeError("Expected {} tensors, got {}.".format(len(buffer), len(value)))
+        for item_buffer, item in zip(buffer, value):
+            _write(item_buffer, position, item)
+    else:
+        buffer[position].copy_(value)
+
+
+def _view(buffer, size):
+    if isinstance(buffer, list):
+        return [_view(item, size) for item in buffer]
+    return buffer[:size]
+
+
+def _worker_loop(dataset, slots, index_queue, ready_queue, seed, worker_id):
+    """Write the samples of the received batches in their slots and send
+    back the slot indices only."""
+    torch.set_num_threads(1)
+    np.random.seed((seed + worker_id) % 2 ** 32)
+    torch.manual_seed(seed + worker_id)
+
+    epoch = None
+    while True:
+        task = index_queue.get()
+        if task is None:
+            break
+
+        slot, batch_idx, indices, task_epoch = task
+        try:
+            if task_epoch != epoch and hasattr(dataset, 'set_epoch'):
+                dataset.set_epoch(task_epoch)
+            epoch = task_epoch
+
+            for position, index in enumerate(indices):
+                sample = dataset[index]
+                for key, buffer in slots[slot].items():
+                    _write(buffer, position, sample[key])
+            ready_queue.put((slot, batch_idx, len(indices), None))
+        except Exception:
+            ready_queue.put((slot, batch_idx, 0, traceback.format_exc()))
+
+
+class SharedMemoryLoader(object):
+    """Batch loader whose worker processes write the samples directly in a
+    ring of preallocated shared memory batch slots. Only the slot indices go
+    through the queues, so the samples are never pickled, and the batches
+    are views of the slots (no collate copy).
+
+    The tensors of a batch are only valid until the next batch is
+    requested, their slot is then reused by the workers: clone them to
+    keep them. All the samples must have the same tensor shapes, they are
+    read from the first sample of the dataset. The values which are not
+    tensors (e.g. the metadata) are not transferred.
+
+    The workers are started on the first iteration and kept alive until
+    :meth:`close` is called. The epoch set by :meth:`set_epoch` is also
+    forwarded to the set_epoch() method of the dataset in the workers.
+
+    :param dataset: the dataset, returning dicts of tensors (or lists of
+                    tensors, e.g. the inputs of multiple contrasts).
+    :param batch_size: the number of samples per batch.
+    :param shuffle: if True, the samples are shuffled at each epoch.
+    :param num_workers: number of worker processes.
+    :param num_slots: number of batch slots in the ring, at least 2 (one
+                      read by the trainer, one written by a worker),
+                      default 2 * num_workers.
+    :param drop_last: if True, the last incomplete batch is dropped.
+    :param keys: the keys of the samples to load, default all the tensor
+                 values of the first sample.
+    :param seed: seed of the shuffling (combined with the epoch) and of the
+                 global generators of the workers.
+    :param timeout: maximum waiting time in seconds for a batch, or None.
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, num_workers=2,
+                 num_slots=None, drop_last=False, keys=None, seed=0,
+                 timeout=None):
+        if num_workers < 1:
+            raise ValueError("At least one worker is required.")
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.num_slots = max(num_slots or 2 * num_workers, 2)
+        self.drop_last = drop_last
+        self.keys = keys
+        self.seed = seed
+        self.timeout = timeout
+        self.epoch = 0
+
+        self._slots = None
+        self._workers = []
+        self._in_flight = 0
+
+    def set_epoch(self, epoch):
+        """Set the epoch used to seed the shuffling, it should be called
+        before each epoch.
+
+        :param epoch: the epoch number.
+        """
+        self.epoch = epoch
+
+    def _batches(self):
+        order = np.arange(len(self.dataset))
+        if self.shuffle:
+            order = np.random.RandomState([self.seed, self.epoch]).permutation(order)
+
+        batches = [order[start:start + self.batch_size].tolist()
+                   for start in range(0, len(order), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        return batches
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def _start(self):
+        sample = self.dataset[0]
+        keys = self.keys
+        if keys is None:
+            keys = [key for key in sample if _sample_spec(sample[key]) is not None]
+
+        specs = {}
+        for key in keys:
+            specs[key] = _sample_spec(sample[key])
+            if specs[key] is None:
+                raise ValueError("The sample value '{}' is not a tensor.".format(key))
+
+        self._slots = [{key: _allocate(spec, self.batch_size) for key, spec in specs.items()}
+                       for _ in range(self.num_slots)]
+
+        self._index_queue = mp.Queue()
+        self._ready_queue = mp.Queue()
+        for worker_id in range(self.num_workers):
+            worker = mp.Process(target=_worker_loop,
+                                args=(self.dataset, self._slots, self._index_queue,
+                                      self._ready_queue, self.seed, worker_id),
+                                daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _get(self):
+        waited = 0.0
+        while True:
+            try:
+                message = self._ready_queue.get(timeout=1.0)
+                self._in_flight -= 1
+                return message
+            except queue.Empty:
+                dead = [worker.pid for worker in self._workers if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError("Loader workers (pid {}) exited unexpectedly.".format(
+                        ", ".join(str(pid) for pid in dead)))
+                waited += 1.0
+                if self.timeout is not None and waited >= self.timeout:
+                    raise RuntimeError("Loader timed out after {} seconds.".format(self.timeout))
+
+    def _drain(self):
+        # Wait for the batches of an interrupted iteration
+        while self._in_flight > 0:
+            self._get()
+
+    def __iter__(self):
+        if self._slots is None:
+            self._start()
+        self._drain()
+
+        batches = self._batches()
+        free = list(range(self.num_slots))
+        ready = {}
+        sent = 0
+        for batch_idx in range(len(batches)):
+            # Keep all the free slots busy
+            while free and sent < len(batches):
+                self._index_queue.put((free.pop(), sent, batches[sent], self.epoch))
+                self._in_flight += 1
+                sent += 1
+
+            while batch_idx not in ready:
+                slot, idx, size, error = self._get()
+                if error is not None:
+                    raise RuntimeError("Error in a loader worker:\n{}".format(error))
+                ready[idx] = (slot, size)
+
+            slot, size = ready.pop(batch_idx)
+            yield {key: _view(buffer, size) for key, buffer in self._slots[slot].items()}
+            free.append(slot)
+
+    def close(self):
+        """Stop the worker processes."""
+        for _ in self._workers:
+            self._index_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5.0)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        self._slots = None
+        self._in_flight = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if self._workers:
+            self.close()
@@ -0,0 +1,267 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn import Module
+
+from medicaltorch import models as mt_models
+from medicaltorch.batch_transforms import warp_affine
+
+
+class TestTimeAugmentation(object):
+    """Test-time augmentation with invertible geometric transformations.
+
+    Each augmentation is applied to the whole input batch, all the augmented
+    views are predicted in a single forward pass, then each prediction is
+    warped back with the inverse of its transformation and the predictions
+    are averaged. Pixels that fell outside of an augmented view don't
+    contribute to its average.
+
+    :param model: the model, its predictions must have the spatial size of
+                  its inputs. It should be in eval mode.
+    :param augmentations: list of :class:`medicaltorch.batch_transforms.BatchAffineTransform`
+                          keeping the image size (rotations, affine
+                          transformations, flips). They can be random, the
+                          drawn matrices are inverted.
+    :param include_identity: if True, the original batch is also predicted.
+    :param activation: function applied to the predictions before
+                       averaging (e.g. torch.sigmoid), or None.
+    """
+
+    def __init__(self, model, augmentations, include_identity=True,
+                 activation=None):
+        self.model = model
+        self.augmentations = augmentations
+        self.include_identity = include_identity
+        self.activation = activation
+
+    def augment(self, input_data):
+        """Return the augmented views of a batch and their forward
+        matrices (None for the identity).
+
+        :param input_data: the (B, C, H, W) input tensor.
+        """
+        height, width = input_data.shape[-2:]
+        views, matrices = [], []
+        if self.include_identity:
+            views.append(input_data)
+            matrices.append(None)
+
+        for augmentation in self.augmentations:
+            batch = {'input': input_data}
+            aug_matrices, output_size = augmentation.get_matrices(batch, height, width)
+            if tuple(output_size) != (height, width):
+                raise ValueError("Test-time augmentations must keep the image size.")
+            views.append(warp_affine(input_data, aug_matrices, output_size))
+            matrices.append(aug_matrices)
+        return views, matrices
+
+    def __call__(self, input_data):
+        """Return the averaged predictions of a batch.
+
+        :param input_data: the (B, C, H, W) input tensor.
+        """
+        batch_size = input_data.size(0)
+        height, width = input_data.shape[-2:]
+        views, matrices = self.augment(input_data)
+
+        with torch.no_grad():
+            predictions = self.model(torch.cat(views, dim=0))
+            if self.activation is not None:
+                predictions = self.activation(predictions)
+
+        total = torch.zeros_like(predictions[:batch_size])
+        weights = torch.zeros_like(total[:, :1])
+        ones = torch.ones_like(weights)
+        for idx, aug_matrices in enumerate(matrices):
+            prediction = predictions[idx * batch_size:(idx + 1) * batch_size]
+            if aug_matrices is None:
+                total += prediction
+                weights += ones
+                continue
+
+            inverse = torch.inverse(aug_matrices)
+            total += warp_affine(prediction, inverse, (height, width))
+            # Coverage of the augmented view in the original image
+            weights += warp_affine(ones, inverse, (height, width))
+
+        return total / weights.clamp(min=1e-6)
+
+
+def _bn_scale_shift(bn):
+    """Return the per-channel (scale, shift) of a BatchNorm in eval mode."""
+    if bn.running_var is None:
+        raise ValueError("BatchNorm without running statistics can't be folded.")
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    return scale.detach(), shift.detach()
+
+
+def _channel_view(tensor, conv):
+    return tensor.view((1, -1) + (1,) * (conv.weight.dim() - 2))
+
+
+def _conv_with_bias(conv):
+    conv = copy.deepcopy(conv)
+    if conv.bias is None:
+        conv.bias = nn.Parameter(torch.zeros(conv.out_channels, dtype=conv.weight.dtype,
+                                             device=conv.weight.device))
+    return conv
+
+
+def fold_bn_into_next_conv(bn, conv):
+    """Return a copy of a 1x1 convolution applied to the output of a
+    BatchNorm, with the BatchNorm folded in its weights and bias.
+
+    The convolution must not pad its input: the padded zeros would
+    otherwise be shifted by the BatchNorm.
+
+    :param bn: the BatchNorm, in front of the convolution.
+    :param conv: the convolution.
+    """
+    if any(size != 1 for size in conv.kernel_size) or any(pad != 0 for pad in conv.padding) \
+            or conv.groups != 1:
+        raise ValueError("Only a 1x1 convolution without padding can absorb a BatchNorm.")
+    scale, shift = _bn_scale_shift(bn)
+    folded = _conv_with_bias(conv)
+    with torch.no_grad():
+        weight = folded.weight.view(folded.out_channels, -1)
+        folded.bias.add_(weight.mv(shift))
+        folded.weight.mul_(_channel_view(scale, folded))
+    return folded
+
+
+class ConvClamp(Module):
+    """Inference form of conv -> ReLU -> BatchNorm: a single convolution
+    followed by a per-channel clamp.
+
+    With the BatchNorm y = a * relu(z) + b, y is a * z + b clamped from
+    below by b where a >= 0 and from above by b where a < 0, so the
+    BatchNorm is folded exactly in the weights and bias of the convolution.
+    The upper clamp is skipped when all the scales are positive.
+
+    :param conv: the convolution.
+    :param bn: the BatchNorm following the ReLU.
+    """
+
+    def __init__(self, conv, bn):
+        super().__init__()
+        scale, shift = _bn_scale_shift(bn)
+        self.conv = _conv_with_bias(conv)
+        with torch.no_grad():
+            self.conv.weight.mul_(_channel_view(scale, self.conv).transpose(0, 1))
+            self.conv.bias.mul_(scale).add_(shift)
+
+        infinity = torch.full_like(shift, float('inf'))
+        positive = scale >= 0
+        self.register_buffer('lower', _channel_view(torch.where(positive, shift, -infinity), self.conv))
+        self.register_buffer('upper', _channel_view(torch.where(positive, infinity, shift), self.conv))
+        self.clamp_upper = bool((~positive).any())
+
+    def forward(self, x):
+        x = torch.max(self.conv(x), self.lower)
+        if self.clamp_upper:
+            x = torch.min(x, self.upper)
+        return x
+
+
+def _fold_layer(model, name):
+    """Fold the layer of a model with its BatchNorm, a separable convolution
+    (a Sequential) is folded in its last convolution."""
+    conv, bn = getattr(model, name), getattr(model, name + '_bn')
+    if isinstance(conv, nn.Sequential):
+        return nn.Sequential(*([copy.deepcopy(m) for m in conv[:-1]] + [ConvClamp(conv[-1], bn)]))
+    return ConvClamp(conv, bn)
+
+
+class FoldedDownConv(Module):
+    """Inference form of :class:`medicaltorch.models.DownConv`."""
+
+    def __init__(self, down_conv):
+        super().__init__()
+        self.conv1 = ConvClamp(down_conv.conv1, down_conv.conv1_bn)
+        self.conv2 = ConvClamp(down_conv.conv2, down_conv.conv2_bn)
+
+    def forward(self, x):
+        return self.conv2(self.conv1(x))
+
+
+class FoldedUpConv(Module):
+    """Inference form of :class:`medicaltorch.models.UpConv`."""
+
+    def __init__(self, up_conv):
+        super().__init__()
+        self.downconv = FoldedDownConv(up_conv.downconv)
+
+    def forward(self, x, y):
+        x = F.interpolate(x, scale_factor=2.0, mode='bilinear', align_corners=True)
+        x = torch.cat([x, y], dim=1)
+        return self.downconv(x)
+
+
+class FoldedNoPoolASPP(Module):
+    """Inference form of :class:`medicaltorch.models.NoPoolASPP`, the
+    BatchNorms following the ReLUs are folded with :class:`ConvClamp` and
+    the BatchNorm of the concatenation is folded in the amortization
+    convolution."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.stem = nn.Sequential(*[_fold_layer(model, name) for name in model.stem_names()])
+        self.branches = nn.ModuleList()
+        for names in model.branch_names():
+            self.branches.append(nn.Sequential(*[_fold_layer(model, name) for name in names]))
+        self.amort = ConvClamp(fold_bn_into_next_conv(model.concat_bn, model.amort),
+                               model.amort_bn)
+        self.prediction = copy.deepcopy(model.prediction)
+
+    def forward(self, x):
+        x = self.stem(x)
+        outputs = []
+        for branch in self.branches:
+            outputs.append(branch(x))
+        # Global Average Pooling
+        outputs.append(F.adaptive_avg_pool2d(x, 1).expand_as(x))
+
+        x = self.amort(torch.cat(outputs, dim=1))
+        return torch.sigmoid(self.prediction(x))
+
+
+def _fold_unet(model):
+    model = copy.deepcopy(model)
+    for name, child in list(model.named_children()):
+        if isinstance(child, mt_models.DownConv):
+            setattr(model, name, FoldedDownConv(child))
+        elif isinstance(child, mt_models.UpConv):
+            setattr(model, name, FoldedUpConv(child))
+    return model
+
+
+def optimize_for_inference(model, script=False):
+    """Return an inference copy of a :class:`medicaltorch.models.Unet` or
+    :class:`medicaltorch.models.NoPoolASPP`, without the dropouts and with
+    each conv -> ReLU -> BatchNorm replaced by a single convolution and a
+    clamp (see :class:`ConvClamp`). The predictions are the ones of the
+    model in eval mode, up to the float rounding.
+
+    :param model: the trained model, it is not modified.
+    :param script: if True, the returned module is compiled with
+                   torch.jit.script.
+    """
+    if isinstance(model, mt_models.NoPoolASPP):
+        optimized = FoldedNoPoolASPP(model)
+    elif isinstance(model, mt_models.Unet):
+        optimized = _fold_unet(model)
+    else:
+        raise TypeError("Unsupported model {}.".format(type(model).__name__))
+
+    optimized.eval()
+    for param in optimized.parameters():
+        param.requires_grad_(False)
+    if script:
+        optimized = torch.jit.script(optimized)
+    return optimized
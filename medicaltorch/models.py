@@ -1,7 +1,12 @@
+import inspect
+
 import torch
 import torch.nn as nn
 from torch.nn import Module
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+_CHECKPOINT_REENTRANT_ARG = 'use_reentrant' in inspect.signature(checkpoint).parameters
 
 
 class NoPoolASPP(Module):
@@ -12,8 +17,24 @@ class NoPoolASPP(Module):
 
     An ASPP-based model without initial pooling layers.
 
+    The default options build the model of the paper. Each branch has two
+    3x3 convolutions with the dilation of the branch (the second one is a
+    1x1 convolution for a dilation of 1), the branches are concatenated
+    with the global average pooling of their input.
+
     :param drop_rate: dropout rate.
     :param bn_momentum: batch normalization momentum.
+    :param base_num_filters: number of filters of the first layers.
+    :param in_channels: number of input channels.
+    :param dilations: the dilation of each branch.
+    :param separable: if True, the 3x3 convolutions of the branches are
+                      depthwise separable (a depthwise 3x3 convolution
+                      followed by a pointwise 1x1 convolution).
+    :param shared_reduction: if True, a shared 1x1 convolution reduces the
+                             input of the branches to branch_filters
+                             channels.
+    :param branch_filters: number of filters of the branches, default
+                           base_num_filters.
 
     .. seealso::
         Perone, C. S., et al (2017). Spinal cord gray matter
@@ -23,10 +44,15 @@ class NoPoolASPP(Module):
 
     """
     def __init__(self, drop_rate=0.4, bn_momentum=0.1,
-                 base_num_filters=64):
+                 base_num_filters=64, in_channels=1,
+                 dilations=(1, 6, 12, 18, 24), separable=False,
+                 shared_reduction=False, branch_filters=None):
         super().__init__()
+        branch_filters = branch_filters or base_num_filters
+        self.n_branches = len(dilations)
+        self.shared_reduction = shared_reduction
 
-        self.conv1a = nn.Conv2d(1, base_num_filters, kernel_size=3, padding=1)
+        self.conv1a = nn.Conv2d(in_channels, base_num_filters, kernel_size=3, padding=1)
         self.conv1a_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
         self.conv1a_drop = nn.Dropout2d(drop_rate)
         self.conv1b = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=1)
@@ -40,135 +66,96 @@ class NoPoolASPP(Module):
         self.conv2b_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
         self.conv2b_drop = nn.Dropout2d(drop_rate)
 
-        # Branch 1x1 convolution
-        self.branch1a = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=1)
-        self.branch1a_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch1a_drop = nn.Dropout2d(drop_rate)
-        self.branch1b = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=1)
-        self.branch1b_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch1b_drop = nn.Dropout2d(drop_rate)
-
-        # Branch for 3x3 rate 6
-        self.branch2a = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=6, dilation=6)
-        self.branch2a_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch2a_drop = nn.Dropout2d(drop_rate)
-        self.branch2b = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=6, dilation=6)
-        self.branch2b_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch2b_drop = nn.Dropout2d(drop_rate)
-
-        # Branch for 3x3 rate 12
-        self.branch3a = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=12, dilation=12)
-        self.branch3a_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch3a_drop = nn.Dropout2d(drop_rate)
-        self.branch3b = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=12, dilation=12)
-        self.branch3b_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch3b_drop = nn.Dropout2d(drop_rate)
-
-        # Branch for 3x3 rate 18
-        self.branch4a = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=18, dilation=18)
-        self.branch4a_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch4a_drop = nn.Dropout2d(drop_rate)
-        self.branch4b = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=18, dilation=18)
-        self.branch4b_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch4b_drop = nn.Dropout2d(drop_rate)
-
-        # Branch for 3x3 rate 24
-        self.branch5a = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=24, dilation=24)
-        self.branch5a_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch5a_drop = nn.Dropout2d(drop_rate)
-        self.branch5b = nn.Conv2d(base_num_filters, base_num_filters, kernel_size=3, padding=24, dilation=24)
-        self.branch5b_bn = nn.BatchNorm2d(base_num_filters, momentum=bn_momentum)
-        self.branch5b_drop = nn.Dropout2d(drop_rate)
-
+        branch_in = base_num_filters
+        if shared_reduction:
+            self.reduction = nn.Conv2d(base_num_filters, branch_filters, kernel_size=1)
+            self.reduction_bn = nn.BatchNorm2d(branch_filters, momentum=bn_momentum)
+            self.reduction_drop = nn.Dropout2d(drop_rate)
+            branch_in = branch_filters
+
+        # Branches of dilated convolutions, named branch1a, branch1b, ...
+        for idx, dilation in enumerate(dilations, 1):
+            first = self.branch_conv(branch_in, branch_filters, 3, dilation, separable)
+            if dilation == 1:
+                second = nn.Conv2d(branch_filters, branch_filters, kernel_size=1)
+            else:
+                second = self.branch_conv(branch_filters, branch_filters, 3, dilation, separable)
+
+            for suffix, conv in (('a', first), ('b', second)):
+                name = 'branch{}{}'.format(idx, suffix)
+                setattr(self, name, conv)
+                setattr(self, name + '_bn', nn.BatchNorm2d(branch_filters, momentum=bn_momentum))
+                setattr(self, name + '_drop', nn.Dropout2d(drop_rate))
+
+        concat_filters = self.n_branches * branch_filters + branch_in
         self.concat_drop = nn.Dropout2d(drop_rate)
-        self.concat_bn = nn.BatchNorm2d(6*base_num_filters, momentum=bn_momentum)
+        self.concat_bn = nn.BatchNorm2d(concat_filters, momentum=bn_momentum)
 
-        self.amort = nn.Conv2d(6*base_num_filters, base_num_filters*2, kernel_size=1)
+        self.amort = nn.Conv2d(concat_filters, base_num_filters*2, kernel_size=1)
         self.amort_bn = nn.BatchNorm2d(base_num_filters*2, momentum=bn_momentum)
         self.amort_drop = nn.Dropout2d(drop_rate)
 
         self.prediction = nn.Conv2d(base_num_filters*2, 1, kernel_size=1)
 
+    @staticmethod
+    def branch_conv(in_channels, out_channels, kernel_size, dilation, separable):
+        """Return a dilated convolution of a branch, a Sequential of the
+        depthwise and pointwise convolutions if it is separable."""
+        padding = dilation * (kernel_size // 2)
+        if not separable:
+            return nn.Conv2d(in_channels, out_channels, kernel_size=kernel_size,
+                             padding=padding, dilation=dilation)
+        return nn.Sequential(
+            nn.Conv2d(in_channels, in_channels, kernel_size=kernel_size, padding=padding,
+                      dilation=dilation, groups=in_channels, bias=False),
+            nn.Conv2d(in_channels, out_channels, kernel_size=1))
+
+    def stem_names(self):
+        """Return the names of the convolutions preceding the branches."""
+        names = ['conv1a', 'conv1b', 'conv2a', 'conv2b']
+        if self.shared_reduction:
+            names.append('reduction')
+        return names
+
+    def branch_names(self):
+        """Return the names of the convolutions of each branch."""
+        return [['branch{}a'.format(idx), 'branch{}b'.format(idx)]
+                for idx in range(1, self.n_branches + 1)]
+
+    def conv_block(self, name, x):
+        """Apply the convolution, ReLU, BatchNorm and dropout of a layer."""
+        x = F.relu(getattr(self, name)(x))
+        x = getattr(self, name + '_bn')(x)
+        return getattr(self, name + '_drop')(x)
+
     def forward(self, x):
         """Model forward pass.
 
         :param x: input data.
         """
-        x = F.relu(self.conv1a(x))
-        x = self.conv1a_bn(x)
-        x = self.conv1a_drop(x)
-
-        x = F.relu(self.conv1b(x))
-        x = self.conv1b_bn(x)
-        x = self.conv1b_drop(x)
-
-        x = F.relu(self.conv2a(x))
-        x = self.conv2a_bn(x)
-        x = self.conv2a_drop(x)
-        x = F.relu(self.conv2b(x))
-        x = self.conv2b_bn(x)
-        x = self.conv2b_drop(x)
-
-        # Branch 1x1 convolution
-        branch1 = F.relu(self.branch1a(x))
-        branch1 = self.branch1a_bn(branch1)
-        branch1 = self.branch1a_drop(branch1)
-        branch1 = F.relu(self.branch1b(branch1))
-        branch1 = self.branch1b_bn(branch1)
-        branch1 = self.branch1b_drop(branch1)
-
-        # Branch for 3x3 rate 6
-        branch2 = F.relu(self.branch2a(x))
-        branch2 = self.branch2a_bn(branch2)
-        branch2 = self.branch2a_drop(branch2)
-        branch2 = F.relu(self.branch2b(branch2))
-        branch2 = self.branch2b_bn(branch2)
-        branch2 = self.branch2b_drop(branch2)
-
-        # Branch for 3x3 rate 6
-        branch3 = F.relu(self.branch3a(x))
-        branch3 = self.branch3a_bn(branch3)
-        branch3 = self.branch3a_drop(branch3)
-        branch3 = F.relu(self.branch3b(branch3))
-        branch3 = self.branch3b_bn(branch3)
-        branch3 = self.branch3b_drop(branch3)
-
-        # Branch for 3x3 rate 18
-        branch4 = F.relu(self.branch4a(x))
-        branch4 = self.branch4a_bn(branch4)
-        branch4 = self.branch4a_drop(branch4)
-        branch4 = F.relu(self.branch4b(branch4))
-        branch4 = self.branch4b_bn(branch4)
-        branch4 = self.branch4b_drop(branch4)
-
-        # Branch for 3x3 rate 24
-        branch5 = F.relu(self.branch5a(x))
-        branch5 = self.branch5a_bn(branch5)
-        branch5 = self.branch5a_drop(branch5)
-        branch5 = F.relu(self.branch5b(branch5))
-        branch5 = self.branch5b_bn(branch5)
-        branch5 = self.branch5b_drop(branch5)
+        for name in self.stem_names():
+            x = self.conv_block(name, x)
+
+        branches = []
+        for names in self.branch_names():
+            branch = x
+            for name in names:
+                branch = self.conv_block(name, branch)
+            branches.append(branch)
 
         # Global Average Pooling
         global_pool = F.avg_pool2d(x, kernel_size=x.size()[2:])
         global_pool = global_pool.expand(x.size())
 
-        concatenation = torch.cat([branch1,
-                                   branch2,
-                                   branch3,
-                                   branch4,
-                                   branch5,
-                                   global_pool], dim=1)
+        concatenation = torch.cat(branches + [global_pool], dim=1)
 
         concatenation = self.concat_bn(concatenation)
         concatenation = self.concat_drop(concatenation)
 
-        amort = F.relu(self.amort(concatenation))
-        amort = self.amort_bn(amort)
-        amort = self.amort_drop(amort)
+        amort = self.conv_block('amort', concatenation)
 
         predictions = self.prediction(amort)
-        predictions = F.sigmoid(predictions)
+        predictions = torch.sigmoid(predictions)
 
         return predictions
 
@@ -267,16 +254,39 @@ class UNet3D(nn.Module):
     """A reference of 3D U-Net model.
     Implementation origin :
     https://github.com/shiba24/3d-unet/blob/master/pytorch/model.py
+
+    The forward pass is split in stages (see :attr:`STAGES`), the stages
+    listed in checkpoint_stages don't keep their intermediate activations
+    during training, they are recomputed in the backward pass.
+
+    :param in_channel: the number of input channels.
+    :param n_classes: the number of output channels.
+    :param checkpoint_stages: the stages to checkpoint, 'all' or None.
+    :param inplace: if True, the LeakyReLUs are computed in place.
+
     .. seealso::
         Özgün Çiçek, Ahmed Abdulkadir, Soeren S. Lienkamp, Thomas Brox
         and Olaf Ronneberger (2016). 3D U-Net: Learning Dense Volumetric
         Segmentation from Sparse Annotation
         ArXiv link: https://arxiv.org/pdf/1606.06650.pdf
     """
-    def __init__(self, in_channel, n_classes):
+    STAGES = ('encoder0', 'encoder1', 'encoder2', 'bottom',
+              'decoder2', 'decoder1', 'decoder0')
+
+    def __init__(self, in_channel, n_classes, checkpoint_stages=None, inplace=False):
         self.in_channel = in_channel
         self.n_classes = n_classes
+        self.inplace = inplace
         super(UNet3D, self).__init__()
+
+        if checkpoint_stages == 'all':
+            checkpoint_stages = self.STAGES
+        self.checkpoint_stages = set(checkpoint_stages or [])
+        unknown = self.checkpoint_stages.difference(self.STAGES)
+        if unknown:
+            raise ValueError("Unknown stages {}, expected stages in {}.".format(
+                sorted(unknown), self.STAGES))
+
         self.ec0 = self.down_conv(self.in_channel, 32, bias=False, batchnorm=False)
         self.ec1 = self.down_conv(32, 64, bias=False, batchnorm=False)
         self.ec2 = self.down_conv(64, 64, bias=False, batchnorm=False)
@@ -308,11 +318,11 @@ class UNet3D(nn.Module):
             layer = nn.Sequential(
                 nn.Conv3d(in_channels, out_channels, kernel_size, stride=stride, padding=padding, bias=bias),
                 nn.BatchNorm2d(out_channels),
-                nn.LeakyReLU())
+                nn.LeakyReLU(inplace=self.inplace))
         else:
             layer = nn.Sequential(
                 nn.Conv3d(in_channels, out_channels, kernel_size, stride=stride, padding=padding, bias=bias),
-                nn.LeakyReLU())
+                nn.LeakyReLU(inplace=self.inplace))
         return layer
 
 
@@ -321,47 +331,55 @@ class UNet3D(nn.Module):
         layer = nn.Sequential(
             nn.ConvTranspose3d(in_channels, out_channels, kernel_size, stride=stride,
                                padding=padding, output_padding=output_padding, bias=bias),
-            nn.LeakyReLU())
+            nn.LeakyReLU(inplace=self.inplace))
         return layer
 
+    def encoder0(self, x):
+        return self.ec1(self.ec0(x))
+
+    def encoder1(self, syn0):
+        return self.ec3(self.ec2(self.pool0(syn0)))
+
+    def encoder2(self, syn1):
+        return self.ec5(self.ec4(self.pool1(syn1)))
+
+    def bottom(self, syn2):
+        return self.dc9(self.ec7(self.ec6(self.pool2(syn2))))
+
+    def decoder2(self, up, syn2):
+        return self.dc6(self.dc7(self.dc8(torch.cat((up, syn2), dim=1))))
+
+    def decoder1(self, up, syn1):
+        return self.dc3(self.dc4(self.dc5(torch.cat((up, syn1), dim=1))))
+
+    def decoder0(self, up, syn0):
+        return self.dc0(self.dc1(self.dc2(torch.cat((up, syn0), dim=1))))
+
+    def run_stage(self, name, *inputs):
+        """Run a stage, checkpointed if it is listed in checkpoint_stages
+        and the model is trained."""
+        stage = getattr(self, name)
+        if name not in self.checkpoint_stages or not self.training \
+                or not torch.is_grad_enabled():
+            return stage(*inputs)
+
+        if _CHECKPOINT_REENTRANT_ARG:
+            return checkpoint(stage, *inputs, use_reentrant=False)
+        # The reentrant checkpoint only backpropagates to the parameters
+        # when an input requires grad, which isn't the case of the input
+        # of the first stage: add a dummy one
+        dummy = torch.ones(1, requires_grad=True)
+        return checkpoint(lambda _, *args: stage(*args), dummy, *inputs)
+
     def forward(self, x):
-        e0 = self.ec0(x)
-        syn0 = self.ec1(e0)
-        e1 = self.pool0(syn0)
-        e2 = self.ec2(e1)
-        syn1 = self.ec3(e2)
-        del e0, e1, e2
-
-        e3 = self.pool1(syn1)
-        e4 = self.ec4(e3)
-        syn2 = self.ec5(e4)
-        del e3, e4
-
-        e5 = self.pool2(syn2)
-        e6 = self.ec6(e5)
-        e7 = self.ec7(e6)
-        del e5, e6
-
-        d9 = torch.cat((self.dc9(e7), syn2), dim=1)
-        del e7, syn2
-
-        d8 = self.dc8(d9)
-        d7 = self.dc7(d8)
-        del d9, d8
-
-        d6 = torch.cat((self.dc6(d7), syn1), dim=1)
-        del d7, syn1
-
-        d5 = self.dc5(d6)
-        d4 = self.dc4(d5)
-        del d6, d5
-
-        d3 = torch.cat((self.dc3(d4), syn0), dim=1)
-        del d4, syn0
-
-        d2 = self.dc2(d3)
-        d1 = self.dc1(d2)
-        del d3, d2
-
-        d0 = self.dc0(d1)
-        return d0
\ No newline at end of file
+        # Each activation is only referenced until its last use
+        syn0 = self.run_stage('encoder0', x)
+        syn1 = self.run_stage('encoder1', syn0)
+        syn2 = self.run_stage('encoder2', syn1)
+        up = self.run_stage('bottom', syn2)
+
+        up = self.run_stage('decoder2', up, syn2)
+        del syn2
+        up = self.run_stage('decoder1', up, syn1)
+        del syn1
+        return self.run_stage('decoder0', up, syn0)
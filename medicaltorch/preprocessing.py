@@ -0,0 +1,251 @@
+import argparse
+import csv
+import json
+import os
+from multiprocessing import Pool
+
+from tqdm import tqdm
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import zoom
+
+
+def resample_volume(data, zooms, spacing, order=1):
+    """Resample a volume to a new voxel spacing.
+
+    :param data: the volume (numpy array).
+    :param zooms: the current voxel dimensions in mm.
+    :param spacing: the new voxel dimensions in mm.
+    :param order: the spline interpolation order (0 for labels).
+    :returns: tuple (resampled volume, actual voxel dimensions).
+    """
+    factors = [float(z) / s for z, s in zip(zooms, spacing)]
+    resampled = zoom(data, factors, order=order)
+    new_zooms = [z * old / new for z, old, new in zip(zooms, data.shape, resampled.shape)]
+    return resampled, new_zooms
+
+
+def crop_or_pad(data, shape):
+    """Center crop or zero pad a volume to a new shape.
+
+    :param data: the volume (numpy array).
+    :param shape: the new shape, dimensions set to 0 or None are unchanged.
+    :returns: tuple (new volume, start index of the new volume in the
+              original one, negative when padding).
+    """
+    shape = [size or data_size for size, data_size in zip(shape, data.shape)]
+    starts = [(data_size - size) // 2 for size, data_size in zip(shape, data.shape)]
+
+    output = np.zeros(shape, dtype=data.dtype)
+    src, dst = [], []
+    for start, size, data_size in zip(starts, shape, data.shape):
+        src_start, src_stop = max(start, 0), min(start + size, data_size)
+        src.append(slice(src_start, src_stop))
+        dst.append(slice(src_start - start, src_stop - start))
+    output[tuple(dst)] = data[tuple(src)]
+    return output, starts
+
+
+def normalize_intensity(data, method='zscore', percentiles=(0.5, 99.5)):
+    """Normalize the intensities of a volume.
+
+    :param data: the volume (numpy array).
+    :param method: 'zscore', 'minmax', 'percentile' (clipping followed
+                   by min-max) or None.
+    :param percentiles: the percentiles of the 'percentile' method.
+    """
+    if method is None:
+        return data
+    if method == 'percentile':
+        low, high = np.percentile(data, percentiles)
+        data = np.clip(data, low, high)
+        method = 'minmax'
+    if method == 'zscore':
+        std = data.std()
+        return (data - data.mean()) / std if std > 0 else data - data.mean()
+    if method == 'minmax':
+        data_range = data.max() - data.min()
+        return (data - data.min()) / data_range if data_range > 0 else data - data.min()
+    raise ValueError("Unknown normalization method '{}'.".format(method))
+
+
+def preprocess_volume(input_filename, output_filename, spacing=None,
+                      crop=None, normalization=None, label=False):
+    """Reorient, resample, crop and normalize a volume and save it.
+
+    :param input_filename: the input filename (supported by nibabel).
+    :param output_filename: the output filename.
+    :param spacing: the new voxel dimensions in mm or None.
+    :param crop: the shape of the center crop or None.
+    :param normalization: the normalization method, see
+                          :func:`normalize_intensity`.
+    :param label: if True, the volume is a label volume (nearest
+                  neighbour interpolation and no normalization).
+    """
+    img = nib.as_closest_canonical(nib.load(input_filename))
+    if len(img.shape) > 3:
+        raise RuntimeError("4-dimensional volumes not supported.")
+
+    data = img.get_fdata(dtype=np.float32)
+    affine = img.affine.copy()
+    zooms = img.header.get_zooms()[:3]
+
+    if spacing is not None:
+        data, new_zooms = resample_volume(data, zooms, spacing, order=0 if label else 1)
+        affine[:3, :3] = affine[:3, :3] * (np.array(new_zooms) / np.array(zooms))
+
+    if crop is not None:
+        data, starts = crop_or_pad(data, crop)
+        affine[:3, 3] = affine[:3, :3].dot(starts) + affine[:3, 3]
+
+    if not label:
+        data = normalize_intensity(data, normalization)
+
+    output_img = nib.Nifti1Image(data.astype(np.float32), affine)
+    nib.save(output_img, output_filename)
+
+
+def _output_filename(output_dir, filename):
+    return os.path.join(output_dir, os.path.basename(filename))
+
+
+def _preprocess_subject(args):
+    subject, output_dir, params = args
+    entry = {}
+    for key in ('input', 'gt', 'roi'):
+        filenames = subject.get(key)
+        if not filenames:
+            entry[key] = None
+            continue
+
+        entry[key] = []
+        for filename in filenames:
+            output_filename = _output_filename(output_dir, filename)
+            preprocess_volume(filename, output_filename,
+                              spacing=params['spacing'], crop=params['crop'],
+                              normalization=params['normalization'],
+                              label=key != 'input')
+            entry[key].append(output_filename)
+    entry['source'] = subject
+    return entry
+
+
+def read_subjects(csv_filename):
+    """Read the subject list of a CSV file with an 'input' column and
+    optional 'gt' and 'roi' columns. Multiple files (modalities or
+    classes) in a column are separated by ';'.
+
+    :param csv_filename: the CSV filename.
+    """
+    subjects = []
+    with open(csv_filename) as fhandle:
+        for row in csv.DictReader(fhandle):
+            subjects.append({key: [f for f in (row.get(key) or '').split(';') if f]
+                             for key in ('input', 'gt', 'roi')})
+    return subjects
+
+
+def preprocess_dataset(subjects, output_dir, spacing=None, crop=None,
+                       normalization='zscore', num_workers=0, verbose=False):
+    """Preprocess all the volumes of the subjects once, with a process pool,
+    and write a manifest.json in the output directory, so that the training
+    transformations only need to do the augmentation.
+
+    :param subjects: a list of dicts with the 'input', 'gt' and 'roi'
+                     filename lists (see :func:`read_subjects`).
+    :param output_dir: the output directory.
+    :param spacing: the new voxel dimensions in mm or None.
+    :param crop: the shape of the center crop or None.
+    :param normalization: the normalization method of the inputs.
+    :param num_workers: number of processes, 0 to run in the main process.
+    :param verbose: if True, it will show a progress bar.
+    :returns: the manifest.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    output_filenames = [_output_filename(output_dir, filename)
+                        for subject in subjects for key in ('input', 'gt', 'roi')
+                        for filename in subject.get(key) or []]
+    if len(set(output_filenames)) != len(output_filenames):
+        raise RuntimeError("Filenames must be unique to be written in the same directory.")
+
+    params = {
+        'spacing': list(spacing) if spacing is not None else None,
+        'crop': list(crop) if crop is not None else None,
+        'normalization': normalization,
+    }
+    tasks = [(subject, output_dir, params) for subject in subjects]
+
+    if num_workers > 0:
+        pool = Pool(num_workers)
+        results = pool.imap(_preprocess_subject, tasks)
+    else:
+        pool = None
+        results = map(_preprocess_subject, tasks)
+
+    try:
+        entries = list(tqdm(results, total=len(tasks), desc="Preprocessing",
+                            disable=not verbose))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    manifest = {
+        'parameters': params,
+        'subjects': entries,
+    }
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as fhandle:
+        json.dump(manifest, fhandle, indent=2)
+    return manifest
+
+
+def load_manifest(manifest_filename):
+    """Return the filename pairs of a preprocessing manifest, in the format
+    expected by :class:`medicaltorch.datasets.MRI2DSegmentationDataset`.
+
+    :param manifest_filename: the manifest.json filename.
+    """
+    with open(manifest_filename) as fhandle:
+        manifest = json.load(fhandle)
+
+    filename_pairs = []
+    for entry in manifest['subjects']:
+        metadata = [{} for _ in entry['input']]
+        filename_pairs.append((entry['input'], entry['gt'], entry['roi'], metadata))
+    return filename_pairs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Reorient, resample, crop and normalize volumes once before training.")
+    parser.add_argument('subjects', help="CSV file with 'input', 'gt' and 'roi' columns, "
+                                         "multiple files separated by ';'.")
+    parser.add_argument('output_dir', help="output directory of the volumes and the manifest.")
+    parser.add_argument('--spacing', type=float, nargs='+',
+                        help="voxel dimensions in mm, a single value for isotropic resampling.")
+    parser.add_argument('--crop', type=int, nargs=3,
+                        help="shape of the center crop, 0 to keep a dimension.")
+    parser.add_argument('--normalization', default='zscore',
+                        choices=['zscore', 'minmax', 'percentile', 'none'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of processes.")
+    args = parser.parse_args(argv)
+
+    spacing = args.spacing
+    if spacing is not None:
+        if len(spacing) == 1:
+            spacing = spacing * 3
+        elif len(spacing) != 3:
+            parser.error("--spacing takes 1 or 3 values.")
+
+    normalization = None if args.normalization == 'none' else args.normalization
+    preprocess_dataset(read_subjects(args.subjects), args.output_dir,
+                       spacing=spacing, crop=args.crop,
+                       normalization=normalization,
+                       num_workers=args.workers, verbose=True)
+
+
+if __name__ == '__main__':
+    main()
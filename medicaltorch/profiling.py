@@ -0,0 +1,586 @@
+import collections
+import copy
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+from multiprocessing import util
+
+import numpy as np
+import torch
+
+
+def _max_rss():
+    """Return the peak resident set size of the current process in bytes."""
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _reset_peak():
+    """Make the tracemalloc peak restart from the current traced size."""
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        # Older Python versions: restart the traces from zero
+        tracemalloc.clear_traces()
+
+
+class InstrumentedCompose(object):
+    """Compose transforms like torchvision's Compose, recording the wall
+    time and the allocation size of each transform.
+
+    It can be used as the transform of a dataset loaded by DataLoader
+    workers: each worker sends its records to the main process through a
+    queue every `flush_every` samples and when it exits, where they are
+    aggregated by a background thread. Use :meth:`collect` after the
+    loading loop to wait for the last records.
+
+    The allocation size is the peak of the memory traced by tracemalloc
+    during the transform, it includes the numpy arrays and the PIL images
+    but not the torch tensors.
+
+    :param transforms: list of transforms to compose.
+    :param trace_memory: if True, tracemalloc is started to record the
+                         allocation sizes (it slows the transforms down).
+    :param flush_every: number of samples between two sends of a worker.
+    """
+
+    def __init__(self, transforms, trace_memory=True, flush_every=50):
+        self.transforms = transforms
+        self.trace_memory = trace_memory
+        self.flush_every = flush_every
+        self.names = ['{}:{}'.format(idx, type(t).__name__)
+                      for idx, t in enumerate(transforms)]
+
+        self._pid = os.getpid()
+        self._queue = multiprocessing.Queue()
+        self._lock = threading.Lock()
+        self._stats = self._empty_records()
+        self._pending = None
+        self._calls = 0
+        self._finalizer = None
+
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
+
+    def __getstate__(self):
+        # Only the queue and the configuration are sent to the workers
+        state = self.__dict__.copy()
+        for key in ('_lock', '_stats', '_receiver', '_finalizer'):
+            state[key] = None
+        return state
+
+    def _empty_records(self):
+        return collections.OrderedDict((name, {'time': [], 'memory': []})
+                                       for name in self.names)
+
+    def _merge(self, records):
+        with self._lock:
+            for name, record in records.items():
+                self._stats[name]['time'].extend(record['time'])
+                self._stats[name]['memory'].extend(record['memory'])
+
+    def _receive(self):
+        while True:
+            records = self._queue.get()
+            if records is None:
+                break
+            self._merge(records)
+
+    def flush(self):
+        """Send the pending records of a worker to the main process."""
+        if self._pending is not None and self._calls > 0:
+            self._queue.put(self._pending)
+            self._pending = self._empty_records()
+            self._calls = 0
+
+    def __call__(self, sample):
+        in_worker = os.getpid() != self._pid
+        if in_worker and self._finalizer is None:
+            # First call in this worker, flush before the queue is closed
+            self._pending = self._empty_records()
+            self._calls = 0
+            self._finalizer = util.Finalize(self, self.flush, exitpriority=100)
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        records = self._pending if in_worker else self._stats
+        for name, t in zip(self.names, self.transforms):
+            if self.trace_memory:
+                _reset_peak()
+                base, _ = tracemalloc.get_traced_memory()
+
+            start = time.perf_counter()
+            sample = t(sample)
+            records[name]['time'].append(time.perf_counter() - start)
+
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                records[name]['memory'].append(max(peak - base, 0))
+
+        if in_worker:
+            self._calls += 1
+            if self._calls >= self.flush_every:
+                self.flush()
+        return sample
+
+    def collect(self, timeout=1.0):
+        """Wait until the records sent by the workers are aggregated, or
+        until the timeout in seconds, and return the summary.
+
+        :param timeout: the maximum waiting time in seconds.
+        """
+        deadline = time.time() + timeout
+        while not self._queue.empty() and time.time() < deadline:
+            time.sleep(0.01)
+        return self.summary()
+
+    def reset(self):
+        """Clear the aggregated records."""
+        with self._lock:
+            self._stats = self._empty_records()
+
+    def close(self):
+        """Stop the thread aggregating the records of the workers."""
+        self._queue.put(None)
+        self._receiver.join()
+
+    def summary(self):
+        """Return an ordered dict with the call count, the total time (s),
+        the p50/p95 time (s) and the p50/p95 allocation size (bytes) of
+        each transform."""
+        summary = collections.OrderedDict()
+        with self._lock:
+            for name, record in self._stats.items():
+                times = np.array(record['time'])
+                memory = np.array(record['memory'])
+                summary[name] = {
+                    'calls': len(times),
+                    'total_time': float(times.sum()),
+                    'time_p50': float(np.percentile(times, 50)) if len(times) else 0.0,
+                    'time_p95': float(np.percentile(times, 95)) if len(times) else 0.0,
+                    'memory_p50': float(np.percentile(memory, 50)) if len(memory) else 0.0,
+                    'memory_p95': float(np.percentile(memory, 95)) if len(memory) else 0.0,
+                }
+        return summary
+
+    def report(self):
+        """Return the summary as a table, sorted by total time."""
+        summary = self.summary()
+        header = "{:<32} {:>8} {:>10} {:>9} {:>9} {:>12} {:>12}".format(
+            "transform", "calls", "total (s)", "p50 (ms)", "p95 (ms)",
+            "p50 (KiB)", "p95 (KiB)")
+        lines = [header, "-" * len(header)]
+        for name, stats in sorted(summary.items(), key=lambda item: -item[1]['total_time']):
+            lines.append("{:<32} {:>8d} {:>10.3f} {:>9.3f} {:>9.3f} {:>12.1f} {:>12.1f}".format(
+                name, stats['calls'], stats['total_time'],
+                stats['time_p50'] * 1e3, stats['time_p95'] * 1e3,
+                stats['memory_p50'] / 1024., stats['memory_p95'] / 1024.))
+        return "\n".join(lines)
+
+    def to_json(self, filename=None):
+        """Return the summary as JSON, and write it if filename is given.
+
+        :param filename: the output filename or None.
+        """
+        output = json.dumps(self.summary(), indent=2)
+        if filename is not None:
+            with open(filename, 'w') as fhandle:
+                fhandle.write(output)
+        return output
+
+
+def _train_step_worker(model_fn, input_shape, steps, result_queue):
+    try:
+        torch.manual_seed(0)
+        model = model_fn()
+        model.train()
+        input_data = torch.randn(*input_shape)
+        baseline = _max_rss()
+        # The first step allocates the gradients
+        model(input_data).float().mean().backward()
+
+        times = []
+        for _ in range(steps):
+            model.zero_grad()
+            start = time.perf_counter()
+            model(input_data).float().mean().backward()
+            times.append(time.perf_counter() - start)
+
+        peak = _max_rss()
+        result_queue.put({
+            'step_time': float(np.median(times)),
+            'peak_rss': peak,
+            'baseline_rss': baseline,
+        })
+    except Exception as e:
+        result_queue.put({'error': repr(e)})
+
+
+def measure_train_step(model_fn, input_shape, steps=3, timeout=None):
+    """Measure the median time and the peak resident memory of a training
+    step (forward and backward) in a fresh process, so that the memory
+    peak isn't hidden by a previous allocation of the caller.
+
+    The peak RSS includes the first step, which allocates the gradients.
+    The baseline RSS is measured once the model and the input are
+    allocated, the difference is the memory of the activations and of the
+    gradients.
+
+    :param model_fn: picklable callable returning the model, e.g.
+                     functools.partial(UNet3D, 1, 2, checkpoint_stages='all').
+    :param input_shape: the shape of the input batch.
+    :param steps: the number of timed steps.
+    :param timeout: maximum time in seconds, or None. The process is
+                    terminated when it is exceeded.
+    :returns: dict with the median 'step_time' (s), the 'peak_rss' and the
+              'baseline_rss' (bytes).
+    :raises RuntimeError: if the step fails, times out or if the process
+                          exits without a result (e.g. killed when out of
+                          memory).
+    """
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=_train_step_worker,
+                              args=(model_fn, tuple(input_shape), steps, result_queue))
+    process.start()
+    result = None
+    waited = 0.0
+    try:
+        while result is None:
+            try:
+                result = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    # The result may have been sent just before the exit
+                    try:
+                        result = result_queue.get(timeout=1.0)
+                    except queue.Empty:
+                        raise RuntimeError(
+                            "Training step process exited with code {} without "
+                            "a result.".format(process.exitcode))
+                waited += 1.0
+                if result is None and timeout is not None and waited >= timeout:
+                    raise RuntimeError("Training step timed out after {} seconds.".format(timeout))
+    finally:
+        if result is None and process.is_alive():
+            process.terminate()
+        process.join()
+    if 'error' in result:
+        raise RuntimeError("Training step failed: {}".format(result['error']))
+    return result
+
+
+def memory_time_table(configs, input_shape, steps=3, timeout=None):
+    """Measure a training step of several model configurations, see
+    :func:`measure_train_step`, and return the results and a table of the
+    peak memory and step time relative to the first configuration.
+
+    :param configs: ordered dict of configuration names and model_fn.
+    :param input_shape: the shape of the input batch.
+    :param steps: the number of timed steps.
+    :param timeout: maximum time in seconds per configuration, or None.
+    :returns: tuple (ordered dict of results, table).
+    """
+    results = collections.OrderedDict()
+    for name, model_fn in configs.items():
+        results[name] = measure_train_step(model_fn, input_shape, steps, timeout)
+
+    header = "{:<32} {:>12} {:>14} {:>10} {:>10} {:>10}".format(
+        "configuration", "peak (MiB)", "training (MiB)", "memory", "step (s)", "time")
+    lines = [header, "-" * len(header)]
+    reference = next(iter(results.values()), None)
+    for name, result in results.items():
+        training = result['peak_rss'] - result['baseline_rss']
+        reference_training = max(reference['peak_rss'] - reference['baseline_rss'], 1)
+        lines.append("{:<32} {:>12.1f} {:>14.1f} {:>9.2f}x {:>10.3f} {:>9.2f}x".format(
+            name, result['peak_rss'] / 2. ** 20, training / 2. ** 20,
+            training / float(reference_training),
+            result['step_time'], result['step_time'] / reference['step_time']))
+    return results, "\n".join(lines)
+
+
+def count_parameters(model, trainable_only=False):
+    """Return the number of parameters of a model.
+
+    :param model: the model.
+    :param trainable_only: if True, only the parameters requiring grad
+                           are counted.
+    """
+    return sum(param.numel() for param in model.parameters()
+               if param.requires_grad or not trainable_only)
+
+
+def _module_flops(module, inputs, output):
+    if isinstance(module, (torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d)):
+        # One multiply-accumulate per weight of a group and per output
+        kernel = int(np.prod(module.kernel_size)) * module.in_channels // module.groups
+        return 2 * output.numel() * kernel
+    if isinstance(module, (torch.nn.ConvTranspose1d, torch.nn.ConvTranspose2d,
+                           torch.nn.ConvTranspose3d)):
+        kernel = int(np.prod(module.kernel_size)) * module.out_channels // module.groups
+        return 2 * inputs[0].numel() * kernel
+    if isinstance(module, torch.nn.Linear):
+        return 2 * output.numel() * module.in_features
+    if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+        return 2 * output.numel()
+    return 0
+
+
+def count_flops(model, input_shape):
+    """Return the number of floating point operations of a forward pass,
+    counted by forward hooks on the convolutions (2 operations per
+    multiply-accumulate), the linear layers and the BatchNorms. The
+    activations, poolings and element-wise operations are not counted.
+
+    :param model: the model.
+    :param input_shape: the shape of the input batch.
+    """
+    flops = []
+
+    def hook(module, inputs, output):
+        flops.append(_module_flops(module, inputs, output))
+
+    handles = [module.register_forward_hook(hook) for module in model.modules()]
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.zeros(*input_shape))
+    finally:
+        model.train(training)
+        for handle in handles:
+            handle.remove()
+    return int(sum(flops))
+
+
+def model_cost_table(models, input_shape, repeats=3):
+    """Return the parameter count, the forward FLOPs and the median
+    forward time (eval mode, no grad) of model variants, and a table.
+
+    :param models: ordered dict of variant names and models.
+    :param input_shape: the shape of the input batch.
+    :param repeats: the number of timed forward passes.
+    :returns: tuple (ordered dict of results, table).
+    """
+    results = collections.OrderedDict()
+    for name, model in models.items():
+        training = model.training
+        model.eval()
+        input_data = torch.randn(*input_shape)
+        times = []
+        with torch.no_grad():
+            for _ in range(repeats):
+                start = time.perf_counter()
+                model(input_data)
+                times.append(time.perf_counter() - start)
+        model.train(training)
+
+        results[name] = {
+            'parameters': count_parameters(model),
+            'flops': count_flops(model, input_shape),
+            'forward_time': float(np.median(times)),
+        }
+
+    header = "{:<32} {:>14} {:>12} {:>12}".format(
+        "model", "parameters", "GFLOPs", "time (ms)")
+    lines = [header, "-" * len(header)]
+    for name, result in results.items():
+        lines.append("{:<32} {:>14,d} {:>12.2f} {:>12.1f}".format(
+            name, result['parameters'], result['flops'] / 1e9,
+            result['forward_time'] * 1e3))
+    return results, "\n".join(lines)
+
+
+# Number of optimizer state tensors per parameter
+_OPTIMIZER_STATES = {None: 0, 'sgd': 0, 'momentum': 1, 'rmsprop': 1, 'adam': 2, 'adamw': 2}
+
+
+def _storage(tensor):
+    """Return the (address, size in bytes) of the storage of a tensor."""
+    if hasattr(tensor, 'untyped_storage'):
+        storage = tensor.untyped_storage()
+        return storage.data_ptr(), storage.nbytes()
+    storage = tensor.storage()
+    return storage.data_ptr(), storage.size() * storage.element_size()
+
+
+def estimate_memory(model, input_shape, optimizer='adam'):
+    """Estimate the memory of a training step of a model from a forward
+    pass traced in training mode.
+
+    The activations are the distinct storages of the tensors that autograd
+    saves for the backward pass (including the outputs of the functional
+    operations such as F.relu or torch.cat), the parameters excepted. With
+    the torch versions without saved tensor hooks, they are the distinct
+    outputs of the leaf modules and the input. The transient buffers of the
+    backward pass are not counted. The running statistics of the
+    BatchNorms are restored after the trace.
+
+    :param model: the model.
+    :param input_shape: the shape of the input batch.
+    :param optimizer: the optimizer, its state tensors are counted:
+                      'sgd', 'momentum', 'rmsprop', 'adam', 'adamw' or None.
+    :returns: dict with the 'parameters', 'gradients', 'optimizer',
+              'activations' and 'total' memory in bytes.
+    """
+    if optimizer not in _OPTIMIZER_STATES:
+        raise ValueError("Unknown optimizer '{}'.".format(optimizer))
+
+    parameters = sum(param.numel() * param.element_size() for param in model.parameters())
+    gradients = sum(param.numel() * param.element_size()
+                    for param in model.parameters() if param.requires_grad)
+
+    excluded = set(_storage(param)[0] for param in model.parameters())
+    storages = {}
+    outputs = []
+
+    def pack(tensor):
+        address, size = _storage(tensor)
+        if address not in excluded:
+            storages[address] = size
+        return tensor
+
+    def hook(module, inputs, output):
+        input_ptrs = set(tensor.data_ptr() for tensor in inputs if torch.is_tensor(tensor))
+        tensors = output if isinstance(output, (list, tuple)) else [output]
+        for tensor in tensors:
+            # In-place modules return the storage of their input
+            if torch.is_tensor(tensor) and tensor.data_ptr() not in input_ptrs:
+                outputs.append(tensor.numel() * tensor.element_size())
+
+    saved_tensors_hooks = getattr(getattr(torch.autograd, 'graph', None),
+                                  'saved_tensors_hooks', None)
+    handles = []
+    if saved_tensors_hooks is None:
+        handles = [module.register_forward_hook(hook) for module in model.modules()
+                   if not list(module.children())]
+    # BatchNorm rebinds num_batches_tracked, the buffers are restored by name
+    state = copy.deepcopy(model.state_dict())
+    training = model.training
+    model.train()
+    try:
+        input_data = torch.zeros(*input_shape)
+        if saved_tensors_hooks is None:
+            outputs.append(input_data.numel() * input_data.element_size())
+            with torch.no_grad():
+                model(input_data)
+        else:
+            with torch.enable_grad(), saved_tensors_hooks(pack, lambda tensor: tensor):
+                output = model(input_data)
+            del output
+    finally:
+        model.train(training)
+        for handle in handles:
+            handle.remove()
+        model.load_state_dict(state)
+
+    result = {
+        'parameters': parameters,
+        'gradients': gradients,
+        'optimizer': gradients * _OPTIMIZER_STATES[optimizer],
+        'activations': sum(storages.values()) + sum(outputs),
+    }
+    result['total'] = sum(result.values())
+    return result
+
+
+def _validate_size(size, input_shape_fn, budget, fixed, model_fn, step, minimum):
+    """Decrease a size until a measured training step fits the budget."""
+    while size >= minimum:
+        try:
+            result = measure_train_step(model_fn, input_shape_fn(size), steps=1)
+        except RuntimeError:
+            # A step killed or failing (e.g. out of memory) doesn't fit
+            size -= step
+            continue
+        # The measured memory covers the activations and the gradients
+        measured = result['peak_rss'] - result['baseline_rss'] + fixed
+        if measured <= budget:
+            return size
+        size = min(size - step, int(size * budget / float(measured)) // step * step)
+    return None
+
+
+def find_max_batch_size(model, sample_shape, budget, optimizer='adam',
+                        max_batch_size=1024, model_fn=None):
+    """Return the largest batch size whose estimated training memory (see
+    :func:`estimate_memory`) fits a memory budget, or None.
+
+    The activations grow linearly with the batch size, they are estimated
+    for batches of 1 and 2 samples and extrapolated.
+
+    :param model: the model, e.g. :class:`medicaltorch.models.Unet`.
+    :param sample_shape: the shape of a sample, without the batch axis.
+    :param budget: the memory budget in bytes.
+    :param optimizer: the optimizer, see :func:`estimate_memory`.
+    :param max_batch_size: the largest batch size returned.
+    :param model_fn: if not None, picklable callable returning the model:
+                     the batch size is validated with a measured training
+                     step (see :func:`measure_train_step`) and decreased
+                     until it fits.
+    """
+    sample_shape = tuple(sample_shape)
+    one = estimate_memory(model, (1,) + sample_shape, optimizer)
+    two = estimate_memory(model, (2,) + sample_shape, optimizer)
+    per_sample = two['activations'] - one['activations']
+    fixed = one['total'] - per_sample
+
+    if fixed + per_sample > budget:
+        return None
+    batch_size = min(int((budget - fixed) // max(per_sample, 1)), max_batch_size)
+
+    if model_fn is not None:
+        fixed_params = one['parameters'] + one['optimizer']
+        batch_size = _validate_size(batch_size, lambda size: (size,) + sample_shape,
+                                    budget, fixed_params, model_fn, step=1, minimum=1)
+    return batch_size
+
+
+def find_max_patch_size(model, in_channels, budget, batch_size=1, optimizer='adam',
+                        multiple=8, max_length=512, model_fn=None):
+    """Return the largest length of cubic patches, a multiple of `multiple`,
+    whose estimated training memory (see :func:`estimate_memory`) fits a
+    memory budget, or None.
+
+    The activations grow linearly with the number of voxels, they are
+    estimated for two patch lengths and extrapolated.
+
+    :param model: the 3D model, e.g. :class:`medicaltorch.models.UNet3D`.
+    :param in_channels: the number of input channels.
+    :param budget: the memory budget in bytes.
+    :param batch_size: the batch size.
+    :param optimizer: the optimizer, see :func:`estimate_memory`.
+    :param multiple: the patch length must be a multiple of this value
+                     (8 for the 3 poolings of UNet3D).
+    :param max_length: the largest patch length returned.
+    :param model_fn: if not None, picklable callable returning the model:
+                     the patch length is validated with a measured
+                     training step and decreased until it fits.
+    """
+    def input_shape(length):
+        return (batch_size, in_channels, length, length, length)
+
+    small = estimate_memory(model, input_shape(multiple), optimizer)
+    large = estimate_memory(model, input_shape(2 * multiple), optimizer)
+    per_voxel = (large['activations'] - small['activations']) / float(7 * multiple ** 3)
+    fixed = small['total'] - per_voxel * multiple ** 3
+
+    if small['total'] > budget:
+        return None
+    length = int(((budget - fixed) / max(per_voxel, 1e-12)) ** (1. / 3))
+    length = max(min(length // multiple * multiple, max_length // multiple * multiple),
+                 multiple)
+
+    if model_fn is not None:
+        fixed_params = small['parameters'] + small['optimizer']
+        length = _validate_size(length, input_shape, budget, fixed_params, model_fn,
+                                step=multiple, minimum=multiple)
+    return length
@@ -0,0 +1,251 @@
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn import Module
+from torch.nn.quantized import FloatFunctional
+from torch.quantization import DeQuantStub, QuantStub
+
+from medicaltorch import losses as mt_losses
+from medicaltorch import models as mt_models
+from medicaltorch.inference import fold_bn_into_next_conv
+
+
+class QuantizableConvBlock(Module):
+    """A conv -> ReLU -> BatchNorm block whose convolution and ReLU are
+    fused for the quantization (the BatchNorm following the ReLU can't be
+    folded in the int8 convolution, it is kept as a quantized BatchNorm).
+
+    :param conv: the convolution, or a Sequential ending with the convolution.
+    :param bn: the BatchNorm following the ReLU.
+    """
+
+    def __init__(self, conv, bn):
+        super().__init__()
+        self.conv = copy.deepcopy(conv)
+        self.relu = nn.ReLU()
+        self.bn = copy.deepcopy(bn)
+
+    def forward(self, x):
+        return self.bn(self.relu(self.conv(x)))
+
+    def fuse(self):
+        # The ReLU follows the last convolution of a separable convolution
+        conv_name = 'conv'
+        if isinstance(self.conv, nn.Sequential):
+            conv_name = 'conv.{}'.format(len(self.conv) - 1)
+        torch.quantization.fuse_modules(self, [[conv_name, 'relu']], inplace=True)
+
+
+class QuantizableDownConv(Module):
+    """Quantizable form of :class:`medicaltorch.models.DownConv`."""
+
+    def __init__(self, down_conv):
+        super().__init__()
+        self.conv1 = QuantizableConvBlock(down_conv.conv1, down_conv.conv1_bn)
+        self.conv2 = QuantizableConvBlock(down_conv.conv2, down_conv.conv2_bn)
+
+    def forward(self, x):
+        return self.conv2(self.conv1(x))
+
+
+class QuantizableUpConv(Module):
+    """Quantizable form of :class:`medicaltorch.models.UpConv`."""
+
+    def __init__(self, up_conv):
+        super().__init__()
+        self.downconv = QuantizableDownConv(up_conv.downconv)
+        self.concat = FloatFunctional()
+
+    def forward(self, x, y):
+        x = F.interpolate(x, scale_factor=2.0, mode='bilinear', align_corners=True)
+        x = self.concat.cat([x, y], dim=1)
+        return self.downconv(x)
+
+
+class QuantizableUnet(Module):
+    """Quantizable form of :class:`medicaltorch.models.Unet`, without the
+    dropouts. The input is quantized by a QuantStub and the logits are
+    dequantized before the sigmoid.
+
+    :param model: the trained Unet, it is not modified.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+
+        self.conv1 = QuantizableDownConv(model.conv1)
+        self.mp1 = nn.MaxPool2d(2)
+        self.conv2 = QuantizableDownConv(model.conv2)
+        self.mp2 = nn.MaxPool2d(2)
+        self.conv3 = QuantizableDownConv(model.conv3)
+        self.mp3 = nn.MaxPool2d(2)
+        self.conv4 = QuantizableDownConv(model.conv4)
+
+        self.up1 = QuantizableUpConv(model.up1)
+        self.up2 = QuantizableUpConv(model.up2)
+        self.up3 = QuantizableUpConv(model.up3)
+
+        self.conv9 = copy.deepcopy(model.conv9)
+
+    def forward(self, x):
+        x1 = self.conv1(self.quant(x))
+        x3 = self.conv2(self.mp1(x1))
+        x5 = self.conv3(self.mp2(x3))
+        x7 = self.conv4(self.mp3(x5))
+
+        x8 = self.up1(x7, x5)
+        x9 = self.up2(x8, x3)
+        x10 = self.up3(x9, x1)
+
+        return torch.sigmoid(self.dequant(self.conv9(x10)))
+
+
+class QuantizableNoPoolASPP(Module):
+    """Quantizable form of :class:`medicaltorch.models.NoPoolASPP`, without
+    the dropouts and with the BatchNorm of the concatenation folded in the
+    amortization convolution. The input is quantized by a QuantStub and
+    the logits are dequantized before the sigmoid.
+
+    :param model: the trained NoPoolASPP, it is not modified.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+
+        self.stem = nn.Sequential(*[QuantizableConvBlock(getattr(model, name),
+                                                         getattr(model, name + '_bn'))
+                                    for name in model.stem_names()])
+        self.branches = nn.ModuleList()
+        for names in model.branch_names():
+            self.branches.append(nn.Sequential(*[QuantizableConvBlock(getattr(model, name),
+                                                                      getattr(model, name + '_bn'))
+                                                 for name in names]))
+        self.concat = FloatFunctional()
+        self.amort = QuantizableConvBlock(fold_bn_into_next_conv(model.concat_bn, model.amort),
+                                          model.amort_bn)
+        self.prediction = copy.deepcopy(model.prediction)
+
+    def forward(self, x):
+        x = self.stem(self.quant(x))
+        outputs = []
+        for branch in self.branches:
+            outputs.append(branch(x))
+        # Global Average Pooling, broadcast with a nearest upsampling
+        # which is supported by the quantized tensors
+        global_pool = F.adaptive_avg_pool2d(x, 1)
+        outputs.append(F.interpolate(global_pool, size=x.shape[2:], mode='nearest'))
+
+        x = self.amort(self.concat.cat(outputs, dim=1))
+        return torch.sigmoid(self.dequant(self.prediction(x)))
+
+
+def make_quantizable(model):
+    """Return the quantizable float copy of a :class:`medicaltorch.models.Unet`
+    or :class:`medicaltorch.models.NoPoolASPP`, in eval mode, with its
+    convolutions and ReLUs fused.
+
+    :param model: the trained model, it is not modified.
+    """
+    if isinstance(model, mt_models.NoPoolASPP):
+        quantizable = QuantizableNoPoolASPP(model)
+    elif isinstance(model, mt_models.Unet):
+        quantizable = QuantizableUnet(model)
+    else:
+        raise TypeError("Unsupported model {}.".format(type(model).__name__))
+
+    quantizable.eval()
+    for module in quantizable.modules():
+        if isinstance(module, QuantizableConvBlock):
+            module.fuse()
+    return quantizable
+
+
+def _batch_input(batch):
+    input_data = batch['input']
+    if isinstance(input_data, (list, tuple)):
+        input_data = torch.cat(input_data, dim=1)
+    return input_data
+
+
+def calibrate(model, loader, num_batches=16):
+    """Run batches through a prepared model so that its observers record
+    the activation ranges.
+
+    :param model: the model prepared by torch.quantization.prepare.
+    :param loader: the loader of the calibration batches, e.g. a DataLoader
+                   of :class:`medicaltorch.datasets.MRI2DSegmentationDataset`
+                   with :func:`medicaltorch.datasets.mt_collate`.
+    :param num_batches: the number of batches, None for the whole loader.
+    """
+    with torch.no_grad():
+        for idx, batch in enumerate(loader):
+            if num_batches is not None and idx >= num_batches:
+                break
+            model(_batch_input(batch))
+
+
+def quantize_model(model, calibration_loader, num_batches=16, backend='fbgemm'):
+    """Return a static int8 version of a :class:`medicaltorch.models.Unet`
+    or :class:`medicaltorch.models.NoPoolASPP` for CPU inference, with the
+    activation ranges calibrated on sample batches.
+
+    :param model: the trained model, it is not modified.
+    :param calibration_loader: the loader of the calibration batches, see
+                               :func:`calibrate`.
+    :param num_batches: the number of calibration batches.
+    :param backend: the quantized engine, 'fbgemm' (x86) or 'qnnpack'
+                    (ARM).
+    """
+    torch.backends.quantized.engine = backend
+    quantized = make_quantizable(model)
+    quantized.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(quantized, inplace=True)
+    calibrate(quantized, calibration_loader, num_batches)
+    torch.quantization.convert(quantized, inplace=True)
+    return quantized
+
+
+def dice_drift(reference_model, quantized_model, loader, threshold=0.5, num_batches=None):
+    """Compare the Dice scores of the predictions of a quantized model and
+    of its float reference on a validation set.
+
+    :param reference_model: the float model, in eval mode.
+    :param quantized_model: the quantized model.
+    :param loader: the loader of the validation batches, with the 'input'
+                   and 'gt' tensors.
+    :param threshold: the threshold of the predicted masks.
+    :param num_batches: the number of batches, None for the whole loader.
+    :returns: dict with the mean Dice of both models ('dice_reference',
+              'dice_quantized'), the mean and worst per-sample Dice drift
+              ('drift', 'max_drop') and the mean Dice between the masks
+              of both models ('agreement').
+    """
+    dice_reference, dice_quantized, agreement = [], [], []
+    with torch.no_grad():
+        for idx, batch in enumerate(loader):
+            if num_batches is not None and idx >= num_batches:
+                break
+            input_data = _batch_input(batch)
+            gt_data = batch['gt'].float()
+            reference = (reference_model(input_data) > threshold).float()
+            quantized = (quantized_model(input_data) > threshold).float()
+            for i in range(input_data.size(0)):
+                dice_reference.append(-mt_losses.dice_loss(reference[i], gt_data[i]).item())
+                dice_quantized.append(-mt_losses.dice_loss(quantized[i], gt_data[i]).item())
+                agreement.append(-mt_losses.dice_loss(quantized[i], reference[i]).item())
+
+    drift = np.array(dice_quantized) - np.array(dice_reference)
+    return {
+        'dice_reference': float(np.mean(dice_reference)),
+        'dice_quantized': float(np.mean(dice_quantized)),
+        'drift': float(drift.mean()),
+        'max_drop': float(-drift.min()),
+        'agreement': float(np.mean(agreement)),
+    }
@@ -1,17 +1,130 @@
+import contextlib
 import numbers
+import threading
 
 import numpy as np
 import skimage
 import torch
 import torchvision.transforms.functional as F
 from PIL import Image
-from scipy.ndimage import center_of_mass
+from scipy.ndimage import affine_transform, center_of_mass, zoom
 from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage.interpolation import map_coordinates
 from torchvision import transforms
 
 
+_rng_state = threading.local()
+
+
+def sample_rng(seed, epoch, index, stream=0):
+    """Return the counter-based random generator of a sample.
+
+    The stream only depends on (seed, epoch, index), so the augmentation
+    of a sample doesn't depend on the worker scheduling and an interrupted
+    epoch can be resumed exactly.
+
+    :param seed: the seed of the experiment.
+    :param epoch: the epoch number.
+    :param index: the index of the sample in the dataset.
+    :param stream: the stream number, the generators of different streams
+                   are independent for the same (seed, epoch, index).
+    """
+    return np.random.Generator(np.random.Philox(key=seed,
+                                                counter=[0, stream, index, epoch]))
+
+
+@contextlib.contextmanager
+def sample_rng_context(rng):
+    """Context manager making the random transforms draw from rng
+    instead of the global numpy random state.
+
+    :param rng: the random generator, see :func:`sample_rng`.
+    """
+    previous_rng = getattr(_rng_state, 'rng', None)
+    _rng_state.rng = rng
+    try:
+        yield rng
+    finally:
+        _rng_state.rng = previous_rng
+
+
+def get_rng():
+    """Return the random generator to be used by the random transforms:
+    the one set by :func:`sample_rng_context` or the global numpy random
+    state."""
+    rng = getattr(_rng_state, 'rng', None)
+    return np.random if rng is None else rng
+
+
+def standard_normal(shape):
+    """Draw float32 standard normal values from the generator returned by
+    :func:`get_rng`, without a float64 intermediate when it's possible."""
+    rng = get_rng()
+    if isinstance(rng, np.random.Generator):
+        return rng.standard_normal(shape, dtype=np.float32)
+    return rng.standard_normal(shape).astype(np.float32)
+
+
+def label_map_classes(sample):
+    """Return the number of classes when the ground truth of a sample is a
+    single label map (see the label_map option of the 2D datasets), or
+    None when it has one mask per class."""
+    gt_metadata = sample.get('gt_metadata')
+    if not gt_metadata:
+        return None
+    if isinstance(gt_metadata, list):
+        gt_metadata = gt_metadata[0]
+    if gt_metadata is None or '__label_map' not in gt_metadata:
+        return None
+    return gt_metadata['__label_map']
+
+
+def _rotation_matrix(angle, center):
+    """Return the 3x3 matrix of a counter-clockwise rotation (as
+    PIL.Image.rotate) in degrees around center, in pixel coordinates (x, y)."""
+    angle = np.deg2rad(angle)
+    cos, sin = np.cos(angle), np.sin(angle)
+    cx, cy = center
+    return np.array([[cos, sin, cx - cos * cx - sin * cy],
+                     [-sin, cos, cy + sin * cx - cos * cy],
+                     [0., 0., 1.]])
+
+
+def _affine_matrix(angle, translations, scale, shear, center):
+    """Return the 3x3 matrix of the affine transformation of
+    :class:`RandomAffine`: rotation, scale and shear around center followed
+    by a translation, in pixel coordinates (x, y)."""
+    angle, shear = np.deg2rad(angle), np.deg2rad(shear)
+    rss = np.array([[np.cos(angle), -np.sin(angle + shear)],
+                    [np.sin(angle), np.cos(angle + shear)]]) * scale
+    center = np.asarray(center, dtype=np.float64)
+    matrix = np.eye(3)
+    matrix[:2, :2] = rss
+    matrix[:2, 2] = center + np.asarray(translations) - rss.dot(center)
+    return matrix
+
+
+def _warp_image(img, matrix, size, resample, fillcolor=0):
+    """Warp a PIL image with the forward matrix in a single interpolation."""
+    coeffs = np.linalg.inv(matrix)[:2].ravel()
+    return img.transform(size, Image.AFFINE, tuple(coeffs), resample=resample,
+                         fillcolor=fillcolor)
+
+
 class MTTransform(object):
+    """Base class of the transforms.
+
+    The representations ('pil', 'numpy' or 'tensor') of the images a
+    transform works on are declared for :func:`plan_conversions`:
+
+    - `accepts` maps each accepted representation to the number of full
+      copies of each image the transform makes from it, None means any
+      representation without copy.
+    - `produces` is the representation of the output images, None means
+      the representation of the input images.
+    """
+    accepts = None
+    produces = None
 
     def __call__(self, sample):
         raise NotImplementedError("You need to implement the transform() method.")
@@ -20,14 +133,22 @@ class MTTransform(object):
         raise NotImplementedError("You need to implement the undo_transform() method.")
 
 
+def _metadata_item(metadata, i):
+    """Return the metadata of the i-th image, the metadata being a list
+    (one per image) or a single metadata shared by all the images."""
+    return metadata[i] if isinstance(metadata, list) else metadata
+
+
 class UndoCompose(object):
+    """Undo the transforms of a Compose, in reverse order."""
+
     def __init__(self, compose):
         self.transforms = compose.transforms
 
-    def __call__(self):
-        for t in self.transforms:
-            img = t.undo_transform(img)
-        return img
+    def __call__(self, sample):
+        for t in reversed(self.transforms):
+            sample = t.undo_transform(sample)
+        return sample
 
 
 class UndoTransform(object):
@@ -38,39 +159,158 @@ class UndoTransform(object):
         return self.transform.undo_transform(sample)
 
 
+class FusedGeometricCompose(MTTransform):
+    """Compose transforms like torchvision's Compose, but consecutive
+    geometric transforms (the ones implementing get_affine_matrix(), i.e.
+    :class:`CenterCrop2D`, :class:`RandomRotation`, :class:`RandomAffine`
+    and :class:`Resample`) are fused: their matrices are multiplied and the
+    images are resampled only once. The composed matrices are recorded in
+    the metadata under '__fused_affine' so that the chain can be inverted.
+
+    :param transforms: the list of transforms to compose.
+    :param interpolation: the interpolation of the inputs, the labels and
+                          the ROI use nearest neighbour.
+    :param labeled: if True, the ground truth is also transformed.
+    """
+
+    def __init__(self, transforms, interpolation=Image.BILINEAR, labeled=True):
+        self.transforms = transforms
+        self.interpolation = interpolation
+        self.labeled = labeled
+
+    @staticmethod
+    def is_geometric(transform):
+        return hasattr(transform, 'get_affine_matrix')
+
+    def groups(self):
+        """Return the list of (fused, transforms) groups of the chain."""
+        groups = []
+        for transform in self.transforms:
+            fused = self.is_geometric(transform)
+            if groups and groups[-1][0] == fused:
+                groups[-1][1].append(transform)
+            else:
+                groups.append((fused, [transform]))
+        return groups
+
+    @staticmethod
+    def _record(sample, params):
+        for key in ('input_metadata', 'gt_metadata'):
+            for metadata in sample.get(key) or []:
+                if '__fused_affine' not in metadata:
+                    metadata['__fused_affine'] = []
+                metadata['__fused_affine'].append(params)
+
+    def _warp(self, sample, matrix, size, gt_resample=Image.NEAREST):
+        rdict = {}
+        rdict['input'] = [_warp_image(item, matrix, size, self.interpolation)
+                          for item in sample['input']]
+        if self.labeled and sample.get('gt') is not None:
+            rdict['gt'] = [_warp_image(item, matrix, size, gt_resample)
+                           for item in sample['gt']]
+        if sample.get('roi') is not None:
+            rdict['roi'] = [_warp_image(item, matrix, size, Image.NEAREST)
+                            for item in sample['roi']]
+        sample.update(rdict)
+        return sample
+
+    def fused_transform(self, transforms, sample):
+        """Apply a group of geometric transforms with a single resampling."""
+        input_size = sample['input'][0].size
+        size = input_size
+        matrix = np.eye(3)
+        for transform in transforms:
+            transform_matrix, size = transform.get_affine_matrix(sample, size)
+            matrix = transform_matrix.dot(matrix)
+
+        self._record(sample, (matrix, input_size, size))
+        return self._warp(sample, matrix, size)
+
+    def __call__(self, sample):
+        for fused, transforms in self.groups():
+            if fused:
+                sample = self.fused_transform(transforms, sample)
+            else:
+                for transform in transforms:
+                    sample = transform(sample)
+        return sample
+
+    def undo_transform(self, sample):
+        for fused, transforms in reversed(self.groups()):
+            if not fused:
+                for transform in reversed(transforms):
+                    sample = transform.undo_transform(sample)
+                continue
+
+            matrix, input_size, _ = sample['input_metadata'][0]['__fused_affine'][-1]
+            for key in ('input_metadata', 'gt_metadata'):
+                for metadata in sample.get(key) or []:
+                    metadata['__fused_affine'].pop()
+            # Predictions are interpolated, they aren't binary masks
+            sample = self._warp(sample, np.linalg.inv(matrix), input_size,
+                                gt_resample=self.interpolation)
+        return sample
+
+
 class ToTensor(MTTransform):
-    """Convert a PIL image(s) or numpy array(s) to a PyTorch tensor(s)."""
+    """Convert a PIL image(s) or numpy array(s) to a PyTorch tensor(s).
+
+    Numpy arrays are converted to float32 (uint8 arrays are divided by
+    255) and copied, since they may be views of cached volumes. As with
+    torchvision, 2D arrays get a channel axis and 3D arrays are
+    transposed from (H, W, C) to (C, H, W).
+    """
+    accepts = {'pil': 1, 'numpy': 1}
+    produces = 'tensor'
 
     def __init__(self, labeled=True):
         self.labeled = labeled
 
+    @staticmethod
+    def to_tensor(data):
+        if not isinstance(data, np.ndarray):
+            return F.to_tensor(data)
+        if data.ndim == 2:
+            data = data[:, :, None]
+        data = data.transpose((2, 0, 1))
+        if data.dtype == np.uint8:
+            return torch.from_numpy(np.ascontiguousarray(data)).float().div_(255)
+        # np.array always copies
+        return torch.from_numpy(np.array(data, dtype=np.float32, order='C'))
+
     def __call__(self, sample):
         rdict = {}
         input_data = sample['input']
 
         if len(input_data) > 1:
             # Multiple inputs
-            ret_input = [F.to_tensor(item) for item in input_data]
+            ret_input = [self.to_tensor(item) for item in input_data]
         else:
             # single input
-            ret_input = F.to_tensor(input_data[0])
+            ret_input = self.to_tensor(input_data[0])
 
         rdict['input'] = ret_input
 
+        n_classes = label_map_classes(sample)
         if self.labeled:
             gt_data = sample['gt']
-            if gt_data is not None:
+            if gt_data is not None and n_classes is not None:
+                # Expand the label map to one channel per class
+                label_map = torch.from_numpy(np.array(gt_data[0], dtype=np.int64))
+                classes = torch.arange(1, n_classes + 1).view(-1, 1, 1)
+                rdict['gt'] = (label_map.unsqueeze(0) == classes).float()
+            elif gt_data is not None:
                 if isinstance(gt_data, list):
                     # Add dim 0 for 3D images
                     if gt_data[0].size == 3:
                         ret_gt = [gt.unsqueeze(0) for gt in sample['gt']]
 
                     # multiple GT
-                    ret_gt = torch.cat([F.to_tensor(item) for item in gt_data], dim=0)
+                    ret_gt = torch.cat([self.to_tensor(item) for item in gt_data], dim=0)
 
                 else:
                     # single GT
-                    ret_gt = F.to_tensor(gt_data)
+                    ret_gt = self.to_tensor(gt_data)
 
                 rdict['gt'] = ret_gt
                 
@@ -79,17 +319,24 @@ class ToTensor(MTTransform):
 
 
 class ToPIL(MTTransform):
+    """Convert numpy array(s) or PyTorch tensor(s) to PIL image(s), uint8
+    data is converted to 'L' images and the rest to 'F' images."""
+    accepts = {'numpy': 1, 'tensor': 1}
+    produces = 'pil'
+
     def __init__(self, labeled=True):
         self.labeled = labeled
 
     def sample_transform(self, sample_data):
         # Numpy array
         if not isinstance(sample_data, np.ndarray):
-            input_data_npy = sample_data.numpy()
+            input_data_npy = sample_data.squeeze(0).numpy()
         else:
             input_data_npy = sample_data
 
-        input_data = Image.fromarray(input_data_npy, mode='F')
+        if input_data_npy.dtype == np.uint8:
+            return Image.fromarray(input_data_npy, mode='L')
+        input_data = Image.fromarray(input_data_npy.astype(np.float32, copy=False), mode='F')
         return input_data
 
     def __call__(self, sample):
@@ -109,12 +356,49 @@ class ToPIL(MTTransform):
         return sample
 
 
+class ToNumpy(MTTransform):
+    """Convert PIL image(s) or PyTorch tensor(s) to numpy array(s), 'F'
+    images give float32 arrays and 'L' images uint8 arrays. Tensors are
+    converted without copy."""
+    accepts = {'pil': 1, 'numpy': 0, 'tensor': 0}
+    produces = 'numpy'
+
+    def __init__(self, labeled=True):
+        self.labeled = labeled
+
+    def sample_transform(self, sample_data):
+        if isinstance(sample_data, np.ndarray):
+            return sample_data
+        if isinstance(sample_data, torch.Tensor):
+            return sample_data.squeeze(0).numpy()
+        return np.array(sample_data)
+
+    def __call__(self, sample):
+        rdict = {}
+        input_data = sample['input']
+        if isinstance(input_data, list):
+            rdict['input'] = [self.sample_transform(item) for item in input_data]
+        else:
+            rdict['input'] = self.sample_transform(input_data)
+
+        if self.labeled and sample.get('gt') is not None:
+            gt_data = sample['gt']
+            if isinstance(gt_data, list):
+                rdict['gt'] = [self.sample_transform(item) for item in gt_data]
+            else:
+                rdict['gt'] = self.sample_transform(gt_data)
+
+        sample.update(rdict)
+        return sample
+
+
 class StackTensors(MTTransform):
     """
     Stack all modalities in a single vector.
 
     TODO: add reverse transformation
     """
+    accepts = {'tensor': 1}
 
     def __call__(self, sample):
         rdict = {}
@@ -136,6 +420,7 @@ class Crop2D(MTTransform):
                          When this is True (default), the crop
                          will also be applied to the ground truth.
     """
+    accepts = {'pil': 1}
 
     def __init__(self, size, labeled=True):
         self.size = size
@@ -149,7 +434,8 @@ class Crop2D(MTTransform):
 
     @staticmethod
     def get_params(sample):
-        return [sample['input_metadata'][i]["__centercrop"] for i in range(len(sample))]
+        return [_metadata_item(sample['input_metadata'], i)["__centercrop"]
+                for i in range(len(sample['input']))]
 
     def undo_transform(self, sample):
         rdict = {}
@@ -202,21 +488,40 @@ class CenterCrop2D(Crop2D):
 
         rdict['input'] = input_data
 
-        gt_data = sample['gt']
-        gt_metadata = sample['gt_metadata']
-        for i in range(len(gt_data)):
-            w, h = gt_data[i].size
-            fh = int(round((h - th) / 2.))
-            fw = int(round((w - tw) / 2.))
+        if self.labeled:
+            gt_data = sample['gt']
+            gt_metadata = sample['gt_metadata']
+            for i in range(len(gt_data)):
+                w, h = gt_data[i].size
+                fh = int(round((h - th) / 2.))
+                fw = int(round((w - tw) / 2.))
 
-            gt_data[i] = F.center_crop(gt_data[i], self.size)
-            gt_metadata[i]["__centercrop"] = (fh, fw, w, h)
-        rdict['gt'] = gt_data
-        rdict['gt_metadata'] = gt_metadata
+                gt_data[i] = F.center_crop(gt_data[i], self.size)
+                gt_metadata[i]["__centercrop"] = (fh, fw, w, h)
+            rdict['gt'] = gt_data
+            rdict['gt_metadata'] = gt_metadata
 
         sample.update(rdict)
         return sample
 
+    def get_affine_matrix(self, sample, size):
+        """Return the forward matrix of the crop and the output size, see
+        :class:`FusedGeometricCompose`.
+
+        :param size: the current (width, height) of the images.
+        """
+        w, h = size
+        th, tw = self.size
+        fh = int(round((h - th) / 2.))
+        fw = int(round((w - tw) / 2.))
+        for i in range(len(sample['input'])):
+            self.propagate_params(sample, (fh, fw, w, h), i)
+
+        matrix = np.eye(3)
+        matrix[0, 2] = -fw
+        matrix[1, 2] = -fh
+        return matrix, (tw, th)
+
     # Reverse transformation. Implemented by @Charleygros
     def _uncrop(self, data, params):
         fh, fw, w, h = params
@@ -233,19 +538,28 @@ class CenterCrop2D(Crop2D):
         if isinstance(sample['input'], list):
             rdict['input'] = sample['input']
             for i in range(len(sample['input'])):
-                rdict['input'][i] = self._uncrop(sample['input'][i], sample['input_metadata']["__centercrop"])
+                params = _metadata_item(sample['input_metadata'], i)["__centercrop"]
+                rdict['input'][i] = self._uncrop(sample['input'][i], params)
         else:
             rdict['input'] = self._uncrop(sample['input'], sample['input_metadata']["__centercrop"])
 
-        rdict['gt'] = sample['gt']
-        for i in range(len(sample['gt'])):
-            rdict['gt'][i] = self._uncrop(sample['gt'][i], sample['input_metadata']["__centercrop"])
+        if self.labeled and sample.get('gt') is not None:
+            rdict['gt'] = sample['gt']
+            gt_metadata = sample.get('gt_metadata') or sample['input_metadata']
+            for i in range(len(sample['gt'])):
+                params = _metadata_item(gt_metadata, i)["__centercrop"]
+                rdict['gt'][i] = self._uncrop(sample['gt'][i], params)
         sample.update(rdict)
         return sample
 
 
 class ROICrop2D(Crop2D):
     """Make a crop of a specified size around a ROI.
+
+    The crop is centered on the ROI centroid precomputed by
+    :class:`medicaltorch.datasets.MRI2DSegmentationDataset`, the center
+    of mass of the ROI is only computed when it is not available.
+
     :param labeled: if it is a segmentation task.
                          When this is True (default), the crop
                          will also be applied to the ground truth.
@@ -254,37 +568,151 @@ class ROICrop2D(Crop2D):
     def __init__(self, size, labeled=True):
         super().__init__(size, labeled)
 
+    @staticmethod
+    def get_roi_center(sample):
+        """Return the (row, col) center of the ROI of the sample in the
+        current image space, or None for an empty ROI."""
+        roi_data = sample['roi']
+        roi_metadata = sample.get('roi_metadata')
+        w, h = roi_data[0].size
+
+        if roi_metadata and '__roi_center' in roi_metadata[0]:
+            center = roi_metadata[0]['__roi_center']
+            if center is None:
+                return None
+            # Rescale the center if the ROI was resampled meanwhile
+            shape_h, shape_w = roi_metadata[0]['__roi_shape']
+            return center[0] * h / shape_h, center[1] * w / shape_w
+
+        roi_array = np.array(roi_data[0])
+        if not roi_array.any():
+            return None
+        return center_of_mass(roi_array)
+
     def __call__(self, sample):
         rdict = {}
         input_data = sample['input']
-        roi_data = sample['roi']
-
-        # compute center of mass of the ROI
-        x_roi, y_roi = center_of_mass(np.array(roi_data).astype(np.int))
-        x_roi, y_roi = int(round(x_roi)), int(round(y_roi))
+        th, tw = self.size
+        th_half, tw_half = int(round(th / 2.)), int(round(tw / 2.))
 
-        for i in range(len(input_data)):
-            w, h = input_data[i].size
-            th, tw = self.size
-            th_half, tw_half = int(round(th / 2.)), int(round(tw / 2.))
+        center = self.get_roi_center(sample)
+        w, h = input_data[0].size
+        if center is None:
+            # Empty ROI, fallback to a centered crop
+            center = (h / 2., w / 2.)
+        row_roi, col_roi = int(round(center[0])), int(round(center[1]))
 
-            # compute top left corner of the crop area
-            fh = y_roi - th_half
-            fw = x_roi - tw_half
-            params = (fh, fw, w, h)
+        # compute top left corner of the crop area
+        fh = row_roi - th_half
+        fw = col_roi - tw_half
+        params = (fh, fw, w, h)
 
+        for i in range(len(input_data)):
             self.propagate_params(sample, params, i)
 
             # crop data
-            input_data[i] = F.crop(input_data[i], fw, fh, tw, th)
+            input_data[i] = F.crop(input_data[i], fh, fw, th, tw)
         rdict['input'] = input_data
 
         if self.labeled:
             gt_data = sample['gt']
             gt_metadata = sample['gt_metadata']
-            gt_data = F.crop(gt_data, fw, fh, tw, th)
-            gt_metadata["__centercrop"] = (fh, fw, w, h)
+            for i in range(len(gt_data)):
+                gt_data[i] = F.crop(gt_data[i], fh, fw, th, tw)
+                gt_metadata[i]["__centercrop"] = params
             rdict['gt'] = gt_data
+            rdict['gt_metadata'] = gt_metadata
+
+        sample.update(rdict)
+        return sample
+
+
+class RandomCrop2D(Crop2D):
+    """Make a random crop of a specified size, centered on a foreground
+    pixel of the ground truth with probability positive_ratio and at a
+    uniformly drawn position otherwise.
+
+    The foreground pixels are sampled from the coordinates indexed by the
+    foreground_index option of
+    :class:`medicaltorch.datasets.MRI2DSegmentationDataset`, they are only
+    computed from the ground truth images when the index is not available.
+    When the slice has no foreground, the crop position is drawn uniformly.
+
+    :param size: the (height, width) of the crop.
+    :param positive_ratio: the probability to center the crop on the
+                           foreground.
+    :param labeled: if it is a segmentation task.
+                         When this is True (default), the crop
+                         will also be applied to the ground truth.
+    """
+
+    def __init__(self, size, positive_ratio=0.5, labeled=True):
+        super().__init__(size, labeled)
+        self.positive_ratio = positive_ratio
+
+    @staticmethod
+    def get_foreground(sample):
+        """Return the (N, 2) (row, col) coordinates of the foreground
+        pixels of the sample and the (height, width) they refer to."""
+        gt_metadata = sample.get('gt_metadata')
+        if gt_metadata and '__fg_coords' in gt_metadata[0]:
+            return gt_metadata[0]['__fg_coords'], gt_metadata[0]['__fg_shape']
+
+        gt_arrays = [np.array(gt) for gt in sample.get('gt') or [] if gt is not None]
+        if not gt_arrays:
+            return None, None
+        foreground = np.any([gt_array > 0 for gt_array in gt_arrays], axis=0)
+        return np.argwhere(foreground), foreground.shape
+
+    @staticmethod
+    def _offset(center, size, crop_size):
+        # Keep the crop inside the image when it is large enough
+        offset = int(round(center)) - int(round(crop_size / 2.))
+        if size >= crop_size:
+            return min(max(offset, 0), size - crop_size)
+        return int(round((size - crop_size) / 2.))
+
+    def draw_params(self, sample):
+        """Draw the crop parameters (top, left, width, height) of a sample."""
+        w, h = sample['input'][0].size
+        th, tw = self.size
+        rng = get_rng()
+
+        coords, shape = None, None
+        if rng.random() < self.positive_ratio:
+            coords, shape = self.get_foreground(sample)
+
+        if coords is not None and len(coords):
+            idx = min(int(rng.uniform(0, len(coords))), len(coords) - 1)
+            # Rescale the coordinates if the slice was resampled meanwhile
+            row = (coords[idx][0] + 0.5) * h / shape[0]
+            col = (coords[idx][1] + 0.5) * w / shape[1]
+        else:
+            row = rng.uniform(th / 2., max(h - th / 2., th / 2.))
+            col = rng.uniform(tw / 2., max(w - tw / 2., tw / 2.))
+
+        return self._offset(row, h, th), self._offset(col, w, tw), w, h
+
+    def __call__(self, sample):
+        rdict = {}
+        input_data = sample['input']
+        th, tw = self.size
+        params = self.draw_params(sample)
+        fh, fw, _, _ = params
+
+        for i in range(len(input_data)):
+            self.propagate_params(sample, params, i)
+            input_data[i] = F.crop(input_data[i], fh, fw, th, tw)
+        rdict['input'] = input_data
+
+        if self.labeled:
+            gt_data = sample['gt']
+            gt_metadata = sample['gt_metadata']
+            for i in range(len(gt_data)):
+                gt_data[i] = F.crop(gt_data[i], fh, fw, th, tw)
+                gt_metadata[i]["__centercrop"] = params
+            rdict['gt'] = gt_data
+            rdict['gt_metadata'] = gt_metadata
 
         sample.update(rdict)
         return sample
@@ -298,6 +726,7 @@ class Normalize(MTTransform):
 
     In case of multiple inputs, both mean and std are lists.
     """
+    accepts = {'tensor': 1}
 
     def __init__(self, mean, std):
         self.mean = mean
@@ -321,21 +750,47 @@ class NormalizeInstance(MTTransform):
     """Normalize a tensor image with mean and standard deviation estimated
     from the sample itself.
 
-    :param mean: mean value.
-    :param std: standard deviation value.
+    By default the statistics of each slice are computed in a single pass
+    (slices with a null standard deviation, e.g. empty slices, are left
+    unchanged). With per_volume=True, the statistics of the whole volume
+    recorded at load time are used instead, see the volume_stats option of
+    :class:`medicaltorch.datasets.MRI2DSegmentationDataset`, so that all
+    the slices of a volume get the same scale and shift.
+
+    :param per_volume: if True, use the volume statistics of the metadata.
     """
+    accepts = {'tensor': 1}
+
+    def __init__(self, per_volume=False):
+        self.per_volume = per_volume
+
+    def get_stats(self, input_data, metadata):
+        if not self.per_volume:
+            std, mean = torch.std_mean(input_data)
+            return mean.item(), std.item()
+
+        if metadata is None or '__volume_stats' not in metadata:
+            raise RuntimeError("Volume statistics not found in the metadata, "
+                               "use the volume_stats option of the dataset.")
+        return metadata['__volume_stats']
+
+    def normalize(self, input_data, metadata):
+        mean, std = self.get_stats(input_data, metadata)
+        if std > 0:
+            # Out of place, the tensor may share the storage of a cached array
+            input_data = (input_data - mean) / std
+        return input_data
 
     def __call__(self, sample):
         input_data = sample['input']
+        input_metadata = sample.get('input_metadata')
         if isinstance(input_data, list):
             for i in range(len(input_data)):
-                if input_data[i].type(torch.bool).any():
-                    mean, std = input_data[i].mean(), input_data[i].std()
-                    input_data[i] = F.normalize(input_data[i], [mean], [std])
+                input_data[i] = self.normalize(input_data[i],
+                                               _metadata_item(input_metadata, i))
         else:
-            if input_data.type(torch.bool).any():
-                mean, std = input_data.mean(), input_data.std()
-                input_data = F.normalize(input_data, [mean], [std])
+            input_data = self.normalize(input_data,
+                                        _metadata_item(input_metadata, 0))
 
         rdict = {
             'input': input_data,
@@ -351,6 +806,7 @@ class NormalizeInstance3D(MTTransform):
     :param mean: mean value.
     :param std: standard deviation value.
     """
+    accepts = {'tensor': 1}
 
     def __call__(self, sample):
         input_data_normalized = []
@@ -381,6 +837,8 @@ class NormalizeInstance3D(MTTransform):
 
 
 class RandomRotation(MTTransform):
+    accepts = {'pil': 1}
+
     def __init__(self, degrees, resample=False,
                  expand=False, center=None,
                  labeled=True):
@@ -400,9 +858,33 @@ class RandomRotation(MTTransform):
 
     @staticmethod
     def get_params(degrees):
-        angle = np.random.uniform(degrees[0], degrees[1])
+        angle = get_rng().uniform(degrees[0], degrees[1])
         return angle
 
+    def get_affine_matrix(self, sample, size):
+        """Return the forward matrix of a random rotation and the output
+        size, see :class:`FusedGeometricCompose`.
+
+        :param size: the current (width, height) of the images.
+        """
+        angle = self.get_params(self.degrees)
+        for input_metadata in sample['input_metadata']:
+            input_metadata['randomRotation'] = angle
+
+        w, h = size
+        if not self.expand:
+            center = self.center if self.center is not None else (w / 2., h / 2.)
+            return _rotation_matrix(angle, center), size
+
+        # Enlarge the output to fit the rotated corners, as PIL.Image.rotate
+        matrix = _rotation_matrix(angle, (w / 2., h / 2.))
+        corners = matrix.dot(np.array([[0, w, w, 0], [0, 0, h, h], [1, 1, 1, 1]]))
+        out_w = int(np.ceil(corners[0].max()) - np.floor(corners[0].min()))
+        out_h = int(np.ceil(corners[1].max()) - np.floor(corners[1].min()))
+        matrix[0, 2] += (out_w - w) / 2.
+        matrix[1, 2] += (out_h - h) / 2.
+        return matrix, (out_w, out_h)
+
     def __call__(self, sample):
         rdict = {}
 
@@ -421,10 +903,12 @@ class RandomRotation(MTTransform):
         rdict['input'] = input_lst
 
         if self.labeled:
+            # Label maps can only be warped with nearest neighbour
+            resample = False if label_map_classes(sample) else self.resample
             gt_lst = []
             for gt_data in sample['gt']:
                 gt_lst.append(F.rotate(gt_data, angle,
-                                       self.resample, self.expand,
+                                       resample, self.expand,
                                        self.center))
             rdict['gt'] = gt_lst
 
@@ -433,26 +917,26 @@ class RandomRotation(MTTransform):
 
     def undo_transform(self, sample):
         rdict = {}
+        angle = - _metadata_item(sample['input_metadata'], 0)['randomRotation']
 
         if isinstance(sample['input'], list):
-            angle = - sample['input_metadata']['randomRotation']
-
             rdict['input'] = sample['input']
             for i in range(len(sample['input'])):
                 rdict['input'][i] = F.rotate(sample['input'][i], angle,
                                              self.resample, self.expand,
                                              self.center)
         else:
-            angle = - sample['input_metadata']['randomRotation']
-
             rdict['input'] = F.rotate(sample['input'], angle,
                                       self.resample, self.expand,
                                       self.center)
-        rdict['gt'] = sample['gt']
-        for i in range(len(sample['gt'])):
-            rdict['gt'][i] = F.rotate(sample['gt'][i], angle,
-                                   self.resample, self.expand,
-                                   self.center)
+
+        if self.labeled and sample.get('gt') is not None:
+            resample = False if label_map_classes(sample) else self.resample
+            rdict['gt'] = sample['gt']
+            for i in range(len(sample['gt'])):
+                rdict['gt'][i] = F.rotate(sample['gt'][i], angle,
+                                          resample, self.expand,
+                                          self.center)
 
         sample.update(rdict)
         return sample
@@ -461,11 +945,21 @@ class RandomRotation(MTTransform):
 class RandomRotation3D(MTTransform):
     """Make a rotation of the volume's values.
 
+    All the modalities (and the labels with linear interpolation) are
+    stacked and rotated around the volume center in a single float32
+    resampling pass.
+
     :param degrees: Maximum rotation's degrees.
-    :param axis: Axis of the rotation.
+    :param axis: Axis of the rotation, or None to draw a random rotation
+                 axis for each sample.
+    :param labeled: if True, the ground truth is also rotated.
+    :param label_interpolation: 'nearest' or 'linear' (the rotated labels
+                                are thresholded at 0.5).
     """
+    accepts = {'numpy': 2}
 
-    def __init__(self, degrees, axis=0, labeled=True):
+    def __init__(self, degrees, axis=0, labeled=True,
+                 label_interpolation='nearest'):
         if isinstance(degrees, numbers.Number):
             if degrees < 0:
                 raise ValueError("If degrees is a single number, it must be positive.")
@@ -474,46 +968,86 @@ class RandomRotation3D(MTTransform):
             if len(degrees) != 2:
                 raise ValueError("If degrees is a sequence, it must be of len 2.")
             self.degrees = degrees
+        if label_interpolation not in ('nearest', 'linear'):
+            raise ValueError("label_interpolation must be 'nearest' or 'linear'.")
         self.labeled = labeled
         self.axis = axis
+        self.label_interpolation = label_interpolation
 
     @staticmethod
-    def get_params(degrees):
-        angle = np.random.uniform(degrees[0], degrees[1])
-        return angle
+    def get_params(degrees, axis=0):
+        rng = get_rng()
+        angle = rng.uniform(degrees[0], degrees[1])
+        if axis is None:
+            direction = rng.normal(size=3)
+            norm = np.linalg.norm(direction)
+            direction = direction / norm if norm > 0 else np.array([1., 0., 0.])
+        else:
+            direction = np.zeros(3)
+            direction[axis] = 1.
+        return angle, direction
+
+    @staticmethod
+    def rotation_matrix(angle, direction):
+        """Return the 3x3 matrix of the rotation of angle degrees around
+        the unit vector direction (Rodrigues' formula)."""
+        angle = np.deg2rad(angle)
+        cross = np.array([[0., -direction[2], direction[1]],
+                          [direction[2], 0., -direction[0]],
+                          [-direction[1], direction[0], 0.]])
+        return (np.eye(3) + np.sin(angle) * cross +
+                (1 - np.cos(angle)) * cross.dot(cross))
+
+    @staticmethod
+    def rotate(volumes, rotation, order):
+        """Rotate a list of volumes of the same shape around their center.
+
+        :param volumes: list of 3D arrays.
+        :param rotation: the 3x3 rotation matrix.
+        :param order: the interpolation order.
+        :returns: a (C, X, Y, Z) float32 array.
+        """
+        stacked = np.stack(volumes).astype(np.float32, copy=False)
+        center = (np.array(stacked.shape[1:]) - 1) / 2.
+        # affine_transform maps output to input coordinates
+        inverse = rotation.T
+        matrix = np.eye(4)
+        matrix[1:, 1:] = inverse
+        offset = np.zeros(4)
+        offset[1:] = center - inverse.dot(center)
+        return affine_transform(stacked, matrix, offset=offset,
+                                order=order, mode='constant', cval=0.)
 
     def __call__(self, sample):
         rdict = {}
         input_data = sample['input']
-        if len(sample['input'][0].shape) != 3:
+        input_list = input_data if isinstance(input_data, list) else [input_data]
+        if input_list[0].ndim != 3:
             raise ValueError("Input of RandomRotation3D should be a 3 dimensionnal tensor.")
 
-        angle = self.get_params(self.degrees)
+        angle, direction = self.get_params(self.degrees, self.axis)
+        rotation = self.rotation_matrix(angle, direction)
+
+        gt_list = []
+        if self.labeled:
+            gt_data = sample['gt']
+            gt_list = gt_data if isinstance(gt_data, list) else [gt_data]
+
+        volumes = list(input_list)
+        if self.label_interpolation == 'linear':
+            volumes += gt_list
+        rotated = self.rotate(volumes, rotation, order=1)
+        ret_input = list(rotated[:len(input_list)])
 
-        input_rotated = [np.zeros(input_data[0].shape, dtype=input_data.dtype) for i in range(len(input_data))]
-        gt_data = sample['gt'] if self.labeled else None
-        gt_rotated = np.zeros(gt_data.shape, dtype=gt_data.dtype) if self.labeled else None
-
-        # TODO: Would be faster with only one vectorial operation
-        # TODO: Use the axis index for factoring this loopgit a
-        for x in range(input_data.shape[self.axis]):
-            if self.axis == 0:
-                input_rotated[x, :, :] = F.rotate(Image.fromarray(input_data[x, :, :], mode='F'), angle)
-                if self.labeled:
-                    gt_rotated[x, :, :] = F.rotate(Image.fromarray(gt_data[x, :, :], mode='F'), angle)
-            if self.axis == 1:
-                input_rotated[:, x, :] = F.rotate(Image.fromarray(input_data[:, x, :], mode='F'), angle)
-                if self.labeled:
-                    gt_rotated[:, x, :] = F.rotate(Image.fromarray(gt_data[:, x, :], mode='F'), angle)
-            if self.axis == 2:
-                input_rotated[:, :, x] = F.rotate(Image.fromarray(input_data[:, :, x], mode='F'), angle)
-                if self.labeled:
-                    gt_rotated[:, :, x] = F.rotate(Image.fromarray(gt_data[:, :, x], mode='F'), angle)
-
-        rdict['input'] = input_rotated
         if self.labeled:
-            rdict['gt'] = gt_rotated
+            if self.label_interpolation == 'linear':
+                ret_gt = (rotated[len(input_list):] >= 0.5).astype(np.float32)
+            else:
+                ret_gt = self.rotate(gt_list, rotation, order=0)
+            ret_gt = list(ret_gt)
+            rdict['gt'] = ret_gt if isinstance(gt_data, list) else ret_gt[0]
 
+        rdict['input'] = ret_input if isinstance(input_data, list) else ret_input[0]
         sample.update(rdict)
 
         return sample
@@ -523,6 +1057,7 @@ class RandomReverse3D(MTTransform):
     """Make a symmetric inversion of the different values of each dimensions.
     (randomized)
     """
+    accepts = {'numpy': 1}
 
     def __init__(self, labeled=True):
         self.labeled = labeled
@@ -533,15 +1068,16 @@ class RandomReverse3D(MTTransform):
         if not isinstance(input_list, list):
             input_list = [sample['input']]
         gt_data = sample['gt'] if self.labeled else None
+        rng = get_rng()
         reverse_input = []
         for input_data in input_list:
-            if np.random.randint(2) == 1:
+            if rng.random() < 0.5:
                 input_data = np.flip(input_data, axis=0).copy()
                 if self.labeled: gt_data = np.flip(gt_data, axis=0).copy()
-            if np.random.randint(2) == 1:
+            if rng.random() < 0.5:
                 input_data = np.flip(input_data, axis=1).copy()
                 if self.labeled: gt_data = np.flip(gt_data, axis=1).copy()
-            if np.random.randint(2) == 1:
+            if rng.random() < 0.5:
                 input_data = np.flip(input_data, axis=2).copy()
                 if self.labeled: gt_data = np.flip(gt_data, axis=2).copy()
             reverse_input.append(input_data)
@@ -554,6 +1090,8 @@ class RandomReverse3D(MTTransform):
 
 
 class RandomAffine(MTTransform):
+    accepts = {'pil': 1}
+
     def __init__(self, degrees, translate=None,
                  scale=None, shear=None,
                  resample=False, fillcolor=0,
@@ -605,38 +1143,62 @@ class RandomAffine(MTTransform):
         Returns:
             sequence: params to be passed to the affine transformation
         """
-        angle = np.random.uniform(degrees[0], degrees[1])
+        rng = get_rng()
+        angle = rng.uniform(degrees[0], degrees[1])
         if translate is not None:
             max_dx = translate[0] * img_size[0]
             max_dy = translate[1] * img_size[1]
-            translations = (np.round(np.random.uniform(-max_dx, max_dx)),
-                            np.round(np.random.uniform(-max_dy, max_dy)))
+            translations = (np.round(rng.uniform(-max_dx, max_dx)),
+                            np.round(rng.uniform(-max_dy, max_dy)))
         else:
             translations = (0, 0)
 
         if scale_ranges is not None:
-            scale = np.random.uniform(scale_ranges[0], scale_ranges[1])
+            scale = rng.uniform(scale_ranges[0], scale_ranges[1])
         else:
             scale = 1.0
 
         if shears is not None:
-            shear = np.random.uniform(shears[0], shears[1])
+            shear = rng.uniform(shears[0], shears[1])
         else:
             shear = 0.0
 
         return angle, translations, scale, shear
 
+    def get_affine_matrix(self, sample, size):
+        """Return the forward matrix of a random affine transformation and
+        the output size, see :class:`FusedGeometricCompose`.
+
+        :param size: the current (width, height) of the images.
+        """
+        angle, translations, scale, shear = self.get_params(self.degrees, self.translate, self.scale,
+                                                            self.shear, size)
+        w, h = size
+        return _affine_matrix(angle, translations, scale, shear, (w / 2., h / 2.)), size
+
+    @staticmethod
+    def _matrix(data, params):
+        angle, translations, scale, shear = params
+        w, h = data.size
+        return _affine_matrix(angle, translations, scale, shear, (w / 2., h / 2.))
+
     def sample_augment(self, input_data, params):
-        input_data = F.affine(input_data, *params, resample=self.resample,
-                              fillcolor=self.fillcolor)
+        # Same matrix as get_affine_matrix, so that undo_transform is exact
+        input_data = _warp_image(input_data, self._matrix(input_data, params),
+                                 input_data.size, self.resample or Image.NEAREST,
+                                 self.fillcolor)
         return input_data
 
-    def label_augment(self, gt_data, params):
+    def label_augment(self, gt_data, params, label_map=False):
+        if label_map:
+            # Label maps are warped with nearest neighbour, without threshold
+            return _warp_image(gt_data, self._matrix(gt_data, params),
+                               gt_data.size, Image.NEAREST)
         gt_data = self.sample_augment(gt_data, params)
+        # 'L' masks hold 0 or 255, the other masks 0 or 1
+        scale = 255. if gt_data.mode == 'L' else 1.
         np_gt_data = np.array(gt_data)
-        np_gt_data[np_gt_data >= 0.5] = 255.0
-        np_gt_data[np_gt_data < 0.5] = 0.0
-        np_gt_data = np_gt_data.astype(np.uint8)
+        np_gt_data = np.where(np_gt_data >= 0.5 * scale, 255, 0).astype(np.uint8)
         gt_data = Image.fromarray(np_gt_data, mode='L')
         return gt_data
 
@@ -653,6 +1215,10 @@ class RandomAffine(MTTransform):
 
         params = self.get_params(self.degrees, self.translate, self.scale,
                                  self.shear, input_data_size)
+        # save the parameters in metadata for undo_transform
+        if sample.get('input_metadata') is not None:
+            for i in range(len(input_data)):
+                _metadata_item(sample['input_metadata'], i)['__randomAffine'] = params
 
         if isinstance(input_data, list):
             ret_input = [self.sample_augment(item, params)
@@ -664,29 +1230,66 @@ class RandomAffine(MTTransform):
 
         if self.labeled:
             gt_data = sample['gt']
+            label_map = label_map_classes(sample) is not None
             if isinstance(gt_data, list):
-                ret_gt = [self.label_augment(item, params)
+                ret_gt = [self.label_augment(item, params, label_map)
                           for item in gt_data]
             else:
-                ret_gt = self.label_augment(gt_data, params)
+                ret_gt = self.label_augment(gt_data, params, label_map)
 
             rdict['gt'] = ret_gt
 
         sample.update(rdict)
         return sample
 
+    def _unwarp(self, data, params, resample):
+        matrix = np.linalg.inv(self._matrix(data, params))
+        return _warp_image(data, matrix, data.size, resample)
+
+    def undo_transform(self, sample):
+        """Invert the affine transformation with the parameters recorded in
+        the input metadata."""
+        rdict = {}
+        params = _metadata_item(sample['input_metadata'], 0)['__randomAffine']
+        resample = self.resample or Image.NEAREST
+
+        input_data = sample['input']
+        if isinstance(input_data, list):
+            rdict['input'] = [self._unwarp(item, params, resample) for item in input_data]
+        else:
+            rdict['input'] = self._unwarp(input_data, params, resample)
+
+        if self.labeled and sample.get('gt') is not None:
+            gt_data = sample['gt']
+            if isinstance(gt_data, list):
+                rdict['gt'] = [self._unwarp(item, params, Image.NEAREST) for item in gt_data]
+            else:
+                rdict['gt'] = self._unwarp(gt_data, params, Image.NEAREST)
+
+        sample.update(rdict)
+        return sample
+
 
 class RandomTensorChannelShift(MTTransform):
+    """Shift the intensities of the inputs by a random value, drawn once
+    per sample. Numpy arrays are shifted without going through PIL.
+
+    :param shift_range: the range of the added value.
+    """
+    accepts = {'pil': 2, 'numpy': 1}
+
     def __init__(self, shift_range):
         self.shift_range = shift_range
 
     @staticmethod
     def get_params(shift_range):
-        sampled_value = np.random.uniform(shift_range[0],
+        sampled_value = get_rng().uniform(shift_range[0],
                                           shift_range[1])
         return sampled_value
 
     def sample_augment(self, input_data, params):
+        if isinstance(input_data, np.ndarray):
+            return input_data + np.float32(params)
         np_input_data = np.array(input_data)
         np_input_data += params
         input_data = Image.fromarray(np_input_data, mode='F')
@@ -710,92 +1313,181 @@ class RandomTensorChannelShift(MTTransform):
 
 
 class ElasticTransform(MTTransform):
-    "Elastic transform for 2D and 3D inputs"
+    """Elastic transform for 2D and 3D inputs.
+
+    A single displacement field is drawn per sample and applied to all its
+    modalities and labels. The field is smoothed in float32 on a coarse
+    control grid and linearly upsampled. The image is deformed by chunks
+    along its first axis, so the temporary memory is a small multiple of
+    the chunk size instead of the image size.
+
+    :param alpha_range: range of the displacement amplitude.
+    :param sigma_range: range of the displacement smoothness.
+    :param p: probability of applying the transform.
+    :param labeled: if True, the ground truth is also deformed.
+    :param grid_spacing: spacing of the control grid in pixels, by default
+                         sigma / 2 (1 means a full resolution field).
+    :param chunk_size: number of slices (rows in 2D) deformed at once,
+                       None to deform the whole image at once.
+    """
+    accepts = {'pil': 3, 'numpy': 1}
 
     def __init__(self, alpha_range, sigma_range,
-                 p=0.5, labeled=True):
+                 p=0.5, labeled=True, grid_spacing=None, chunk_size=16):
         self.alpha_range = alpha_range
         self.sigma_range = sigma_range
         self.labeled = labeled
         self.p = p
+        self.grid_spacing = grid_spacing
+        self.chunk_size = chunk_size
         self.is3D = False
+        self._grids = {}
 
     @staticmethod
     def get_params(alpha, sigma):
-        alpha = np.random.uniform(alpha[0], alpha[1])
-        sigma = np.random.uniform(sigma[0], sigma[1])
+        rng = get_rng()
+        alpha = rng.uniform(alpha[0], alpha[1])
+        sigma = rng.uniform(sigma[0], sigma[1])
         return alpha, sigma
 
-    def elastic_transform(self, image, alpha, sigma):
-        shape = image.shape
-        dx = gaussian_filter((np.random.rand(*shape) * 2 - 1),
-                             sigma, mode="constant", cval=0) * alpha
-        dy = gaussian_filter((np.random.rand(*shape) * 2 - 1),
-                             sigma, mode="constant", cval=0) * alpha
-        if self.is3D:
-            dz = gaussian_filter((np.random.rand(*shape) * 2 - 1),
-                                 sigma, mode="constant", cval=0) * alpha
-            x, y, z = np.meshgrid(np.arange(shape[0]),
-                                  np.arange(shape[1]),
-                                  np.arange(shape[2]), indexing='ij')
-            indices = np.reshape(x + dx, (-1, 1)), np.reshape(y + dy, (-1, 1)), np.reshape(z + dz, (-1, 1))
-        else:
-            x, y = np.meshgrid(np.arange(shape[0]),
-                               np.arange(shape[1]), indexing='ij')
-            indices = np.reshape(x + dx, (-1, 1)), np.reshape(y + dy, (-1, 1))
-        return map_coordinates(image, indices, order=1).reshape(shape)
-
-    def sample_augment(self, input_data, params):
-        param_alpha, param_sigma = params
-        np_input_data = np.array(input_data)
-        if len(np_input_data.shape) == 3:
-            self.is3D = True
+    def get_spacing(self, sigma):
+        if self.grid_spacing is not None:
+            return self.grid_spacing
+        return max(1, int(sigma // 2))
+
+    def get_grid(self, shape):
+        """Return the cached open identity grid of a shape, one float32
+        array per axis broadcastable to the shape."""
+        key = tuple(shape)
+        if key not in self._grids:
+            ndim = len(shape)
+            self._grids[key] = [
+                np.arange(size, dtype=np.float32).reshape(
+                    [-1 if i == axis else 1 for i in range(ndim)])
+                for axis, size in enumerate(shape)
+            ]
+        return self._grids[key]
+
+    def get_chunks(self, shape):
+        chunk_size = self.chunk_size or shape[0]
+        for start in range(0, shape[0], chunk_size):
+            yield start, min(start + chunk_size, shape[0])
+
+    def coarse_field(self, shape, alpha, sigma, spacing):
+        """Return the smoothed random displacements of each axis on the
+        control grid. The amplitude is scaled so that the field has the
+        same statistics as a field smoothed at full resolution."""
+        coarse_shape = tuple(int(np.ceil((size - 1) / float(spacing))) + 1
+                             for size in shape)
+        scale = alpha * spacing ** (-len(shape) / 2.)
+        rng = get_rng()
+        fields = []
+        for _ in shape:
+            noise = (rng.random(coarse_shape) * 2 - 1).astype(np.float32)
+            field = gaussian_filter(noise, sigma / float(spacing),
+                                    mode="constant", cval=0)
+            field *= scale
+            fields.append(field)
+        return fields
+
+    def get_coordinates(self, shape, fields, spacing, start, stop):
+        """Return the coordinates where the rows start:stop of the deformed
+        image are sampled."""
+        grid = self.get_grid(shape)
+        grid = [grid[0][start:stop]] + grid[1:]
+        chunk_shape = (stop - start,) + tuple(shape[1:])
+        coordinates = np.empty((len(shape),) + chunk_shape, dtype=np.float32)
+
+        if spacing == 1:
+            for axis, field in enumerate(fields):
+                coordinates[axis] = field[start:stop] + grid[axis]
+            return coordinates
+
+        control = np.empty_like(coordinates)
+        for axis in range(len(shape)):
+            control[axis] = grid[axis] / spacing
+        for axis, field in enumerate(fields):
+            map_coordinates(field, control, output=coordinates[axis], order=1)
+            coordinates[axis] += grid[axis]
+        return coordinates
+
+    def deform(self, arrays, params, orders=None):
+        """Deform arrays of the same shape with the same displacement field.
+
+        :param arrays: list of float32 numpy arrays.
+        :param params: the (alpha, sigma) parameters.
+        :param orders: the interpolation order of each array, linear by
+                       default.
+        :returns: the list of deformed float32 arrays.
+        """
+        alpha, sigma = params
+        shape = arrays[0].shape
+        spacing = self.get_spacing(sigma)
+        fields = self.coarse_field(shape, alpha, sigma, spacing)
+
+        orders = orders or [1] * len(arrays)
+        outputs = [np.empty(shape, dtype=np.float32) for _ in arrays]
+        for start, stop in self.get_chunks(shape):
+            coordinates = self.get_coordinates(shape, fields, spacing,
+                                               start, stop)
+            for data, output, order in zip(arrays, outputs, orders):
+                map_coordinates(data, coordinates,
+                                output=output[start:stop], order=order)
+        return outputs
 
-        np_input_data = self.elastic_transform(np_input_data,
-                                               param_alpha, param_sigma)
-        if not self.is3D:
-            input_data = Image.fromarray(np_input_data, mode='F')
-        return input_data
+    def elastic_transform(self, image, alpha, sigma):
+        image = np.asarray(image, dtype=np.float32)
+        return self.deform([image], (alpha, sigma))[0]
 
-    def label_augment(self, gt_data, params):
-        param_alpha, param_sigma = params
+    def sample_augment(self, input_data, np_input_data):
+        if isinstance(input_data, Image.Image):
+            return Image.fromarray(np_input_data, mode='F')
+        return np_input_data
 
-        np_gt_data = np.array(gt_data)
-        np_gt_data = self.elastic_transform(np_gt_data,
-                                            param_alpha, param_sigma)
-        if not self.is3D:
-            np_gt_data[np_gt_data >= 0.5] = 255.0
-            np_gt_data[np_gt_data < 0.5] = 0.0
+    def label_augment(self, gt_data, np_gt_data, label_map=False):
+        if label_map:
             np_gt_data = np_gt_data.astype(np.uint8)
-            gt_data = Image.fromarray(np_gt_data, mode='L')
-
-        return gt_data
+        elif not self.is3D:
+            # 'L' masks hold 0 or 255, the other masks 0 or 1
+            scale = 255. if isinstance(gt_data, Image.Image) or \
+                np.asarray(gt_data).dtype == np.uint8 else 1.
+            np_gt_data = np.where(np_gt_data >= 0.5 * scale, 255, 0).astype(np.uint8)
+        if isinstance(gt_data, Image.Image):
+            return Image.fromarray(np_gt_data, mode='L')
+        return np_gt_data
 
     def __call__(self, sample):
         rdict = {}
 
-        if np.random.random() < self.p:
+        if get_rng().random() < self.p:
             input_data = sample['input']
             params = self.get_params(self.alpha_range,
                                      self.sigma_range)
 
-            if isinstance(input_data, list):
-                ret_input = [self.sample_augment(item, params)
-                             for item in input_data]
-            else:
-                ret_input = self.sample_augment(input_data, params)
-
-            rdict['input'] = ret_input
+            input_list = input_data if isinstance(input_data, list) else [input_data]
+            arrays = [np.asarray(item, dtype=np.float32) for item in input_list]
+            self.is3D = arrays[0].ndim == 3
 
+            gt_list = []
+            label_map = label_map_classes(sample) is not None
             if self.labeled:
                 gt_data = sample['gt']
-                if isinstance(gt_data, list):
-                    ret_gt = [self.label_augment(item, params)
-                              for item in gt_data]
-                else:
-                    ret_gt = self.label_augment(gt_data, params)
+                gt_list = gt_data if isinstance(gt_data, list) else [gt_data]
+                arrays += [np.asarray(item, dtype=np.float32) for item in gt_list]
+            # Label maps are warped with nearest neighbour
+            orders = [1] * len(input_list) + [0 if label_map else 1] * len(gt_list)
 
-                rdict['gt'] = ret_gt
+            # One displacement field shared by all modalities and labels
+            outputs = self.deform(arrays, params, orders)
+
+            ret_input = [self.sample_augment(item, output)
+                         for item, output in zip(input_list, outputs)]
+            rdict['input'] = ret_input if isinstance(input_data, list) else ret_input[0]
+
+            if self.labeled:
+                ret_gt = [self.label_augment(item, output, label_map)
+                          for item, output in zip(gt_list, outputs[len(input_list):])]
+                rdict['gt'] = ret_gt if isinstance(gt_data, list) else ret_gt[0]
 
         sample.update(rdict)
         return sample
@@ -805,6 +1497,8 @@ class ElasticTransform(MTTransform):
 #       By changing pixel dimensions, we should be
 #       able to return later to the original space.
 class Resample(MTTransform):
+    accepts = {'pil': 1}
+
     def __init__(self, wspace, hspace,
                  interpolation=Image.BILINEAR,
                  labeled=True):
@@ -813,8 +1507,13 @@ class Resample(MTTransform):
         self.interpolation = interpolation
         self.labeled = labeled
 
-    @staticmethod
-    def resample_bin(self, data, wshape, hshape, thr=0.5):
+    def resample_bin(self, data, wshape, hshape, thr=0.5, label_map=False):
+        if isinstance(data, list):
+            return [self.resample_bin(item, wshape, hshape, thr, label_map)
+                    for item in data]
+        if label_map:
+            # Label maps are resampled with nearest neighbour, without threshold
+            return data.resize((wshape, hshape), resample=Image.NEAREST)
         data = data.resize((wshape, hshape), resample=self.interpolation)
         np_data = np.array(data)
         np_data[np_data > thr] = 255.0
@@ -823,9 +1522,8 @@ class Resample(MTTransform):
         data = Image.fromarray(np_data, mode='L')
         return data
 
-    def __call__(self, sample):
-        rdict = {}
-        input_data = sample['input']
+    def get_new_shape(self, sample):
+        """Return the (height, width) of the resampled images."""
         input_metadata = sample['input_metadata'][0]
 
         # Voxel dimension in mm
@@ -835,8 +1533,23 @@ class Resample(MTTransform):
         hfactor = hzoom / self.hspace
         wfactor = wzoom / self.wspace
 
-        hshape_new = int(hshape * hfactor)
-        wshape_new = int(wshape * wfactor)
+        return int(hshape * hfactor), int(wshape * wfactor)
+
+    def get_affine_matrix(self, sample, size):
+        """Return the forward matrix of the resampling and the output size,
+        see :class:`FusedGeometricCompose`.
+
+        :param size: the current (width, height) of the images.
+        """
+        hshape_new, wshape_new = self.get_new_shape(sample)
+        w, h = size
+        matrix = np.diag([wshape_new / float(w), hshape_new / float(h), 1.])
+        return matrix, (wshape_new, hshape_new)
+
+    def __call__(self, sample):
+        rdict = {}
+        input_data = sample['input']
+        hshape_new, wshape_new = self.get_new_shape(sample)
 
         if isinstance(input_data, list):
             ret_input = [item.resize((wshape_new, hshape_new), resample=self.interpolation) for item in input_data]
@@ -847,8 +1560,8 @@ class Resample(MTTransform):
 
         if self.labeled:
             gt_data = sample['gt']
-            rdict['gt'] = self.resample_bin(gt_data, wshape_new,
-                                            hshape_new)
+            rdict['gt'] = self.resample_bin(gt_data, wshape_new, hshape_new,
+                                            label_map=label_map_classes(sample) is not None)
         if sample['roi'] is not None:
             roi_data = sample['roi']
             rdict['roi'] = self.resample_bin(roi_data, wshape_new,
@@ -859,6 +1572,14 @@ class Resample(MTTransform):
 
 
 class AdditiveGaussianNoise(MTTransform):
+    """Add gaussian noise to the inputs. A single noise image is drawn per
+    sample and shared by all the modalities.
+
+    :param mean: mean of the noise.
+    :param std: standard deviation of the noise.
+    """
+    accepts = {'pil': 2, 'numpy': 1}
+
     def __init__(self, mean=0.0, std=0.01):
         self.mean = mean
         self.std = std
@@ -867,10 +1588,16 @@ class AdditiveGaussianNoise(MTTransform):
         rdict = {}
         input_data = sample['input']
 
-        noise = np.random.normal(self.mean, self.std, input_data[0].size)
-        noise = noise.astype(np.float32)
+        first_item = input_data[0]
+        shape = first_item.shape if isinstance(first_item, np.ndarray) else first_item.size[::-1]
+        noise = standard_normal(shape)
+        noise *= self.std
+        noise += self.mean
         noisy_input = []
         for item in input_data:
+            if isinstance(item, np.ndarray):
+                noisy_input.append(item + noise)
+                continue
             np_input_data = np.array(item)
             np_input_data += noise
             noisy_input.append(Image.fromarray(np_input_data, mode='F'))
@@ -880,35 +1607,371 @@ class AdditiveGaussianNoise(MTTransform):
         return sample
 
 
+class IntensityAugmentation(MTTransform):
+    """Intensity augmentations applied on float32 data: a smooth
+    multiplicative bias field, a gamma correction (on the intensities
+    rescaled to [0, 1]), a scale, a shift and an additive gaussian noise,
+    in this order. The parameters of all the channels are drawn in one
+    vectorized call. PIL images are converted once to float32 arrays,
+    numpy arrays are copied unless copy is False.
+
+    :param shift_range: range of the additive shift, or None.
+    :param scale_range: range of the multiplicative scale, or None.
+    :param gamma_range: range of the gamma exponent, or None.
+    :param noise_std: standard deviation of the gaussian noise, or None.
+    :param bias_field_std: standard deviation of the log bias field on
+                           its control grid, or None.
+    :param bias_field_grid: number of control points of the bias field
+                            along each axis.
+    :param per_channel: if True, the parameters are drawn per channel,
+                        otherwise they are shared by all the modalities.
+    :param p: probability of augmenting a sample.
+    :param copy: if False, numpy inputs are modified in place, only when
+                 the caller owns them (the datasets may return views of
+                 cached volumes).
+    """
+    accepts = {'pil': 2, 'numpy': 1}
+
+    def __init__(self, shift_range=None, scale_range=None, gamma_range=None,
+                 noise_std=None, bias_field_std=None, bias_field_grid=4,
+                 per_channel=True, p=1.0, copy=True):
+        self.shift_range = shift_range
+        self.scale_range = scale_range
+        self.gamma_range = gamma_range
+        self.noise_std = noise_std
+        self.bias_field_std = bias_field_std
+        self.bias_field_grid = bias_field_grid
+        self.per_channel = per_channel
+        self.p = p
+        self.copy = copy
+        if not copy:
+            self.accepts = {'pil': 2, 'numpy': 0}
+
+    def get_params(self, n_samples, n_channels, ndim=2):
+        """Draw the parameters of n_samples samples as float32 arrays of
+        shape (n_samples, n_channels), n_channels being 1 when the
+        parameters are shared by the channels. The bias field coefficients
+        have ndim extra control grid axes. The parameters of the samples
+        that are not augmented are the identity.
+        """
+        rng = get_rng()
+        shape = (n_samples, n_channels if self.per_channel else 1)
+        applied = (rng.random(n_samples) < self.p).astype(np.float32)[:, None]
+
+        def draw(value_range, identity):
+            if value_range is None:
+                return None
+            values = rng.uniform(value_range[0], value_range[1], shape).astype(np.float32)
+            return applied * values + (1 - applied) * identity
+
+        params = {
+            'shift': draw(self.shift_range, 0.),
+            'scale': draw(self.scale_range, 1.),
+            'gamma': draw(self.gamma_range, 1.),
+            'noise_std': None,
+            'bias': None,
+        }
+        if self.noise_std:
+            params['noise_std'] = np.repeat(applied * self.noise_std, shape[1], axis=1)
+        if self.bias_field_std:
+            bias = standard_normal(shape + (self.bias_field_grid,) * ndim)
+            bias *= self.bias_field_std * applied.reshape((n_samples, 1) + (1,) * ndim)
+            params['bias'] = bias
+        return params
+
+    @staticmethod
+    def augment(data, shift=None, scale=None, gamma=None, bias=None, noise=None):
+        """Augment a float32 array in place.
+
+        :param bias: the coefficients of the log bias field on its control
+                     grid, or None.
+        :param noise: the noise array, or None.
+        """
+        if bias is not None:
+            field = zoom(bias, [size / float(grid_size)
+                                for size, grid_size in zip(data.shape, bias.shape)], order=3)
+            np.exp(field, out=field)
+            data *= field
+        if gamma is not None and gamma != 1:
+            low, high = data.min(), data.max()
+            if high > low:
+                data -= low
+                data /= high - low
+                np.power(data, gamma, out=data)
+                data *= high - low
+                data += low
+        if scale is not None:
+            data *= scale
+        if shift is not None:
+            data += shift
+        if noise is not None:
+            data += noise
+
+    def __call__(self, sample):
+        input_data = sample['input']
+        input_list = input_data if isinstance(input_data, list) else [input_data]
+
+        arrays = []
+        for item in input_list:
+            if isinstance(item, np.ndarray):
+                arrays.append(item.astype(np.float32, copy=self.copy))
+            else:
+                arrays.append(np.array(item, dtype=np.float32))
+
+        shape = arrays[0].shape
+        params = self.get_params(1, len(arrays), len(shape))
+        noise = None
+        if params['noise_std'] is not None:
+            noise_std = params['noise_std'][0]
+            noise = standard_normal((len(noise_std),) + shape)
+            noise *= noise_std.reshape((-1,) + (1,) * len(shape))
+
+        for c, array in enumerate(arrays):
+            k = c if self.per_channel else 0
+            self.augment(array,
+                         *[params[key][0, k] if params[key] is not None else None
+                           for key in ('shift', 'scale', 'gamma', 'bias')],
+                         noise=noise[k] if noise is not None else None)
+
+        ret_input = [array if isinstance(item, np.ndarray) else Image.fromarray(array, mode='F')
+                     for item, array in zip(input_list, arrays)]
+        sample['input'] = ret_input if isinstance(input_data, list) else ret_input[0]
+        return sample
+
+
+def _rescale(data):
+    """Rescale an array to [0, 1] as float32."""
+    data = np.asarray(data, dtype=np.float32)
+    low, high = data.min(), data.max()
+    if high > low:
+        return (data - low) / (high - low)
+    return np.zeros_like(data)
+
+
+def _transform_inputs(sample, fn):
+    """Apply fn to the numpy version of each input of a sample, keeping
+    the PIL images as PIL images."""
+    input_data = sample['input']
+    input_list = input_data if isinstance(input_data, list) else [input_data]
+    ret_input = []
+    for item in input_list:
+        output = fn(np.asarray(item, dtype=np.float32)).astype(np.float32)
+        ret_input.append(output if isinstance(item, np.ndarray) else Image.fromarray(output, mode='F'))
+    sample['input'] = ret_input if isinstance(input_data, list) else ret_input[0]
+    return sample
+
+
 class Clahe(MTTransform):
-    def __init__(self, clip_limit=3.0, kernel_size=(8, 8)):
+    """Contrast Limited Adaptive Histogram Equalization.
+
+    It can be applied to a numpy array, to the inputs of a sample (rescaled
+    to [0, 1] first) or once per volume with :meth:`volume_transform`, see
+    the volume_transform option of
+    :class:`medicaltorch.datasets.MRI2DSegmentationDataset`.
+
+    :param clip_limit: the clipping limit of the histograms.
+    :param kernel_size: the size of the contextual regions.
+    :param slice_axis: axis of the slices equalized by
+                       :meth:`volume_transform`.
+    """
+    accepts = {'pil': 2, 'numpy': 1}
+
+    def __init__(self, clip_limit=3.0, kernel_size=(8, 8), slice_axis=2):
         # Default values are based upon the following paper:
         # https://arxiv.org/abs/1804.09400 (3D Consistent Cardiac Segmentation)
 
         self.clip_limit = clip_limit
         self.kernel_size = kernel_size
+        self.slice_axis = slice_axis
+
+    def volume_params(self):
+        """Return the parameters identifying the output of a volume."""
+        return {'clip_limit': self.clip_limit, 'kernel_size': list(self.kernel_size),
+                'slice_axis': self.slice_axis}
+
+    def equalize(self, array):
+        return skimage.exposure.equalize_adapthist(
+            array,
+            kernel_size=self.kernel_size,
+            clip_limit=self.clip_limit
+        )
+
+    def volume_transform(self, volume):
+        """Equalize each slice of a volume rescaled to [0, 1]."""
+        volume = _rescale(volume)
+        output = np.empty_like(volume)
+        index = [slice(None)] * volume.ndim
+        for slice_index in range(volume.shape[self.slice_axis]):
+            index[self.slice_axis] = slice_index
+            output[tuple(index)] = self.equalize(volume[tuple(index)])
+        return output
 
     def __call__(self, sample):
+        if isinstance(sample, dict):
+            return _transform_inputs(sample, lambda data: self.equalize(_rescale(data)))
         if not isinstance(sample, np.ndarray):
             raise TypeError("Input sample must be a numpy array.")
         input_sample = np.copy(sample)
-        array = skimage.exposure.equalize_adapthist(
-            input_sample,
-            kernel_size=self.kernel_size,
-            clip_limit=self.clip_limit
-        )
+        array = self.equalize(input_sample)
         return array
 
 
 class HistogramClipping(MTTransform):
+    """Clip the intensities to percentiles.
+
+    It can be applied to a numpy array, to the inputs of a sample or once
+    per volume with :meth:`volume_transform` (the percentiles are then
+    computed on the whole volume).
+
+    :param min_percentile: the lower percentile.
+    :param max_percentile: the upper percentile.
+    """
+    accepts = {'pil': 2, 'numpy': 1}
+
     def __init__(self, min_percentile=5.0, max_percentile=95.0):
         self.min_percentile = min_percentile
         self.max_percentile = max_percentile
 
+    def volume_params(self):
+        """Return the parameters identifying the output of a volume."""
+        return {'min_percentile': self.min_percentile,
+                'max_percentile': self.max_percentile}
+
+    def clip(self, array):
+        percentile1, percentile2 = np.percentile(array, (self.min_percentile,
+                                                         self.max_percentile))
+        return np.clip(array, percentile1, percentile2)
+
+    def volume_transform(self, volume):
+        """Clip a volume to the percentiles of the whole volume."""
+        return self.clip(np.asarray(volume, dtype=np.float32))
+
     def __call__(self, sample):
-        array = np.copy(sample)
-        percentile1 = np.percentile(array, self.min_percentile)
-        percentile2 = np.percentile(array, self.max_percentile)
-        array[array <= percentile1] = percentile1
-        array[array >= percentile2] = percentile2
-        return array
+        if isinstance(sample, dict):
+            return _transform_inputs(sample, self.clip)
+        return self.clip(np.copy(sample))
+
+
+def _representation(data):
+    if isinstance(data, np.ndarray):
+        return 'numpy'
+    if isinstance(data, torch.Tensor):
+        return 'tensor'
+    if isinstance(data, Image.Image):
+        return 'pil'
+    raise TypeError("Unknown image representation {}.".format(type(data)))
+
+
+def _image_nbytes(image):
+    if isinstance(image, Image.Image):
+        return image.size[0] * image.size[1] * (1 if image.mode == 'L' else 4)
+    if isinstance(image, torch.Tensor):
+        return image.numel() * image.element_size()
+    return image.nbytes
+
+
+def _sample_images(sample):
+    images = []
+    for key in ('input', 'gt'):
+        data = sample.get(key)
+        if data is None:
+            continue
+        images.extend(item for item in (data if isinstance(data, list) else [data])
+                      if item is not None)
+    return images
+
+
+def _count_copies(transform_list, representation):
+    """Follow the representations through a chain of transforms and
+    return the (image copies, final representation, errors)."""
+    copies, errors = 0, []
+    for t in transform_list:
+        if t.accepts is not None:
+            if representation in t.accepts:
+                copies += t.accepts[representation]
+            else:
+                errors.append("{} doesn't accept '{}' images.".format(
+                    type(t).__name__, representation))
+        representation = t.produces or representation
+    return copies, representation, errors
+
+
+def plan_conversions(compose, sample):
+    """Validate a chain of transforms and rebuild it with the cheapest
+    conversions between the 'pil', 'numpy' and 'tensor' representations,
+    using the `accepts` and `produces` declarations of the transforms.
+
+    The conversion transforms of the chain (:class:`ToTensor`,
+    :class:`ToNumpy` and :class:`ToPIL`) are removed and the ones needed are
+    inserted again; the output of the new chain has the representation of
+    the output of the original one. Transforms without declaration are
+    assumed to work on any representation without copy.
+
+    :param compose: a Compose or a list of transforms.
+    :param sample: an example sample, it gives the representation of the
+                   images fed to the chain and their size.
+    :returns: tuple (new Compose, report dict with 'valid', 'errors' (the
+              transforms of the original chain given a representation they
+              don't accept), 'bytes_before' and 'bytes_after', the bytes
+              copied per sample). When no conversions can link the
+              transforms, the original chain is returned and the report
+              is invalid.
+    """
+    transform_list = list(getattr(compose, 'transforms', compose))
+    images = _sample_images(sample)
+    source = _representation(images[0])
+    nbytes = sum(_image_nbytes(image) for image in images)
+
+    copies_before, target, errors = _count_copies(transform_list, source)
+
+    converters = {'tensor': ToTensor, 'numpy': ToNumpy, 'pil': ToPIL}
+    # Reuse the conversions of the chain to keep their parameters
+    instances = {}
+    for t in transform_list:
+        for representation, cls in converters.items():
+            if type(t) is cls:
+                instances.setdefault(representation, t)
+    steps = [t for t in transform_list if type(t) not in converters.values()]
+
+    def convert(chain, src, dst):
+        if src == dst:
+            return 0, chain
+        conversion = instances.get(dst) or converters[dst]()
+        return converters[dst].accepts.get(src), chain + [conversion]
+
+    # Cheapest (copies, chain) ending with each representation
+    costs = {source: (0, [])}
+    for t in steps:
+        new_costs = {}
+        for src, (copies, chain) in costs.items():
+            for dst, step_copies in (t.accepts or {src: 0}).items():
+                conversion_copies, new_chain = convert(chain, src, dst)
+                if conversion_copies is None:
+                    continue
+                total = copies + conversion_copies + step_copies
+                out = t.produces or dst
+                if out not in new_costs or total < new_costs[out][0]:
+                    new_costs[out] = (total, new_chain + [t])
+        costs = new_costs
+
+    best = None
+    for src, (copies, chain) in costs.items():
+        conversion_copies, new_chain = convert(chain, src, target)
+        if conversion_copies is None:
+            continue
+        if best is None or copies + conversion_copies < best[0]:
+            best = (copies + conversion_copies, new_chain)
+
+    if best is None:
+        # No conversion reaches the representations of the chain, it is
+        # returned unchanged
+        errors.append("No conversion chain from '{}' to '{}' images.".format(source, target))
+        best = (copies_before, transform_list)
+
+    report = {
+        'valid': not errors,
+        'errors': errors,
+        'bytes_before': copies_before * nbytes,
+        'bytes_after': best[0] * nbytes,
+    }
+    return transforms.Compose(best[1]), report
@@ -27,9 +27,9 @@ setup(
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     install_requires=requirements,
     tests_require=test_requirements,
-    #entry_points={
-        #'console_scripts': [
-        #    'cmdname=medicaltorch.mod:function',
-        #],
-    #},
+    entry_points={
+        'console_scripts': [
+            'medicaltorch-preprocess=medicaltorch.preprocessing:main',
+        ],
+    },
 )
@@ -1,15 +1,39 @@
+import collections
 import os
 import pytest
 
+import nibabel as nib
+import numpy as np
+
 import torch
 from torch.utils.data import DataLoader
 from torchvision import transforms
+from PIL import Image
 
 from medicaltorch import datasets as mt_datasets
 from medicaltorch import transforms as mt_transforms
 
 ROOT_DIR_GMCHALLENGE = './data'
 
+WorkerInfo = collections.namedtuple('WorkerInfo', ['id', 'num_workers'])
+
+
+def write_subject(tmpdir, subject, shape=(8, 8, 4)):
+    """Write the input, ground truth and ROI volumes of a subject and
+    return its filename pair. The input slice k of the subject s holds
+    values in [100 * s + k, 100 * s + k + 0.5)."""
+    rng = np.random.RandomState(subject)
+    input_data = (0.5 * rng.rand(*shape) + np.arange(shape[2]) + 100 * subject).astype(np.float32)
+    gt_data = (rng.rand(*shape) > 0.5).astype(np.float32)
+    roi_data = np.zeros(shape, dtype=np.float32)
+    roi_data[2:6, 2:6] = 1
+    filenames = []
+    for name, data in (('image', input_data), ('mask', gt_data), ('roi', roi_data)):
+        filename = str(tmpdir.join('sub{}-{}.nii.gz'.format(subject, name)))
+        nib.save(nib.Nifti1Image(data, np.eye(4)), filename)
+        filenames.append(filename)
+    return [filenames[0]], [filenames[1]], [filenames[2]], [{}]
+
 
 class TestMRIDataset(object):
     @pytest.fixture
@@ -105,3 +129,231 @@ class TestMRIDataset(object):
         for minbatch in dataloader:
             iterations += 1
         assert iterations == 27
+
+
+class TestIterableDataset(object):
+    @staticmethod
+    def slice_values(dataset):
+        return [int(sample['input'][0].getpixel((0, 0))) for sample in dataset]
+
+    def test_iteration(self, tmpdir):
+        filename_pairs = [write_subject(tmpdir, subject) for subject in range(2)]
+        dataset = mt_datasets.MRI2DSegmentationIterableDataset(filename_pairs, shuffle=False)
+        assert self.slice_values(dataset) == [0, 1, 2, 3, 100, 101, 102, 103]
+
+        sample = next(iter(dataset))
+        assert sample['gt'][0].mode == 'L'
+        assert sample['roi'][0].getpixel((3, 3)) == 255
+
+    def test_shuffle_buffer(self, tmpdir):
+        filename_pairs = [write_subject(tmpdir, subject) for subject in range(3)]
+        dataset = mt_datasets.MRI2DSegmentationIterableDataset(filename_pairs, buffer_size=3)
+        values = self.slice_values(dataset)
+        assert sorted(values) == [100 * s + k for s in range(3) for k in range(4)]
+        assert self.slice_values(dataset) == values
+        dataset.set_epoch(1)
+        assert sorted(self.slice_values(dataset)) == sorted(values)
+
+        # The buffered slices are copies, not views of the cached volumes
+        for _, seg_pair_slice, roi_pair_slice in dataset._slices():
+            assert seg_pair_slice['input'][0].base is None
+            assert seg_pair_slice['gt'][0].base is None
+            assert roi_pair_slice['gt'][0].base is None
+            assert roi_pair_slice['input'] is seg_pair_slice['input']
+
+    def test_reproducible_transform(self, tmpdir, monkeypatch):
+        filename_pairs = [write_subject(tmpdir, subject) for subject in range(3)]
+
+        def noisy_slices(num_workers):
+            slices = {}
+            for worker_id in range(num_workers):
+                monkeypatch.setattr(mt_datasets, 'get_worker_info',
+                                    lambda worker_id=worker_id: WorkerInfo(worker_id, num_workers))
+                dataset = mt_datasets.MRI2DSegmentationIterableDataset(
+                    filename_pairs, transform=mt_transforms.AdditiveGaussianNoise(std=1.0),
+                    buffer_size=2, seed=3)
+                dataset.set_epoch(1)
+                for sample in dataset:
+                    metadata = sample['input_metadata'][0]
+                    key = (metadata['input_filenames'], metadata['slice_index'])
+                    slices[key] = np.array(sample['input'][0])
+            return slices
+
+        # The augmentation of a slice depends neither on the global random
+        # state nor on the number of workers
+        np.random.seed(0)
+        expected = noisy_slices(1)
+        np.random.seed(1)
+        slices = noisy_slices(2)
+        assert sorted(slices) == sorted(expected)
+        assert all(np.array_equal(slices[key], expected[key]) for key in expected)
+
+    def test_worker_sharding(self, tmpdir, monkeypatch):
+        filename_pairs = [write_subject(tmpdir, subject) for subject in range(5)]
+        dataset = mt_datasets.MRI2DSegmentationIterableDataset(filename_pairs, buffer_size=2)
+        shards = []
+        for worker_id in range(2):
+            monkeypatch.setattr(mt_datasets, 'get_worker_info',
+                                lambda worker_id=worker_id: WorkerInfo(worker_id, 2))
+            shards.append(self.slice_values(dataset))
+        # Each volume is read by a single worker
+        subjects = [set(value // 100 for value in shard) for shard in shards]
+        assert not subjects[0] & subjects[1]
+        assert subjects[0] | subjects[1] == set(range(5))
+        assert sorted(shards[0] + shards[1]) == [100 * s + k for s in range(5) for k in range(4)]
+
+
+class TestROIIndex(object):
+    def test_roi_bounding_box(self):
+        mask = np.zeros((10, 12), dtype=np.float32)
+        mask[2:5, 3:9] = 1.0
+        bbox, center = mt_datasets.roi_bounding_box(mask)
+        assert bbox == (2, 4, 3, 8)
+        assert center == pytest.approx((3.0, 5.5))
+        assert mt_datasets.roi_bounding_box(np.zeros((4, 4))) == (None, None)
+
+    def test_rle_roundtrip(self):
+        mask = np.zeros((10, 12), dtype=np.float32)
+        mask[2:5, 3:9] = 1.0
+        mask[9, 11] = 1.0
+        runs = mt_datasets.rle_encode(mask)
+        assert runs.shape == (4, 2)
+        decoded = mt_datasets.rle_decode(runs, mask.shape)
+        assert np.array_equal(decoded, mask)
+
+
+class TestCropPushdown(object):
+    def test_read_slice_window(self):
+        volume = np.arange(5 * 6 * 3, dtype=np.float32).reshape(5, 6, 3)
+        window = mt_datasets.read_slice(volume, 1, slice_axis=2, window=(-1, 3, 2, 5))
+        expected = np.zeros((4, 3), dtype=np.float32)
+        expected[1:] = volume[0:3, 2:5, 1]
+        assert np.array_equal(window, expected)
+        assert np.array_equal(mt_datasets.read_slice(volume, 1), volume[..., 1])
+
+    def test_push_down_crop(self):
+        transform = transforms.Compose([
+            mt_transforms.CenterCrop2D((4, 4)),
+            mt_transforms.RandomRotation(10),
+            mt_transforms.ToTensor(),
+        ])
+        crop, remaining = mt_datasets.push_down_crop(transform, margin=2)
+        assert isinstance(crop, mt_transforms.CenterCrop2D)
+        assert [type(t) for t in remaining.transforms] == [
+            mt_transforms.RandomRotation, mt_datasets.MarginCrop2D, mt_transforms.ToTensor]
+        assert len(transform.transforms) == 3
+
+        # The margin crop crops as the CenterCrop2D, the recorded parameters
+        # refer to the full slice
+        def make_sample():
+            data = np.arange(8 * 8, dtype=np.float32).reshape(8, 8)
+            return {
+                'input': [Image.fromarray(data, mode='F')],
+                'gt': [Image.fromarray((data > 30).astype(np.uint8) * 255, mode='L')],
+                'input_metadata': [mt_datasets.SampleMetadata({'__crop_window': (1, 3, 20, 16)})],
+                'gt_metadata': [mt_datasets.SampleMetadata({'__crop_window': (1, 3, 20, 16)})],
+            }
+        expected = mt_transforms.CenterCrop2D((4, 4))(make_sample())
+        sample = remaining.transforms[1](make_sample())
+        for key in ('input', 'gt'):
+            assert np.array_equal(np.array(sample[key][0]), np.array(expected[key][0]))
+            assert sample[key + '_metadata'][0]['__centercrop'] == (3, 5, 20, 16)
+
+        crop, remaining = mt_datasets.push_down_crop(remaining)
+        assert crop is None
+
+    @pytest.mark.parametrize('crop, margin', [
+        (mt_transforms.CenterCrop2D((6, 6)), 0),
+        (mt_transforms.CenterCrop2D((6, 6)), 2),
+        (mt_transforms.CenterCrop2D((6, 6), labeled=False), 0),
+        (mt_transforms.ROICrop2D((6, 6)), 0),
+        (mt_transforms.ROICrop2D((6, 6)), 2),
+    ])
+    def test_dataset_pushdown(self, tmpdir, crop, margin):
+        filename_pairs = [write_subject(tmpdir, subject, shape=(12, 10, 3))
+                          for subject in range(2)]
+        transform = transforms.Compose([crop, mt_transforms.ToTensor()])
+        reference = mt_datasets.MRI2DSegmentationDataset(filename_pairs, transform=transform)
+        dataset = mt_datasets.MRI2DSegmentationDataset(filename_pairs, transform=transform,
+                                                       crop_pushdown=True, crop_margin=margin)
+        assert len(dataset) == len(reference)
+        for index in range(len(dataset)):
+            expected, sample = reference[index], dataset[index]
+            assert torch.equal(sample['input'], expected['input'])
+            assert torch.equal(sample['gt'], expected['gt'])
+            assert sample['input_metadata'][0]['__centercrop'] == \
+                expected['input_metadata'][0]['__centercrop']
+            if crop.labeled:
+                assert sample['gt_metadata'][0]['__centercrop'] == \
+                    expected['gt_metadata'][0]['__centercrop']
+            else:
+                assert sample['gt'].shape[-2:] == (12, 10)
+                assert '__centercrop' not in sample['gt_metadata'][0]
+
+
+class TestAugmentationCache(object):
+    def test_materialize_augmentations(self, tmpdir):
+        dataset = mt_datasets.MRI2DSegmentationDataset([write_subject(tmpdir, 0, (12, 10, 2))])
+        transform = transforms.Compose([mt_transforms.RandomCrop2D((6, 6))])
+        for name in ('aug1', 'aug2'):
+            mt_datasets.materialize_augmentations(dataset, transform, str(tmpdir.join(name)),
+                                                  num_variants=3, seed=0)
+        assert open(str(tmpdir.join('aug1', 'input.dat')), 'rb').read() == \
+            open(str(tmpdir.join('aug2', 'input.dat')), 'rb').read()
+        # The cached slices are not modified by the augmentation
+        assert '__centercrop' not in dataset.indexes[0][0]['input_metadata'][0]
+
+        augmented = mt_datasets.MRI2DAugmentedDataset(dataset, str(tmpdir.join('aug1')), seed=0)
+        assert len(augmented) == 2
+        for epoch in range(3):
+            augmented.set_epoch(epoch)
+            for index in range(len(augmented)):
+                sample = augmented[index]
+                # The metadata are the ones of the served variant
+                fh, fw, w, h = sample['input_metadata'][0]['__centercrop']
+                assert sample['gt_metadata'][0]['__centercrop'] == (fh, fw, w, h)
+                input_slice = dataset.indexes[index][0]['input'][0]
+                assert np.array_equal(np.array(sample['input'][0]),
+                                      input_slice[fh:fh + 6, fw:fw + 6])
+
+    def test_variant_stream(self):
+        # The variants don't reuse the generators of the epochs
+        epoch_rng = mt_transforms.sample_rng(0, 1, 5)
+        variant_rng = mt_transforms.sample_rng(0, 1, 5, stream=mt_datasets.MATERIALIZE_STREAM)
+        assert epoch_rng.random() != variant_rng.random()
+
+    def test_online_transform_required(self, tmpdir):
+        dataset = mt_datasets.MRI2DSegmentationDataset([write_subject(tmpdir, 0, (12, 10, 2))])
+        output_dir = str(tmpdir.join('aug'))
+        mt_datasets.materialize_augmentations(
+            dataset, transforms.Compose([mt_transforms.CenterCrop2D((6, 6))]), output_dir,
+            num_variants=1)
+        with pytest.raises(ValueError):
+            mt_datasets.MRI2DAugmentedDataset(dataset, output_dir, online_ratio=0.5)
+
+
+class TestVolumePreprocessing(object):
+    def test_cache_key(self, tmpdir):
+        filename = str(tmpdir.join('volume.npy'))
+        np.save(filename, np.zeros(3))
+        clipping = mt_transforms.HistogramClipping(5.0, 95.0)
+        params = mt_datasets.volume_stages_params([clipping])
+        key = mt_datasets.VolumeCache.key(filename, params)
+        assert key == mt_datasets.VolumeCache.key(filename, params)
+
+        other = mt_datasets.volume_stages_params([mt_transforms.HistogramClipping(1.0, 99.0)])
+        assert key != mt_datasets.VolumeCache.key(filename, other)
+
+        cache = mt_datasets.VolumeCache(str(tmpdir.join('cache')))
+        assert cache.get(key) is None
+        cache.put(key, np.ones((2, 2), dtype=np.float32))
+        assert np.array_equal(cache.get(key), np.ones((2, 2)))
+
+    def test_volume_transform(self):
+        volume = np.random.rand(16, 16, 4).astype(np.float32)
+        clipped = mt_transforms.HistogramClipping(5.0, 95.0).volume_transform(volume)
+        low, high = np.percentile(volume, (5.0, 95.0))
+        assert clipped.min() >= low - 1e-6 and clipped.max() <= high + 1e-6
+
+        equalized = mt_transforms.Clahe(kernel_size=(4, 4)).volume_transform(volume)
+        assert equalized.shape == volume.shape
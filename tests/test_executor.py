@@ -0,0 +1,47 @@
+import pytest
+import torch
+from torch.utils.data import Dataset
+
+from medicaltorch import executor as mt_executor
+
+
+class IndexDataset(Dataset):
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, index):
+        if index == 7 and getattr(self, 'fail', False):
+            raise ValueError("failing sample")
+        return {
+            'input': [torch.full((1, 4, 4), float(index)), torch.zeros(1, 4, 4)],
+            'gt': torch.full((1, 4, 4), index % 2, dtype=torch.uint8),
+            'input_metadata': {'index': index},
+        }
+
+
+class TestSharedMemoryLoader(object):
+    def test_batches(self):
+        with mt_executor.SharedMemoryLoader(IndexDataset(), batch_size=3,
+                                            num_workers=2, timeout=30) as loader:
+            for _ in range(2):
+                indices = []
+                for batch in loader:
+                    assert 'input_metadata' not in batch
+                    assert batch['gt'].dtype == torch.uint8
+                    indices.extend(batch['input'][0][:, 0, 0, 0].long().tolist())
+                assert indices == list(range(10))
+            assert len(loader) == 4
+
+    def test_shuffle(self):
+        with mt_executor.SharedMemoryLoader(IndexDataset(), batch_size=4, shuffle=True,
+                                            drop_last=True, timeout=30) as loader:
+            indices = [int(i) for batch in loader
+                       for i in batch['input'][0][:, 0, 0, 0].tolist()]
+        assert len(indices) == 8 and len(set(indices)) == 8
+
+    def test_worker_error(self):
+        dataset = IndexDataset()
+        dataset.fail = True
+        with mt_executor.SharedMemoryLoader(dataset, batch_size=2, timeout=30) as loader:
+            with pytest.raises(RuntimeError):
+                list(loader)
@@ -0,0 +1,59 @@
+import torch
+
+from medicaltorch import batch_transforms as mt_batch_transforms
+from medicaltorch import inference as mt_inference
+from medicaltorch import models as mt_models
+
+
+class TestTestTimeAugmentation(object):
+    def test_identity_model(self):
+        input_data = torch.rand(2, 1, 6, 8)
+        tta = mt_inference.TestTimeAugmentation(torch.nn.Identity(), [
+            mt_batch_transforms.BatchRandomFlip(p=1.0),
+            mt_batch_transforms.BatchRandomFlip(p=1.0, horizontal=False, vertical=True),
+        ])
+        views, matrices = tta.augment(input_data)
+        assert len(views) == 3
+        assert torch.allclose(views[1], input_data.flip(-1), atol=1e-5)
+
+        output = tta(input_data)
+        assert output.shape == input_data.shape
+        assert torch.allclose(output, input_data, atol=1e-5)
+
+
+def _randomize_batchnorms(model):
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            # Negative scales are folded with an upper clamp
+            module.weight.data.uniform_(-1.0, 1.0)
+            module.bias.data.uniform_(-0.5, 0.5)
+    return model.eval()
+
+
+class TestOptimizeForInference(object):
+    def test_nopool_aspp(self):
+        model = _randomize_batchnorms(mt_models.NoPoolASPP(base_num_filters=4))
+        input_data = torch.randn(2, 1, 32, 32)
+        optimized = mt_inference.optimize_for_inference(model, script=True)
+        with torch.no_grad():
+            assert torch.allclose(optimized(input_data), model(input_data), atol=1e-5)
+
+    def test_unet(self):
+        model = _randomize_batchnorms(mt_models.Unet())
+        input_data = torch.randn(1, 1, 16, 16)
+        optimized = mt_inference.optimize_for_inference(model, script=True)
+        assert not any(isinstance(m, torch.nn.Dropout2d) for m in optimized.modules())
+        with torch.no_grad():
+            assert torch.allclose(optimized(input_data), model(input_data), atol=1e-5)
+
+    def test_nopool_aspp_variant(self):
+        model = _randomize_batchnorms(mt_models.NoPoolASPP(base_num_filters=8, in_channels=2,
+                                                           dilations=(1, 6), separable=True,
+                                                           shared_reduction=True,
+                                                           branch_filters=4))
+        input_data = torch.randn(2, 2, 32, 32)
+        optimized = mt_inference.optimize_for_inference(model)
+        with torch.no_grad():
+            assert torch.allclose(optimized(input_data), model(input_data), atol=1e-5)
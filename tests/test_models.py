@@ -11,3 +11,28 @@ class TestModels(object):
         random_var = Variable(random_data)
         output = model(random_var)
         assert output.size() == (1, 1, 200, 200)
+
+    def test_unet3d_checkpoint(self):
+        input_data = torch.randn(1, 1, 8, 8, 8)
+        gradients = []
+        for stages, inplace in ((None, False), ('all', True)):
+            torch.manual_seed(0)
+            model = mt_models.UNet3D(1, 2, checkpoint_stages=stages, inplace=inplace)
+            output = model(input_data)
+            assert output.size() == (1, 2, 8, 8, 8)
+            output.mean().backward()
+            gradients.append(model.ec0[0].weight.grad.clone())
+        assert torch.allclose(gradients[0], gradients[1], atol=1e-6)
+
+    def test_aspp_variants(self):
+        model = mt_models.NoPoolASPP()
+        state_dict = model.state_dict()
+        assert state_dict['branch1b.weight'].shape == (64, 64, 1, 1)
+        assert state_dict['branch5b.weight'].shape == (64, 64, 3, 3)
+        assert state_dict['concat_bn.weight'].shape == (6 * 64,)
+
+        variant = mt_models.NoPoolASPP(base_num_filters=16, in_channels=2, dilations=(1, 6, 12),
+                                       separable=True, shared_reduction=True, branch_filters=8)
+        assert variant.amort.in_channels == 4 * 8
+        output = variant(torch.randn(2, 2, 32, 32))
+        assert output.size() == (2, 1, 32, 32)
@@ -0,0 +1,114 @@
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from medicaltorch import datasets as mt_datasets
+from medicaltorch import preprocessing as mt_preprocessing
+
+
+def write_volume(filename, data, zooms=(2., 2., 2.)):
+    affine = np.diag(list(zooms) + [1.])
+    nib.save(nib.Nifti1Image(data.astype(np.float32), affine), filename)
+    return filename
+
+
+@pytest.fixture
+def subjects(tmpdir):
+    rng = np.random.RandomState(0)
+    subjects = []
+    for subject in range(2):
+        input_filename = write_volume(str(tmpdir.join('sub{}-image.nii.gz'.format(subject))),
+                                      10 * rng.rand(8, 8, 4) + 5)
+        gt_filename = write_volume(str(tmpdir.join('sub{}-mask.nii.gz'.format(subject))),
+                                   (rng.rand(8, 8, 4) > 0.5).astype(np.float32))
+        roi_filename = write_volume(str(tmpdir.join('sub{}-roi.nii.gz'.format(subject))),
+                                    np.ones((8, 8, 4)))
+        subjects.append({'input': [input_filename], 'gt': [gt_filename], 'roi': [roi_filename]})
+    return subjects
+
+
+class TestPreprocessing(object):
+    def test_crop_or_pad(self):
+        data = np.arange(4 * 6, dtype=np.float32).reshape(4, 6)
+        output, starts = mt_preprocessing.crop_or_pad(data, (6, 2))
+        assert output.shape == (6, 2)
+        assert starts == [-1, 2]
+        assert np.array_equal(output[1:5], data[:, 2:4])
+        assert not output[0].any() and not output[5].any()
+
+    def test_preprocess_dataset(self, tmpdir, subjects):
+        output_dir = str(tmpdir.join('output'))
+        manifest = mt_preprocessing.preprocess_dataset(subjects, output_dir, spacing=(1., 1., 1.),
+                                                       crop=(12, 12, 0))
+        with open(os.path.join(output_dir, 'manifest.json')) as fhandle:
+            assert json.load(fhandle) == manifest
+        assert manifest['parameters'] == {'spacing': [1., 1., 1.], 'crop': [12, 12, 0],
+                                          'normalization': 'zscore'}
+        assert [entry['source'] for entry in manifest['subjects']] == subjects
+
+        entry = manifest['subjects'][0]
+        input_img = nib.load(entry['input'][0])
+        assert input_img.shape == (12, 12, 8)
+        assert np.allclose(input_img.header.get_zooms(), (1., 1., 1.))
+        input_data = input_img.get_fdata()
+        assert abs(input_data.mean()) < 1e-4
+        assert input_data.std() == pytest.approx(1., abs=1e-4)
+
+        # The labels are resampled with the nearest neighbour and not normalized
+        gt_data = nib.load(entry['gt'][0]).get_fdata()
+        assert gt_data.shape == (12, 12, 8)
+        assert set(np.unique(gt_data)) <= {0., 1.}
+
+        filename_pairs = mt_preprocessing.load_manifest(os.path.join(output_dir, 'manifest.json'))
+        assert filename_pairs[0] == (entry['input'], entry['gt'], entry['roi'], [{}])
+        dataset = mt_datasets.MRI2DSegmentationDataset(filename_pairs)
+        assert len(dataset) == 2 * 8
+
+    def test_unique_filenames(self, tmpdir, subjects):
+        with pytest.raises(RuntimeError):
+            mt_preprocessing.preprocess_dataset(subjects + subjects[:1], str(tmpdir.join('output')))
+
+    def test_read_subjects(self, tmpdir):
+        csv_filename = str(tmpdir.join('subjects.csv'))
+        with open(csv_filename, 'w') as fhandle:
+            fhandle.write("input,gt,roi\nt1.nii.gz;t2.nii.gz,gm.nii.gz;wm.nii.gz,\n")
+        assert mt_preprocessing.read_subjects(csv_filename) == [{
+            'input': ['t1.nii.gz', 't2.nii.gz'],
+            'gt': ['gm.nii.gz', 'wm.nii.gz'],
+            'roi': [],
+        }]
+
+
+class TestMain(object):
+    @pytest.fixture
+    def calls(self, tmpdir, monkeypatch):
+        calls = []
+        monkeypatch.setattr(mt_preprocessing, 'preprocess_dataset',
+                            lambda subjects, output_dir, **kwargs: calls.append(kwargs))
+        with open(str(tmpdir.join('subjects.csv')), 'w') as fhandle:
+            fhandle.write("input\nimage.nii.gz\n")
+        return calls
+
+    def test_spacing(self, tmpdir, calls):
+        csv_filename = str(tmpdir.join('subjects.csv'))
+        mt_preprocessing.main([csv_filename, 'output', '--spacing', '0.5', '--workers', '0'])
+        mt_preprocessing.main([csv_filename, 'output', '--spacing', '0.5', '0.5', '2'])
+        assert calls[0]['spacing'] == [0.5, 0.5, 0.5]
+        assert calls[0]['num_workers'] == 0
+        assert calls[0]['normalization'] == 'zscore'
+        assert calls[1]['spacing'] == [0.5, 0.5, 2.]
+
+        with pytest.raises(SystemExit):
+            mt_preprocessing.main([csv_filename, 'output', '--spacing', '0.5', '0.5'])
+        assert len(calls) == 2
+
+    def test_normalization(self, tmpdir, calls):
+        csv_filename = str(tmpdir.join('subjects.csv'))
+        mt_preprocessing.main([csv_filename, 'output', '--normalization', 'none',
+                               '--crop', '64', '64', '0'])
+        assert calls[0]['normalization'] is None
+        assert calls[0]['crop'] == [64, 64, 0]
+        assert calls[0]['spacing'] is None
@@ -0,0 +1,127 @@
+import collections
+import functools
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from medicaltorch import models as mt_models
+from medicaltorch import profiling as mt_profiling
+
+
+class AddOne(object):
+    def __call__(self, sample):
+        sample['input'] = sample['input'] + 1
+        return sample
+
+
+class TestInstrumentedCompose(object):
+    def test_records_each_transform(self):
+        compose = mt_profiling.InstrumentedCompose([AddOne(), AddOne()])
+        for _ in range(5):
+            sample = compose({'input': np.zeros((64, 64), dtype=np.float32)})
+        assert sample['input'].max() == 2
+
+        summary = compose.collect()
+        assert list(summary.keys()) == ['0:AddOne', '1:AddOne']
+        assert all(stats['calls'] == 5 for stats in summary.values())
+        assert summary['0:AddOne']['memory_p95'] >= 64 * 64 * 4
+
+        assert '0:AddOne' in compose.report()
+        assert json.loads(compose.to_json())['1:AddOne']['calls'] == 5
+        compose.close()
+
+
+class TestMeasureTrainStep(object):
+    def test_memory_time_table(self):
+        configs = collections.OrderedDict([
+            ('baseline', functools.partial(mt_models.UNet3D, 1, 1)),
+            ('checkpoint', functools.partial(mt_models.UNet3D, 1, 1, checkpoint_stages='all')),
+        ])
+        results, table = mt_profiling.memory_time_table(configs, (1, 1, 8, 8, 8),
+                                                        steps=1, timeout=120)
+        assert list(results) == ['baseline', 'checkpoint']
+        assert all(result['peak_rss'] >= result['baseline_rss'] > 0
+                   for result in results.values())
+        assert 'checkpoint' in table
+
+    def test_process_killed(self):
+        with pytest.raises(RuntimeError, match="without a result"):
+            mt_profiling.measure_train_step(functools.partial(os._exit, 1), (1, 1, 8, 8))
+
+    def test_timeout(self):
+        start = time.time()
+        with pytest.raises(RuntimeError, match="timed out"):
+            mt_profiling.measure_train_step(functools.partial(time.sleep, 60), (1, 1, 8, 8),
+                                            timeout=2)
+        assert time.time() - start < 30
+
+
+class TestModelCost(object):
+    def test_count_flops(self):
+        conv = torch.nn.Conv2d(2, 4, kernel_size=3, padding=1)
+        assert mt_profiling.count_parameters(conv) == 4 * 2 * 9 + 4
+        assert mt_profiling.count_flops(conv, (1, 2, 8, 8)) == 2 * 4 * 8 * 8 * 2 * 9
+
+    def test_model_cost_table(self):
+        models = collections.OrderedDict([
+            ('aspp', mt_models.NoPoolASPP(base_num_filters=8)),
+            ('aspp-separable', mt_models.NoPoolASPP(base_num_filters=8, separable=True)),
+        ])
+        results, table = mt_profiling.model_cost_table(models, (1, 1, 32, 32), repeats=1)
+        assert results['aspp-separable']['flops'] < results['aspp']['flops']
+        assert results['aspp-separable']['parameters'] < results['aspp']['parameters']
+        assert 'aspp-separable' in table
+
+
+class ConvSigmoid(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(1, 4, kernel_size=3, padding=1)
+
+    def forward(self, x):
+        return torch.sigmoid(self.conv(x))
+
+
+class TestMemoryEstimation(object):
+    def test_estimate_memory(self):
+        model = torch.nn.Sequential(torch.nn.Conv2d(1, 4, kernel_size=3, padding=1),
+                                    torch.nn.ReLU(inplace=True))
+        memory = mt_profiling.estimate_memory(model, (2, 1, 8, 8), optimizer='adam')
+        assert memory['parameters'] == (4 * 9 + 4) * 4
+        assert memory['optimizer'] == 2 * memory['gradients']
+        # The in-place ReLU output isn't counted twice
+        assert memory['activations'] == (2 * 4 * 8 * 8 + 2 * 8 * 8) * 4
+        assert memory['total'] == sum(memory[key] for key in
+                                      ('parameters', 'gradients', 'optimizer', 'activations'))
+
+    def test_estimate_memory_functional(self):
+        # The output of the functional sigmoid is saved for the backward
+        memory = mt_profiling.estimate_memory(ConvSigmoid(), (2, 1, 8, 8))
+        assert memory['activations'] == (2 * 4 * 8 * 8 + 2 * 8 * 8) * 4
+
+    def test_estimate_memory_keeps_state(self):
+        model = torch.nn.Sequential(torch.nn.Conv2d(1, 4, kernel_size=3, padding=1),
+                                    torch.nn.BatchNorm2d(4), torch.nn.Dropout2d(0.5))
+        model.eval()
+        mt_profiling.estimate_memory(model, (2, 1, 8, 8))
+        assert not model.training
+        assert torch.equal(model[1].running_mean, torch.zeros(4))
+        assert model[1].num_batches_tracked.item() == 0
+
+    def test_find_max_sizes(self):
+        model = mt_models.Unet()
+        budget = 256 * 2 ** 20
+        batch_size = mt_profiling.find_max_batch_size(model, (1, 32, 32), budget)
+        assert batch_size >= 1
+        assert mt_profiling.estimate_memory(model, (batch_size, 1, 32, 32))['total'] <= budget
+        assert mt_profiling.estimate_memory(model, (batch_size + 1, 1, 32, 32))['total'] > budget
+        assert mt_profiling.find_max_batch_size(model, (1, 32, 32), 2 ** 20) is None
+
+        model = torch.nn.Conv3d(1, 2, kernel_size=3, padding=1)
+        length = mt_profiling.find_max_patch_size(model, 1, 8 * 2 ** 20, multiple=8)
+        assert length % 8 == 0
+        assert mt_profiling.estimate_memory(model, (1, 1, length, length, length))['total'] <= 8 * 2 ** 20
@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from medicaltorch import models as mt_models
+from medicaltorch import quantization as mt_quantization
+
+
+def _batches(num_batches=2):
+    batches = []
+    for _ in range(num_batches):
+        gt = (torch.rand(2, 1, 16, 16) > 0.7).float()
+        batches.append({'input': torch.randn(2, 1, 16, 16), 'gt': gt})
+    return batches
+
+
+class TestQuantization(object):
+    def test_quantizable_matches_float(self):
+        model = mt_models.NoPoolASPP(base_num_filters=4).eval()
+        quantizable = mt_quantization.make_quantizable(model)
+        input_data = torch.randn(1, 1, 16, 16)
+        with torch.no_grad():
+            assert torch.allclose(quantizable(input_data), model(input_data), atol=1e-5)
+
+    @pytest.mark.skipif('fbgemm' not in torch.backends.quantized.supported_engines,
+                        reason="fbgemm quantized engine not available")
+    def test_quantize_and_report(self):
+        model = mt_models.NoPoolASPP(base_num_filters=4).eval()
+        quantized = mt_quantization.quantize_model(model, _batches(), num_batches=2)
+        output = quantized(torch.randn(1, 1, 16, 16))
+        assert output.shape == (1, 1, 16, 16)
+
+        report = mt_quantization.dice_drift(model, quantized, _batches())
+        assert set(report) == {'dice_reference', 'dice_quantized', 'drift', 'max_drop', 'agreement'}
+        assert 0.0 <= report['agreement'] <= 1.0
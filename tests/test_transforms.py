@@ -0,0 +1,410 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from scipy.ndimage import gaussian_filter
+from torchvision import transforms
+
+from medicaltorch import batch_transforms as mt_batch_transforms
+from medicaltorch import datasets as mt_datasets
+from medicaltorch import transforms as mt_transforms
+
+
+class TestSampleRNG(object):
+    def test_sample_rng_is_deterministic(self):
+        degrees = (-10, 10)
+        with mt_transforms.sample_rng_context(mt_transforms.sample_rng(42, 3, 7)):
+            first = mt_transforms.RandomRotation.get_params(degrees)
+        with mt_transforms.sample_rng_context(mt_transforms.sample_rng(42, 3, 7)):
+            second = mt_transforms.RandomRotation.get_params(degrees)
+        with mt_transforms.sample_rng_context(mt_transforms.sample_rng(42, 3, 8)):
+            other = mt_transforms.RandomRotation.get_params(degrees)
+        assert first == second
+        assert first != other
+        assert mt_transforms.get_rng() is np.random
+
+    def test_resumable_sampler(self):
+        data_source = list(range(20))
+        sampler = mt_datasets.ResumableRandomSampler(data_source, seed=1)
+        sampler.set_epoch(2)
+        full_epoch = list(sampler)
+        assert sorted(full_epoch) == data_source
+
+        state = sampler.state_dict(8)
+        resumed = mt_datasets.ResumableRandomSampler(data_source)
+        resumed.load_state_dict(state)
+        resumed.set_epoch(2)
+        assert len(resumed) == 12
+        assert list(resumed) == full_epoch[8:]
+
+        # The permutation stream is not the one of a sample or of a variant
+        streams = [0, mt_datasets.MATERIALIZE_STREAM, mt_datasets.SAMPLER_STREAM]
+        assert len(set(streams)) == len(streams)
+
+
+class TestBatchTransforms(object):
+    @staticmethod
+    def make_batch():
+        gt = torch.zeros(2, 1, 8, 10)
+        gt[:, :, 2:6, 3:7] = 1.0
+        return {'input': torch.rand(2, 1, 8, 10), 'gt': gt}
+
+    def test_center_crop(self):
+        batch = self.make_batch()
+        expected = batch['input'][..., 2:6, 3:7].clone()
+        batch = mt_batch_transforms.BatchCenterCrop2D((4, 4))(batch)
+        assert batch['input'].size() == (2, 1, 4, 4)
+        assert torch.equal(batch['input'], expected)
+        assert batch['gt'].sum() == 2 * 16
+        assert batch['__affine'].size() == (2, 3, 3)
+
+    def test_identity_rotation(self):
+        batch = self.make_batch()
+        expected_input = batch['input'].clone()
+        expected_gt = batch['gt'].clone()
+        batch = mt_batch_transforms.BatchRandomRotation((0, 0))(batch)
+        assert torch.allclose(batch['input'], expected_input, atol=1e-5)
+        assert torch.equal(batch['gt'], expected_gt)
+
+    def test_additive_gaussian_noise(self):
+        batch = {'input': torch.zeros(2, 3, 8, 10)}
+        transform = mt_batch_transforms.BatchAdditiveGaussianNoise(mean=1.0, std=0.5)
+        with mt_transforms.sample_rng_context(mt_transforms.sample_rng(0, 0, 0)):
+            batch = transform(batch)
+        expected = 1.0 + 0.5 * mt_transforms.sample_rng(0, 0, 0).standard_normal(
+            (2, 1, 8, 10), dtype=np.float32)
+        assert batch['input'].dtype == torch.float32
+        # The noise of a sample is shared by its modalities
+        assert torch.allclose(batch['input'], torch.from_numpy(expected).expand(2, 3, 8, 10))
+
+
+class TestFusedGeometricCompose(object):
+    @staticmethod
+    def make_sample():
+        input_data = np.random.rand(8, 10).astype(np.float32)
+        gt_data = np.zeros((8, 10), dtype=np.uint8)
+        gt_data[2:6, 3:7] = 255
+        return {
+            'input': [Image.fromarray(input_data, mode='F')],
+            'gt': [Image.fromarray(gt_data, mode='L')],
+            'roi': None,
+            'input_metadata': [mt_datasets.SampleMetadata({})],
+            'gt_metadata': [mt_datasets.SampleMetadata({})],
+        }
+
+    def test_groups(self):
+        fused = mt_transforms.FusedGeometricCompose([
+            mt_transforms.CenterCrop2D((4, 4)),
+            mt_transforms.RandomRotation(5),
+            mt_transforms.ToTensor(),
+        ])
+        assert [(flag, len(group)) for flag, group in fused.groups()] == [(True, 2), (False, 1)]
+
+    def test_crop_matches_center_crop(self):
+        sample = self.make_sample()
+        expected = np.array(sample['input'][0])[2:6, 3:7]
+        fused = mt_transforms.FusedGeometricCompose([mt_transforms.CenterCrop2D((4, 4))])
+        sample = fused(sample)
+        assert sample['input'][0].size == (4, 4)
+        assert np.allclose(np.array(sample['input'][0]), expected)
+        assert np.array(sample['gt'][0]).min() == 255
+
+        sample = fused.undo_transform(sample)
+        assert sample['input'][0].size == (10, 8)
+        assert np.allclose(np.array(sample['input'][0])[2:6, 3:7], expected)
+
+
+class TestElasticTransform(object):
+    def test_shared_field(self):
+        gt_data = np.zeros((32, 24), dtype=np.uint8)
+        gt_data[8:24, 6:18] = 255
+        sample = {
+            'input': [Image.fromarray(gt_data.astype(np.float32) / 255, mode='F')],
+            'gt': [Image.fromarray(gt_data, mode='L')],
+        }
+        transform = mt_transforms.ElasticTransform(alpha_range=(20., 20.),
+                                                   sigma_range=(4., 4.), p=1.0)
+        with mt_transforms.sample_rng_context(mt_transforms.sample_rng(0, 0, 0)):
+            sample = transform(sample)
+
+        input_data = np.array(sample['input'][0])
+        gt_data = np.array(sample['gt'][0])
+        assert input_data.shape == gt_data.shape == (32, 24)
+        assert np.array_equal(np.where(input_data >= 0.5, 255, 0), gt_data)
+
+    def test_chunks_match_whole_volume(self):
+        volume = np.random.rand(12, 10, 8).astype(np.float32)
+        chunked = mt_transforms.ElasticTransform((10., 10.), (3., 3.), chunk_size=5)
+        whole = mt_transforms.ElasticTransform((10., 10.), (3., 3.), chunk_size=None)
+        with mt_transforms.sample_rng_context(mt_transforms.sample_rng(0, 0, 0)):
+            expected = whole.elastic_transform(volume, 10., 3.)
+        with mt_transforms.sample_rng_context(mt_transforms.sample_rng(0, 0, 0)):
+            output = chunked.elastic_transform(volume, 10., 3.)
+        assert output.dtype == np.float32
+        assert np.allclose(output, expected)
+
+    @pytest.mark.parametrize('sigma, spacing', [(4., 2), (8., 4)])
+    def test_coarse_field_amplitude(self, sigma, spacing):
+        # The coarse field has the amplitude of a full resolution field
+        noise = np.random.RandomState(0).random_sample((256, 256)) * 2 - 1
+        reference = 30. * gaussian_filter(noise, sigma, mode="constant", cval=0)
+        transform = mt_transforms.ElasticTransform((30., 30.), (sigma, sigma))
+        with mt_transforms.sample_rng_context(mt_transforms.sample_rng(0, 0, 0)):
+            fields = transform.coarse_field((256, 256), 30., sigma, spacing)
+
+        def interior(field):
+            margin = field.shape[0] // 4
+            return field[margin:-margin, margin:-margin]
+
+        coarse_std = np.std([interior(field) for field in fields])
+        assert coarse_std == pytest.approx(np.std(interior(reference)), rel=0.25)
+
+
+class TestRandomRotation3D(object):
+    def test_rotation_around_axis(self):
+        volume = np.zeros((9, 9, 9), dtype=np.float32)
+        volume[4, 4, 6:] = 1.
+        sample = {'input': [volume], 'gt': [volume.copy()]}
+        transform = mt_transforms.RandomRotation3D((90, 90), axis=0)
+        sample = transform(sample)
+
+        expected = np.rot90(volume, k=1, axes=(1, 2))
+        assert sample['input'][0].dtype == np.float32
+        assert np.allclose(sample['input'][0], expected, atol=1e-5)
+        assert np.array_equal(sample['gt'][0], np.round(sample['input'][0]))
+
+    def test_random_axis_is_unit(self):
+        angle, direction = mt_transforms.RandomRotation3D.get_params((-10, 10), axis=None)
+        rotation = mt_transforms.RandomRotation3D.rotation_matrix(angle, direction)
+        assert np.isclose(np.linalg.norm(direction), 1.)
+        assert np.allclose(rotation.dot(rotation.T), np.eye(3))
+
+
+class TestLabelMap(object):
+    def test_warp_and_expand(self):
+        masks = [np.zeros((8, 8), dtype=np.float32) for _ in range(3)]
+        masks[0][1:3, 1:3] = 1.
+        masks[2][5:7, 4:8] = 1.
+        seg_pair_slice = {
+            'input': [np.random.rand(8, 8).astype(np.float32)],
+            'gt': masks,
+            'input_metadata': [mt_datasets.SampleMetadata({})],
+            'gt_metadata': [mt_datasets.SampleMetadata({}) for _ in masks],
+        }
+        roi_pair_slice = {'gt': [], 'gt_metadata': []}
+        sample = mt_datasets.build_slice_sample(seg_pair_slice, roi_pair_slice,
+                                                label_map=True)
+        assert len(sample['gt']) == 1
+        assert mt_transforms.label_map_classes(sample) == 3
+
+        # The label map is warped with nearest neighbour whatever resample is
+        rotation = mt_transforms.RandomRotation((90, 90), resample=Image.BILINEAR)
+        sample = mt_transforms.ToTensor()(rotation(sample))
+        assert sample['gt'].shape == (3, 8, 8)
+        assert sample['gt'].sum(0).max() <= 1
+        assert sample['gt'][1].sum() == 0
+        for idx, mask in enumerate(masks):
+            assert sample['gt'][idx].sum() == mask.sum()
+
+
+class TestPlanConversions(object):
+    def test_removes_round_trips(self):
+        gt_data = np.zeros((8, 8), dtype=np.uint8)
+        gt_data[2:6, 2:6] = 255
+        sample = {
+            'input': [Image.fromarray(np.random.rand(8, 8).astype(np.float32), mode='F')],
+            'gt': [Image.fromarray(gt_data, mode='L')],
+        }
+        chain = [
+            mt_transforms.ToNumpy(),
+            mt_transforms.RandomTensorChannelShift((0., 0.)),
+            mt_transforms.ToPIL(),
+            mt_transforms.AdditiveGaussianNoise(0., 0.),
+            mt_transforms.ToTensor(),
+        ]
+        compose, report = mt_transforms.plan_conversions(chain, sample)
+        assert [type(t) for t in compose.transforms] == [
+            mt_transforms.ToNumpy,
+            mt_transforms.RandomTensorChannelShift,
+            mt_transforms.AdditiveGaussianNoise,
+            mt_transforms.ToTensor,
+        ]
+        assert report['valid']
+        assert report['bytes_before'] == 6 * (8 * 8 * 4 + 8 * 8)
+        assert report['bytes_after'] == 4 * (8 * 8 * 4 + 8 * 8)
+
+        expected = np.array(sample['input'][0])
+        sample = compose(sample)
+        assert torch.allclose(sample['input'], torch.from_numpy(expected).unsqueeze(0))
+        assert sample['gt'].shape == (1, 8, 8)
+        assert sample['gt'].max() == 1
+
+    def test_invalid_chain(self):
+        sample = {'input': [np.zeros((4, 4), dtype=np.float32)], 'gt': None}
+        compose, report = mt_transforms.plan_conversions(
+            [mt_transforms.RandomRotation(10), mt_transforms.ToTensor()], sample)
+        assert not report['valid']
+        assert [type(t) for t in compose.transforms] == [
+            mt_transforms.ToPIL, mt_transforms.RandomRotation, mt_transforms.ToTensor]
+
+    def test_unreachable_representation(self):
+        class ToVolume(mt_transforms.MTTransform):
+            accepts = {'numpy': 0}
+            produces = 'volume'
+
+            def __call__(self, sample):
+                return sample
+
+        sample = {'input': [np.zeros((4, 4), dtype=np.float32)], 'gt': None}
+        chain = [ToVolume(), mt_transforms.ToTensor()]
+        compose, report = mt_transforms.plan_conversions(chain, sample)
+        assert not report['valid']
+        assert "No conversion chain" in report['errors'][-1]
+        assert compose.transforms == chain
+        assert report['bytes_after'] == report['bytes_before']
+
+    def test_to_tensor_numpy(self):
+        volume = np.random.rand(4, 5, 6).astype(np.float32)
+        tensor = mt_transforms.ToTensor.to_tensor(volume)
+        assert tensor.shape == (6, 4, 5)
+        assert torch.equal(tensor, torch.from_numpy(volume).permute(2, 0, 1))
+
+        image = np.random.rand(4, 5).astype(np.float32)
+        tensor = mt_transforms.ToTensor.to_tensor(image)
+        assert tensor.shape == (1, 4, 5)
+        tensor.add_(1)
+        assert np.allclose(tensor.numpy()[0], image + 1)
+
+
+class TestUndoCompose(object):
+    def test_rotation_roundtrip(self):
+        input_data = np.random.rand(8, 8).astype(np.float32)
+        sample = {
+            'input': [Image.fromarray(input_data, mode='F')],
+            'gt': [Image.fromarray(np.zeros((8, 8), dtype=np.uint8), mode='L')],
+            'input_metadata': [mt_datasets.SampleMetadata({})],
+            'gt_metadata': [mt_datasets.SampleMetadata({})],
+        }
+        compose = transforms.Compose([
+            mt_transforms.RandomRotation((90, 90)),
+            mt_transforms.RandomAffine((180, 180)),
+        ])
+        sample = compose(sample)
+        assert not np.allclose(np.array(sample['input'][0]), input_data)
+
+        sample = mt_transforms.UndoCompose(compose)(sample)
+        assert np.allclose(np.array(sample['input'][0]), input_data)
+
+
+class TestIntensityAugmentation(object):
+    def test_sample_in_place(self):
+        arrays = [np.random.rand(6, 7).astype(np.float32) for _ in range(2)]
+        expected = [array * 2 + 1 for array in arrays]
+        transform = mt_transforms.IntensityAugmentation(shift_range=(1., 1.),
+                                                        scale_range=(2., 2.),
+                                                        gamma_range=(1., 1.),
+                                                        copy=False)
+        sample = transform({'input': list(arrays)})
+        for array, output, expected_array in zip(arrays, sample['input'], expected):
+            assert output is array
+            assert np.allclose(output, expected_array)
+
+    def test_copy_by_default(self):
+        volume = np.ones((4, 5, 6), dtype=np.float32)
+        transform = mt_transforms.IntensityAugmentation(shift_range=(1., 1.))
+        for _ in range(3):
+            output = transform({'input': volume})['input']
+        assert np.allclose(volume, 1.)
+        assert np.allclose(output, 2.)
+
+        input_data = torch.ones(2, 1, 4, 4)
+        batch = mt_batch_transforms.BatchIntensityAugmentation(shift_range=(1., 1.))(
+            {'input': input_data})
+        assert torch.equal(input_data, torch.ones(2, 1, 4, 4))
+        assert torch.allclose(batch['input'], torch.full((2, 1, 4, 4), 2.))
+
+    def test_shared_bias_field(self):
+        input_data = torch.ones(3, 2, 8, 8)
+        transform = mt_batch_transforms.BatchIntensityAugmentation(
+            bias_field_std=0.5, noise_std=None, per_channel=False, copy=False)
+        batch = transform({'input': input_data})
+        assert batch['input'] is input_data
+        assert (input_data > 0).all()
+        assert torch.allclose(input_data[:, 0], input_data[:, 1])
+        assert not torch.allclose(input_data[0], input_data[1])
+
+
+class TestNormalizeInstance(object):
+    def test_per_slice(self):
+        image = torch.rand(1, 8, 8) * 10 + 5
+        original = image.clone()
+        sample = {'input': image, 'input_metadata': mt_datasets.SampleMetadata({})}
+        output = mt_transforms.NormalizeInstance()(sample)['input']
+        expected = (original - original.mean()) / original.std()
+        assert torch.allclose(output, expected, atol=1e-5)
+        assert torch.equal(image, original)
+
+        empty = {'input': torch.zeros(1, 8, 8)}
+        assert torch.equal(mt_transforms.NormalizeInstance()(empty)['input'], torch.zeros(1, 8, 8))
+
+    def test_per_volume(self):
+        volume = np.random.rand(6, 5, 20) * 10
+        mean, std = mt_datasets.volume_stats(volume, chunk_size=3)
+        assert np.isclose(mean, volume.mean())
+        assert np.isclose(std, volume.std(ddof=1))
+
+        metadata = mt_datasets.SampleMetadata({'__volume_stats': (mean, std)})
+        image = torch.from_numpy(volume[..., 0].astype(np.float32)).unsqueeze(0)
+        sample = {'input': [image.clone()], 'input_metadata': [metadata]}
+        output = mt_transforms.NormalizeInstance(per_volume=True)(sample)['input'][0]
+        assert torch.allclose(output, (image - mean) / std, atol=1e-5)
+
+        with pytest.raises(RuntimeError):
+            mt_transforms.NormalizeInstance(per_volume=True)({'input': image, 'input_metadata': None})
+
+
+class TestRandomAffine(object):
+    def test_mask_threshold(self):
+        gt_data = np.zeros((8, 8), dtype=np.uint8)
+        gt_data[2:6, 2:6] = 255
+        gt_data[7] = 100
+        sample = {
+            'input': [Image.fromarray(np.random.rand(8, 8).astype(np.float32), mode='F')],
+            'gt': [Image.fromarray(gt_data, mode='L')],
+            'input_metadata': [mt_datasets.SampleMetadata({})],
+            'gt_metadata': [mt_datasets.SampleMetadata({})],
+        }
+        sample = mt_transforms.RandomAffine((0, 0))(sample)
+        # 'L' masks are thresholded at the half of 255
+        assert np.array_equal(np.array(sample['gt'][0]), np.where(gt_data > 127, 255, 0))
+
+
+class TestRandomCrop2D(object):
+    def _sample(self):
+        gt = np.zeros((40, 40), dtype=np.float32)
+        gt[30:33, 5:8] = 1.0
+        seg_pair_slice = {'gt': [gt], 'gt_metadata': [mt_datasets.SampleMetadata({})]}
+        mt_datasets.index_foreground_slice(seg_pair_slice)
+        assert seg_pair_slice['gt_metadata'][0]['__fg_coords'].dtype == np.int16
+        return {
+            'input': [Image.fromarray(np.random.rand(40, 40).astype(np.float32), mode='F')],
+            'gt': [Image.fromarray((gt * 255).astype(np.uint8), mode='L')],
+            'input_metadata': [mt_datasets.SampleMetadata({})],
+            'gt_metadata': seg_pair_slice['gt_metadata'],
+        }
+
+    def test_positive_crop(self):
+        crop = mt_transforms.RandomCrop2D((8, 8), positive_ratio=1.0)
+        for _ in range(10):
+            sample = crop(self._sample())
+            assert sample['input'][0].size == (8, 8)
+            assert np.array(sample['gt'][0]).any()
+            fh, fw, w, h = sample['input_metadata'][0]['__centercrop']
+            assert 0 <= fh <= 32 and 0 <= fw <= 32
+
+    def test_undo(self):
+        crop = mt_transforms.RandomCrop2D((8, 8), positive_ratio=0.0)
+        sample = transforms.Compose([crop, mt_transforms.ToTensor()])(self._sample())
+        sample['input'] = [sample['input']]
+        sample = crop.undo_transform(sample)
+        assert sample['input'][0].shape[-2:] == (40, 40)